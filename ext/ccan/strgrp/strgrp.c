@@ -16,6 +16,7 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 */
 #include <assert.h>
+#include <ctype.h>
 #include <limits.h>
 #include <math.h>
 #include <stdbool.h>
@@ -23,63 +24,299 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <time.h>
+#include "ccan/block_pool/block_pool.h"
 #include "ccan/darray/darray.h"
-#include "ccan/stringmap/stringmap.h"
+#include "ccan/hash/hash.h"
+#include "ccan/htable/htable_type.h"
+#include "ccan/list/list.h"
+#include "ccan/str/str.h"
 #include "ccan/tal/tal.h"
 #include "ccan/tal/str/str.h"
 #include "strgrp.h"
 #include "config.h"
+#if HAVE_OPENMP
+#include <omp.h>
+#endif
+/* The SIMD kernels are built for any x86-64 CPU and chosen at runtime */
+#if defined(__x86_64__) && defined(__GNUC__)
+#define STRGRP_X86_KERNELS 1
+#include <immintrin.h>
+#endif
 
 #define CHAR_N_VALUES (1 << CHAR_BIT)
 
 typedef darray(struct strgrp_grp *) darray_grp;
 typedef darray(struct strgrp_item *) darray_item;
+typedef darray(struct strgrp_variant *) darray_variant;
+
+/* Exact matching
+ *
+ * Maps each string added to the instance to its group. The query is hashed
+ * once, and the hash serves the lookup, the score cache and the insertion of
+ * the string into its group.
+ */
+struct known_key {
+    const char *str;
+    size_t hash;
+};
+
+struct known_entry {
+    struct known_key key;
+    struct strgrp_grp *grp;
+    char data[];
+};
+
+static inline const struct known_key *
+known_entry_key(const struct known_entry *const e) {
+    return &e->key;
+}
+
+static inline size_t
+known_key_hash(const struct known_key *const k) {
+    return k->hash;
+}
+
+static inline bool
+known_entry_eq(const struct known_entry *const e,
+        const struct known_key *const k) {
+    return e->key.hash == k->hash && streq(e->key.str, k->str);
+}
+
+HTABLE_DEFINE_TYPE(struct known_entry, known_entry_key, known_key_hash,
+        known_entry_eq, known_table);
+
+static inline size_t
+known_hash(const char *const str, const size_t len) {
+    return hash(str, len, 0);
+}
+
+/* A distinct string of a group, shared by the items bearing it */
+struct strgrp_variant {
+    const struct strgrp_grp *grp;
+    /* In ctx->keys, or borrowed from a snapshot */
+    const char *key;
+    size_t key_len;
+    size_t hash;
+    /* The number of items bearing the string */
+    size_t count;
+    /* The position of the key record while saving, see strgrp_save() */
+    size_t slot;
+    bool borrowed;
+};
+
+static inline const struct strgrp_variant *
+variant_key(const struct strgrp_variant *const v) {
+    return v;
+}
+
+static inline size_t
+variant_hash(const struct strgrp_variant *const v) {
+    return hash64(&v->hash, 1, (uintptr_t)v->grp);
+}
+
+static inline bool
+variant_eq(const struct strgrp_variant *const v,
+        const struct strgrp_variant *const k) {
+    return v->grp == k->grp && v->hash == k->hash &&
+        v->key_len == k->key_len && !memcmp(v->key, k->key, k->key_len);
+}
+
+/* The variants of all groups, by group and string */
+HTABLE_DEFINE_TYPE(struct strgrp_variant, variant_key, variant_hash,
+        variant_eq, variant_table);
 
-typedef stringmap(struct strgrp_grp *) stringmap_grp;
+/* Freed keys are binned by size in steps of KEY_GRAIN, see key_dup() */
+#define KEY_GRAIN 8
+#define KEY_BINS 64
+
+struct lcs_pattern;
+struct lcs_scratch;
+struct score_pending;
+struct qgram_posting;
+struct qgram_index;
+struct minhash_index;
+struct partition;
+struct score_cache;
+
+/* Grow-only working space, so steady-state scoring does not allocate */
+struct scratch {
+    uint64_t *words;
+    size_t n_words;
+};
+
+/* The token and bigram profile of a string, see metric_profile_fill() */
+struct metric_profile {
+    /* Distinct token hashes, ascending */
+    uint32_t *tokens;
+    size_t n_tokens;
+    /* Distinct bigrams with their counts, ascending */
+    struct qgram_posting *grams;
+    size_t n_grams;
+    /* The sum, largest and Euclidean norm of the bigram counts */
+    size_t total;
+    uint32_t peak;
+    double norm;
+};
+
+/* A profile in grow-only storage, for strings of up to len characters */
+struct metric_scratch {
+    struct metric_profile profile;
+    size_t len;
+};
+
+/* Parallel scoring of the groups, see score_grps() */
+struct score_schedule {
+    /* The number of threads, or 0 for the OpenMP default */
+    int threads;
+    /* The number of groups scored by a thread at a time */
+    int chunk;
+    /* The number of groups below which scoring is serial */
+    unsigned int serial;
+    /* Adjust serial by the relative cost of serial and parallel scoring */
+    bool autotune;
+    double cost[2];
+    unsigned long calls;
+};
+
+/* Group metadata read by the scans, in arrays indexed by group position. A
+ * scan streams through the arrays, and only visits a group's struct and key
+ * once the cheap filters pass. See grp_col(). */
+struct grp_cols {
+    darray(size_t) key_len;
+    darray(ssize_t) n_items;
+    /* The character counts of the key, see should_grp_score_hist() */
+    darray(struct char_count *) hist;
+    darray(double) score;
+    /* The search that set score */
+    darray(unsigned long) epoch;
+    /* Dynamic threshold bits */
+    darray(double) threshold;
+    darray(bool) dirty;
+};
 
 struct strgrp {
     double threshold;
-    stringmap_grp known;
+    struct known_table known;
+    struct variant_table variants;
     unsigned int n_grps;
     darray_grp grps;
     int size;
-    void (*score)(struct strgrp *const ctx, const char *const str);
+    struct qgram_index *qgrams;
+    struct minhash_index *minhash;
+    struct partition *partition;
+    struct score_cache *cache;
+    int samples;
+    struct score_schedule schedule;
+    struct strgrp_stats stats;
+    /* Counts searches, so scores from earlier searches can be recognised */
+    unsigned long epoch;
+    /* See strgrp_metric() */
+    enum strgrp_metric metric;
+    enum strgrp_metric screen;
+    double margin;
+    /* Items and variants, which are only released with the instance */
+    struct block_pool *pool;
+    /* Variant keys back to back, likewise only released with the instance */
+    struct block_pool *keys;
+    /* Storage given up by removed items, see recycle() */
+    void *free_items;
+    void *free_variants;
+    void *free_keys[KEY_BINS];
+    /* Dissolved groups that are not held, see grps_reclaim() */
+    unsigned int n_dissolved;
+    /* Live iterators, which follow the groups as they are reclaimed */
+    struct list_head iters;
+    struct grp_cols cols;
+    /* The match masks and profile of the query pattern, shared by the
+     * scoring threads */
+    struct scratch pattern;
+    struct metric_scratch query;
+    /* Indexed by OpenMP thread number, see score_reserve() */
+    struct lcs_scratch *scratch;
+    /* See strgrp_kernel() */
+    enum strgrp_kernel kernel;
+    void (*score)(struct strgrp *const ctx, const struct lcs_pattern *const p);
 };
 
 struct strgrp_iter {
     const struct strgrp *ctx;
     int i;
+    struct list_node list;
+};
+
+struct char_count {
+    uint32_t count;
+    unsigned char value;
 };
 
 struct strgrp_grp {
+    /* The instance holding the group's row of ctx->cols */
+    struct strgrp *ctx;
+    /* The key of one of the group's variants. A dissolved group keeps the
+     * storage of its key, which it owns unless borrowed from a snapshot. */
     const char *key;
-    size_t key_len;
+    bool owns_key;
+    size_t hash;
+    /* Position in ctx->grps and ctx->cols */
+    unsigned int index;
+    /* See strgrp_grp_hold() */
+    unsigned int holds;
+    /* Present while a cheap metric is in use */
+    struct metric_profile *profile;
     darray_item items;
-    ssize_t n_items;
-    double score;
+    /* The distinct strings of the items, in the order they were first added */
+    darray_variant variants;
+    /* The partition bucket of the key, see partition_key() */
+    size_t part;
 
-    /* Dynamic threshold bits */
-    double threshold;
-    bool dirty;
+    /* Minimum similarity between the first n_low variants */
+    double low;
+    ssize_t n_low;
 };
 
+/* The metadata of the group at position i, or of grp */
+#define col_at(ctx, col, i) ((ctx)->cols.col.item[i])
+#define grp_col(grp, col) col_at((grp)->ctx, col, (grp)->index)
+
 struct strgrp_grp_iter {
     const struct strgrp_grp *grp;
     int i;
 };
 
 struct strgrp_item {
-    const char *key;
+    struct strgrp_variant *variant;
     void *value;
 };
 
+static uint64_t *
+scratch_words(struct scratch *const s, const size_t n_words) {
+    if (n_words > s->n_words) {
+        uint64_t *const words = realloc(s->words, n_words * sizeof(uint64_t));
+        if (!words) {
+            return NULL;
+        }
+        s->words = words;
+        s->n_words = n_words;
+    }
+    return s->words;
+}
+
+/* Seconds from an arbitrary point, for timing the phases of grouping */
+static double
+now(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec * 1e-9;
+}
+
 /* Low-cost filter functions */
 
 static inline bool
-should_grp_score_len(const double threshold,
-        const struct strgrp_grp *const grp, const char *const str) {
-    const double lstr = (double) strlen(str);
-    const double lkey = (double) grp->key_len;
+should_grp_score_len(const double threshold, const size_t key_len,
+        const size_t len) {
+    const double lstr = (double) len;
+    const double lkey = (double) key_len;
     const double lmin = (lstr > lkey) ? lkey : lstr;
     const double s = sqrt((2 * lmin * lmin) / (1.0 * lstr * lstr + lkey * lkey));
     return threshold <= s;
@@ -95,8 +332,11 @@ static inline int cmi(int i, int j) {
     return ROWS * j + i;
 }
 
+/* Reference implementation: the classic two-row dynamic programming solution.
+ * Scoring uses the bit-parallel kernel below, this remains to cross-check it
+ * (define STRGRP_CHECK_LCS). */
 static inline int16_t
-lcs(const char *const a, const char *const b) {
+lcs_dp(const char *const a, const char *const b) {
     const int lb = strlen(b);
     const int lbp1 = lb + 1;
     int16_t *const lookup = calloc(ROWS * lbp1, sizeof(int16_t));
@@ -121,314 +361,4044 @@ lcs(const char *const a, const char *const b) {
             }
         }
     }
-    int16_t result = lookup[0];
-    free(lookup);
-    return result;
+    int16_t result = lookup[0];
+    free(lookup);
+    return result;
+}
+
+#undef ROWS
+
+/* Bit-parallel LCS[3][4]
+ *
+ * The pattern string is encoded as a set of match masks, one per character
+ * value, with bit i set in the mask for c if pattern[i] == c. The DP column
+ * is then represented by a bit-vector V, where a zero bit marks a row at which
+ * the LCS length increases. Each character of the text string advances the
+ * column with
+ *
+ *     U = V & M[c]
+ *     V = (V + U) | (V - U)
+ *
+ * and the LCS length is the number of zero bits in V. Patterns longer than a
+ * machine word are split across several words, propagating the carry of the
+ * addition; the subtraction never borrows as U is a subset of V.
+ *
+ * The pattern is constructed once per query string and reused against every
+ * group key, so the per-comparison cost is |text| word operations for the
+ * usual case of descriptions no longer than 64 characters.
+ *
+ * [3] Allison, L. and Dix, T. I., "A bit-string longest-common-subsequence
+ *     algorithm", Information Processing Letters 23 (1986)
+ * [4] Hyyrö, H., "Bit-Parallel LCS-length Computation Revisited", AWOCA 2004
+ */
+#define LCS_WORD_BITS 64
+
+struct lcs_pattern {
+    const char *str;
+    size_t len;
+    /* Set for queries, see lcs_pattern_key() */
+    size_t hash;
+    size_t n_words;
+    uint64_t *masks;
+    uint64_t word[CHAR_N_VALUES];
+    uint32_t hist[CHAR_N_VALUES];
+    /* Present while a cheap metric is in use */
+    const struct metric_profile *profile;
+};
+
+/* Comparisons waiting for a SIMD kernel, see lcs_batch_add() */
+#define LCS_LANES_MAX 8
+#define LCS_BATCH_CLASSES 4
+
+struct lcs_batch {
+    int n;
+    struct strgrp_grp *grps[LCS_LANES_MAX];
+    size_t lens[LCS_LANES_MAX];
+    int lmins[LCS_LANES_MAX];
+    double thresholds[LCS_LANES_MAX];
+};
+
+/* The working space of a scoring thread: the match masks of patterns built
+ * while updating thresholds, the DP column of multi-word patterns, the
+ * profiles of the items compared under a cheap metric, the comparisons
+ * waiting for a SIMD kernel by class of key length, and the thread's use of
+ * the score cache waiting to be merged into it */
+struct lcs_scratch {
+    struct scratch masks;
+    struct scratch column;
+    struct metric_scratch items[2];
+    struct lcs_batch batches[LCS_BATCH_CLASSES];
+    darray(struct score_pending) pending;
+};
+
+static inline size_t
+lcs_n_words(const size_t len) {
+    return len ? (len + LCS_WORD_BITS - 1) / LCS_WORD_BITS : 1;
+}
+
+static inline int
+popcount64(const uint64_t v) {
+#if HAVE_BUILTIN_POPCOUNTL && ULONG_MAX == UINT64_MAX
+    return __builtin_popcountl(v);
+#else
+    uint64_t w = v;
+    int n;
+    for (n = 0; w; n++) {
+        w &= w - 1;
+    }
+    return n;
+#endif
+}
+
+/* Identify the query, hashing it once for the exact-match index, the score
+ * cache and insertion */
+static inline void
+lcs_pattern_key(struct lcs_pattern *const p, const char *const str) {
+    p->str = str;
+    p->len = strlen(str);
+    p->hash = known_hash(str, p->len);
+}
+
+/* Patterns longer than a word keep their masks in the scratch space, which
+ * must outlive the pattern */
+static bool
+lcs_pattern_init(struct lcs_pattern *const p, const char *const str,
+        const size_t len, struct scratch *const masks) {
+    size_t i;
+    p->str = str;
+    p->len = len;
+    p->n_words = lcs_n_words(p->len);
+    if (p->n_words == 1) {
+        p->masks = p->word;
+    } else {
+        p->masks = scratch_words(masks, CHAR_N_VALUES * p->n_words);
+        if (!p->masks) {
+            return false;
+        }
+    }
+    memset(p->masks, 0, CHAR_N_VALUES * p->n_words * sizeof(uint64_t));
+    memset(p->hist, 0, sizeof(p->hist));
+    p->profile = NULL;
+    for (i = 0; i < p->len; i++) {
+        const unsigned char c = str[i];
+        p->masks[c * p->n_words + i / LCS_WORD_BITS] |=
+            1ULL << (i % LCS_WORD_BITS);
+        p->hist[c]++;
+    }
+    return true;
+}
+
+/* Threshold-aware evaluation
+ *
+ * Callers only need the exact LCS length when it reaches lmin, the smallest
+ * length for which the normalised score passes the threshold. Two properties
+ * bound the work:
+ *
+ * 1. Each text character extends the LCS by at most one, so once more than
+ *    |b| - lmin text characters have gone unmatched the bound is unreachable
+ *    and the comparison is abandoned.
+ * 2. A common subsequence of length at least lmin can only use matches
+ *    (i, j) with -(|b| - lmin) <= i - j <= |a| - lmin. For multi-word
+ *    patterns only the words intersecting this diagonal band are updated for
+ *    each text character, plus any words above it while a carry propagates.
+ *    Matches outside the band are ignored, which cannot lower a result that
+ *    reaches lmin.
+ *
+ * The kernels therefore return the exact LCS length if it is at least lmin,
+ * and otherwise some value below lmin that is an upper bound on the length
+ * when abandoned early. Passing an lmin of zero gives the exact length.
+ */
+static inline int
+lcs_bp_word(const struct lcs_pattern *const p, const char *const b,
+        const size_t lb, const int lmin) {
+    const uint64_t *const masks = p->masks;
+    const ssize_t slack = lb - lmin;
+    uint64_t v = ~0ULL;
+    size_t i;
+    if (slack < 0 || (ssize_t)p->len < lmin) {
+        return lb < p->len ? lb : p->len;
+    }
+    for (i = 0; i < lb; i++) {
+        const uint64_t u = v & masks[(unsigned char)b[i]];
+        v = (v + u) | (v - u);
+        /* Bits above the pattern length remain set, so the zero count is the
+         * LCS length of the text prefix */
+        const int prefix = LCS_WORD_BITS - popcount64(v);
+        if ((ssize_t)(i + 1 - prefix) > slack) {
+            return prefix + (lb - i - 1);
+        }
+    }
+    if (p->len < LCS_WORD_BITS) {
+        v |= ~0ULL << p->len;
+    }
+    return LCS_WORD_BITS - popcount64(v);
+}
+
+static int
+lcs_bp_multi(const struct lcs_pattern *const p, const char *const b,
+        const size_t lb, const int lmin, struct scratch *const column) {
+    const size_t n_words = p->n_words;
+    const ssize_t slack_a = p->len - lmin;
+    const ssize_t slack_b = lb - lmin;
+    uint64_t *v;
+    size_t i, w;
+    int prefix;
+    if (slack_a < 0 || slack_b < 0) {
+        return lb < p->len ? lb : p->len;
+    }
+    v = scratch_words(column, n_words);
+    if (!v) {
+        return -1;
+    }
+    memset(v, 0xff, n_words * sizeof(uint64_t));
+    prefix = 0;
+    for (i = 0; i < lb; i++) {
+        const uint64_t *const m = &p->masks[(unsigned char)b[i] * n_words];
+        const ssize_t row_lo = (ssize_t)i - slack_b;
+        const size_t row_hi = i + slack_a;
+        const size_t w_lo = row_lo > 0 ? row_lo / LCS_WORD_BITS : 0;
+        const size_t w_hi = row_hi < p->len ? row_hi / LCS_WORD_BITS : n_words - 1;
+        uint64_t carry = 0;
+        for (w = w_lo; w < n_words && (w <= w_hi || carry); w++) {
+            const uint64_t u = w <= w_hi ? v[w] & m[w] : 0;
+            const uint64_t x = v[w] + carry;
+            const uint64_t sum = x + u;
+            prefix -= LCS_WORD_BITS - popcount64(v[w]);
+            carry = (x < carry) | (sum < u);
+            v[w] = sum | (v[w] - u);
+            prefix += LCS_WORD_BITS - popcount64(v[w]);
+        }
+        if ((ssize_t)(i + 1 - prefix) > slack_b) {
+            return prefix + (lb - i - 1);
+        }
+    }
+    return prefix;
+}
+
+static inline int
+lcs_bp(const struct lcs_pattern *const p, const char *const b,
+        const size_t lb, const int lmin, struct lcs_scratch *const scratch) {
+    int result = (p->n_words == 1) ? lcs_bp_word(p, b, lb, lmin) :
+        lcs_bp_multi(p, b, lb, lmin, &scratch->column);
+#ifdef STRGRP_CHECK_LCS
+    {
+        const int expected = lcs_dp(p->str, b);
+        assert(result >= lmin ? result == expected : expected < lmin);
+    }
+#endif
+    return result;
+}
+
+/* Inter-sequence SIMD kernels
+ *
+ * A string is scored against many group keys, and the bit-parallel kernel
+ * only needs the string's match masks and the column V to compare it with a
+ * key. For strings of up to a word V is a single word, so the comparisons
+ * with several keys advance together, one to each 64-bit lane of a vector
+ * register. Each lane looks up the masks of its own key's next character. A
+ * lane reaching the end of its key keeps reading the key's terminating NUL,
+ * whose mask is empty as the string has no NUL, so its column is unchanged.
+ *
+ * The number of text characters left unmatched never decreases, so
+ * lcs_bp_word() abandons a comparison exactly when the LCS length is below
+ * lmin, and then provides lmin - 1. The kernels compute the exact lengths and
+ * provide the same, only testing every LCS_LANES_CHECK characters whether
+ * every lane has been abandoned so the batch can end early. Keys are batched
+ * by length so that their lanes end at much the same time, see
+ * lcs_batch_add().
+ *
+ * The kernels are built with the target attribute and selected with
+ * strgrp_kernel(), as instances use the scalar kernel.
+ */
+#define LCS_LANES_CHECK 8
+
+typedef void (*lcs_kernel_fn)(const struct lcs_pattern *p,
+        const struct lcs_batch *batch, int *lcs);
+
+#if STRGRP_X86_KERNELS
+/* The keys of the lanes, the shortest and the longest. Unused lanes repeat
+ * the first key. */
+struct lcs_lanes {
+    const unsigned char *keys[LCS_LANES_MAX];
+    size_t lens[LCS_LANES_MAX];
+    size_t min;
+    size_t max;
+};
+
+static inline void
+lcs_lanes_init(const struct lcs_batch *const batch, const int lanes,
+        struct lcs_lanes *const ln) {
+    int l;
+    for (l = 0; l < lanes; l++) {
+        const int k = l < batch->n ? l : 0;
+        ln->keys[l] = (const unsigned char *)batch->grps[k]->key;
+        ln->lens[l] = batch->lens[k];
+        if (!l || ln->lens[l] < ln->min) {
+            ln->min = ln->lens[l];
+        }
+        if (!l || ln->lens[l] > ln->max) {
+            ln->max = ln->lens[l];
+        }
+    }
+}
+
+/* The mask of lane l's character i, which is empty past the end of its key
+ * and so leaves the lane's column unchanged */
+static inline uint64_t
+lcs_lane_mask(const struct lcs_lanes *const ln, const uint64_t *const masks,
+        const int l, const size_t i) {
+    return i < ln->lens[l] ? masks[ln->keys[l][i]] : 0;
+}
+
+/* Test whether the comparison of every lane has been abandoned once i
+ * characters have been read, given the columns of the lanes */
+static inline bool
+lcs_lanes_abandoned(const struct lcs_batch *const batch,
+        const uint64_t *const v, const size_t i) {
+    int l;
+    for (l = 0; l < batch->n; l++) {
+        const size_t lb = batch->lens[l];
+        const size_t read = i < lb ? i : lb;
+        const int prefix = LCS_WORD_BITS - popcount64(v[l]);
+        if ((ssize_t)(read - prefix) <= (ssize_t)lb - batch->lmins[l]) {
+            return false;
+        }
+    }
+    return true;
+}
+
+/* Provide the lengths lcs_bp_word() would from the final columns */
+static inline void
+lcs_lanes_finish(const struct lcs_batch *const batch, const uint64_t *const v,
+        int *const lcs) {
+    int l;
+    for (l = 0; l < batch->n; l++) {
+        const int len = LCS_WORD_BITS - popcount64(v[l]);
+        lcs[l] = len >= batch->lmins[l] ? len : batch->lmins[l] - 1;
+    }
+}
+
+__attribute__((target("sse4.1")))
+static void
+lcs_bp_sse41(const struct lcs_pattern *const p,
+        const struct lcs_batch *const batch, int *const lcs) {
+    const uint64_t *const masks = p->masks;
+    uint64_t cols[2];
+    struct lcs_lanes ln;
+    __m128i v = _mm_set1_epi64x(-1);
+    size_t i, end;
+    lcs_lanes_init(batch, 2, &ln);
+    const unsigned char *const k0 = ln.keys[0], *const k1 = ln.keys[1];
+    for (i = 0; i < ln.max; ) {
+        end = i + LCS_LANES_CHECK;
+        if (end <= ln.min) {
+            for (; i < end; i++) {
+                const __m128i u = _mm_and_si128(v,
+                        _mm_set_epi64x(masks[k1[i]], masks[k0[i]]));
+                v = _mm_or_si128(_mm_add_epi64(v, u), _mm_sub_epi64(v, u));
+            }
+        } else {
+            for (; i < end; i++) {
+                const __m128i u = _mm_and_si128(v, _mm_set_epi64x(
+                            lcs_lane_mask(&ln, masks, 1, i),
+                            lcs_lane_mask(&ln, masks, 0, i)));
+                v = _mm_or_si128(_mm_add_epi64(v, u), _mm_sub_epi64(v, u));
+            }
+        }
+        _mm_storeu_si128((__m128i *)cols, v);
+        if (lcs_lanes_abandoned(batch, cols, i)) {
+            break;
+        }
+    }
+    _mm_storeu_si128((__m128i *)cols, v);
+    lcs_lanes_finish(batch, cols, lcs);
+}
+
+__attribute__((target("avx2")))
+static void
+lcs_bp_avx2(const struct lcs_pattern *const p,
+        const struct lcs_batch *const batch, int *const lcs) {
+    const uint64_t *const masks = p->masks;
+    uint64_t cols[4];
+    struct lcs_lanes ln;
+    __m256i v = _mm256_set1_epi64x(-1);
+    size_t i, end;
+    lcs_lanes_init(batch, 4, &ln);
+    const unsigned char *const k0 = ln.keys[0], *const k1 = ln.keys[1];
+    const unsigned char *const k2 = ln.keys[2], *const k3 = ln.keys[3];
+    for (i = 0; i < ln.max; ) {
+        end = i + LCS_LANES_CHECK;
+        if (end <= ln.min) {
+            for (; i < end; i++) {
+                const __m256i u = _mm256_and_si256(v, _mm256_set_epi64x(
+                            masks[k3[i]], masks[k2[i]], masks[k1[i]],
+                            masks[k0[i]]));
+                v = _mm256_or_si256(_mm256_add_epi64(v, u),
+                        _mm256_sub_epi64(v, u));
+            }
+        } else {
+            for (; i < end; i++) {
+                const __m256i u = _mm256_and_si256(v, _mm256_set_epi64x(
+                            lcs_lane_mask(&ln, masks, 3, i),
+                            lcs_lane_mask(&ln, masks, 2, i),
+                            lcs_lane_mask(&ln, masks, 1, i),
+                            lcs_lane_mask(&ln, masks, 0, i)));
+                v = _mm256_or_si256(_mm256_add_epi64(v, u),
+                        _mm256_sub_epi64(v, u));
+            }
+        }
+        _mm256_storeu_si256((__m256i *)cols, v);
+        if (lcs_lanes_abandoned(batch, cols, i)) {
+            break;
+        }
+    }
+    _mm256_storeu_si256((__m256i *)cols, v);
+    lcs_lanes_finish(batch, cols, lcs);
+}
+
+__attribute__((target("avx512f")))
+static void
+lcs_bp_avx512(const struct lcs_pattern *const p,
+        const struct lcs_batch *const batch, int *const lcs) {
+    const uint64_t *const masks = p->masks;
+    uint64_t cols[8];
+    struct lcs_lanes ln;
+    __m512i v = _mm512_set1_epi64(-1);
+    size_t i, end;
+    lcs_lanes_init(batch, 8, &ln);
+    const unsigned char *const k0 = ln.keys[0], *const k1 = ln.keys[1];
+    const unsigned char *const k2 = ln.keys[2], *const k3 = ln.keys[3];
+    const unsigned char *const k4 = ln.keys[4], *const k5 = ln.keys[5];
+    const unsigned char *const k6 = ln.keys[6], *const k7 = ln.keys[7];
+    for (i = 0; i < ln.max; ) {
+        end = i + LCS_LANES_CHECK;
+        if (end <= ln.min) {
+            for (; i < end; i++) {
+                const __m512i u = _mm512_and_si512(v, _mm512_set_epi64(
+                            masks[k7[i]], masks[k6[i]], masks[k5[i]],
+                            masks[k4[i]], masks[k3[i]], masks[k2[i]],
+                            masks[k1[i]], masks[k0[i]]));
+                v = _mm512_or_si512(_mm512_add_epi64(v, u),
+                        _mm512_sub_epi64(v, u));
+            }
+        } else {
+            for (; i < end; i++) {
+                const __m512i u = _mm512_and_si512(v, _mm512_set_epi64(
+                            lcs_lane_mask(&ln, masks, 7, i),
+                            lcs_lane_mask(&ln, masks, 6, i),
+                            lcs_lane_mask(&ln, masks, 5, i),
+                            lcs_lane_mask(&ln, masks, 4, i),
+                            lcs_lane_mask(&ln, masks, 3, i),
+                            lcs_lane_mask(&ln, masks, 2, i),
+                            lcs_lane_mask(&ln, masks, 1, i),
+                            lcs_lane_mask(&ln, masks, 0, i)));
+                v = _mm512_or_si512(_mm512_add_epi64(v, u),
+                        _mm512_sub_epi64(v, u));
+            }
+        }
+        _mm512_storeu_si512(cols, v);
+        if (lcs_lanes_abandoned(batch, cols, i)) {
+            break;
+        }
+    }
+    _mm512_storeu_si512(cols, v);
+    lcs_lanes_finish(batch, cols, lcs);
+}
+#endif
+
+static const struct {
+    lcs_kernel_fn fn;
+    int lanes;
+} lcs_kernels[] = {
+    [STRGRP_KERNEL_SCALAR] = { NULL, 1 },
+#if STRGRP_X86_KERNELS
+    [STRGRP_KERNEL_SSE41] = { lcs_bp_sse41, 2 },
+    [STRGRP_KERNEL_AVX2] = { lcs_bp_avx2, 4 },
+    [STRGRP_KERNEL_AVX512] = { lcs_bp_avx512, 8 },
+#endif
+};
+
+static bool
+lcs_kernel_supported(const enum strgrp_kernel kernel) {
+    switch (kernel) {
+    case STRGRP_KERNEL_SCALAR:
+        return true;
+#if STRGRP_X86_KERNELS
+    case STRGRP_KERNEL_SSE41:
+        return __builtin_cpu_supports("sse4.1");
+    case STRGRP_KERNEL_AVX2:
+        return __builtin_cpu_supports("avx2");
+    case STRGRP_KERNEL_AVX512:
+        return __builtin_cpu_supports("avx512f");
+#endif
+    default:
+        return false;
+    }
+}
+
+#undef LCS_LANES_CHECK
+#undef LCS_WORD_BITS
+
+static inline double
+nlcs_len(const double lcss, const double la, const double lb) {
+    return sqrt((2 * lcss * lcss) / (la * la + lb * lb));
+}
+
+/* The smallest LCS length whose normalised score reaches threshold, or one
+ * more than the shorter length if no LCS can */
+static inline int
+nlcs_lmin(const double threshold, const size_t la, const size_t lb) {
+    const int lmax = la < lb ? la : lb;
+    int l = threshold * sqrt((la * la + lb * lb) / 2.0) - 1;
+    if (l < 0) {
+        l = 0;
+    }
+    while (l <= lmax && nlcs_len(l, la, lb) < threshold) {
+        l++;
+    }
+    return l;
+}
+
+static inline double
+nlcs(const struct lcs_pattern *const a, const char *const b, const size_t lb,
+        struct lcs_scratch *const scratch) {
+    return nlcs_len(lcs_bp(a, b, lb, 0, scratch), a->len, lb);
+}
+
+/* Score a group key, abandoning the comparison once the LCS length cannot
+ * reach lmin. Scores below the threshold are upper bounds on the true score. */
+static inline double
+grp_score(const struct strgrp_grp *const grp,
+        const struct lcs_pattern *const pattern, const int lmin,
+        struct lcs_scratch *const scratch) {
+    const int lcss = lcs_bp(pattern, grp->key, grp_col(grp, key_len), lmin,
+            scratch);
+    return nlcs_len(lcss, pattern->len, grp_col(grp, key_len));
+}
+
+/* Candidate filtering - character histogram bound
+ *
+ * Every character of a common subsequence occurs in both strings, so the size
+ * of the multiset intersection of their characters bounds the LCS length from
+ * above. Each group key stores the counts of its distinct characters, which
+ * are intersected with the histogram of the query held in its pattern.
+ */
+static struct char_count *
+new_char_counts(const tal_t *const tctx, const char *const str,
+        const size_t len) {
+    uint32_t hist[CHAR_N_VALUES] = { 0 };
+    struct char_count *counts;
+    size_t i, n;
+    for (i = 0, n = 0; i < len; i++) {
+        n += !hist[(unsigned char)str[i]]++;
+    }
+    counts = tal_arr(tctx, struct char_count, n + 1);
+    if (!counts) {
+        return NULL;
+    }
+    for (i = 0, n = 0; i < CHAR_N_VALUES; i++) {
+        if (hist[i]) {
+            counts[n].value = i;
+            counts[n].count = hist[i];
+            n++;
+        }
+    }
+    counts[n].count = 0;
+    return counts;
+}
+
+static inline bool
+should_grp_score_hist(const struct lcs_pattern *const p,
+        const struct char_count *const hist, const int lmin) {
+    const struct char_count *c;
+    uint32_t bound = 0;
+    for (c = hist; c->count; c++) {
+        const uint32_t n = p->hist[c->value];
+        bound += n < c->count ? n : c->count;
+        if (bound >= (uint32_t)lmin) {
+            return true;
+        }
+    }
+    return bound >= (uint32_t)lmin;
+}
+
+/* Candidate filtering - q-gram count filter[5]
+ *
+ * A common subsequence z of a and b with length L keeps at least
+ *
+ *     (L - q + 1) - (q - 1)(|a| - L + |b| - L)
+ *
+ * of its q-grams contiguous in both strings, as each gap between consecutive
+ * characters of z in either string breaks at most q - 1 of them. The bound
+ * grows with L, so a group key sharing fewer q-grams with the query than the
+ * bound at lmin cannot reach the threshold and need not be scored.
+ *
+ * Group keys are indexed by hashing their q-grams into a fixed set of buckets,
+ * each holding a posting list of (group, count) pairs. Bucket collisions can
+ * only inflate the shared count, so the filter never rejects a group that
+ * could pass.
+ *
+ * [5] Ukkonen, E., "Approximate string-matching with q-grams and maximal
+ *     matches", Theoretical Computer Science 92 (1992)
+ */
+#define QGRAM_BUCKET_BITS 16
+#define QGRAM_N_BUCKETS (1 << QGRAM_BUCKET_BITS)
+#define QGRAM_MAX 8
+
+struct qgram_posting {
+    uint32_t id;
+    uint32_t count;
+};
+
+/* The new position of a reclaimed group, see grps_reclaim() */
+#define GRP_RECLAIMED UINT32_MAX
+
+typedef darray(struct qgram_posting) darray_posting;
+typedef darray(uint32_t) darray_u32;
+
+struct qgram_index {
+    int q;
+    darray_posting *buckets;
+    darray_u32 shared;
+    bool valid;
+};
+
+static inline uint32_t
+qgram_bucket(const char *const gram, const int q) {
+    uint32_t h;
+    int i;
+    if (q * CHAR_BIT <= QGRAM_BUCKET_BITS) {
+        for (h = 0, i = 0; i < q; i++) {
+            h = (h << CHAR_BIT) | (unsigned char)gram[i];
+        }
+        return h;
+    }
+    /* FNV-1a, folded to the bucket width */
+    for (h = 2166136261u, i = 0; i < q; i++) {
+        h = (h ^ (unsigned char)gram[i]) * 16777619u;
+    }
+    return (h ^ (h >> QGRAM_BUCKET_BITS)) & (QGRAM_N_BUCKETS - 1);
+}
+
+static int
+cmp_u32(const void *a, const void *b) {
+    const uint32_t ua = *(const uint32_t *)a;
+    const uint32_t ub = *(const uint32_t *)b;
+    return (ua > ub) - (ua < ub);
+}
+
+/* Collect the distinct buckets of the q-grams of str with their counts. The
+ * returned array is terminated by a zero count and must be freed. */
+static struct qgram_posting *
+qgram_profile(const int q, const char *const str, const size_t len) {
+    const size_t n = len >= (size_t)q ? len - q + 1 : 0;
+    uint32_t *const grams = malloc((n + 1) * sizeof(uint32_t));
+    struct qgram_posting *const profile =
+        malloc((n + 1) * sizeof(struct qgram_posting));
+    size_t i, j;
+    if (!grams || !profile) {
+        free(grams);
+        free(profile);
+        return NULL;
+    }
+    for (i = 0; i < n; i++) {
+        grams[i] = qgram_bucket(&str[i], q);
+    }
+    qsort(grams, n, sizeof(uint32_t), cmp_u32);
+    for (i = 0, j = 0; i < n; i++) {
+        if (j && profile[j - 1].id == grams[i]) {
+            profile[j - 1].count++;
+        } else {
+            profile[j].id = grams[i];
+            profile[j].count = 1;
+            j++;
+        }
+    }
+    profile[j].count = 0;
+    free(grams);
+    return profile;
+}
+
+static void
+free_qgram_index(struct qgram_index *idx) {
+    size_t i;
+    for (i = 0; i < QGRAM_N_BUCKETS; i++) {
+        darray_free(idx->buckets[i]);
+    }
+    darray_free(idx->shared);
+}
+
+static struct qgram_index *
+new_qgram_index(const tal_t *const tctx, const int q) {
+    struct qgram_index *idx = talz(tctx, struct qgram_index);
+    if (!idx) {
+        return NULL;
+    }
+    idx->q = q;
+    idx->buckets = tal_arrz(idx, darray_posting, QGRAM_N_BUCKETS);
+    if (!idx->buckets) {
+        return tal_free(idx);
+    }
+    darray_init(idx->shared);
+    tal_add_destructor(idx, free_qgram_index);
+    return idx;
+}
+
+static bool
+qgram_index_post(struct qgram_index *const idx, const uint32_t id,
+        const char *const key, const size_t len) {
+    struct qgram_posting *const profile = qgram_profile(idx->q, key, len);
+    struct qgram_posting *gram;
+    if (!profile) {
+        return false;
+    }
+    for (gram = profile; gram->count; gram++) {
+        const struct qgram_posting posting = { id, gram->count };
+        darray_push(idx->buckets[gram->id], posting);
+    }
+    free(profile);
+    return true;
+}
+
+static bool
+qgram_index_add(struct qgram_index *const idx, const uint32_t id,
+        const char *const key, const size_t len) {
+    if (!qgram_index_post(idx, id, key, len)) {
+        return false;
+    }
+    darray_push(idx->shared, 0);
+    return true;
+}
+
+/* Withdraw the postings of key for group id. If this fails the stale postings
+ * only overstate the q-grams the group shares, which weakens the filter. */
+static void
+qgram_index_remove(struct qgram_index *const idx, const uint32_t id,
+        const char *const key, const size_t len) {
+    struct qgram_posting *const profile = qgram_profile(idx->q, key, len);
+    struct qgram_posting *gram;
+    if (!profile) {
+        return;
+    }
+    for (gram = profile; gram->count; gram++) {
+        darray_posting *const bucket = &idx->buckets[gram->id];
+        size_t i;
+        for (i = 0; i < darray_size(*bucket); i++) {
+            if (bucket->item[i].id == id) {
+                bucket->item[i] = darray_pop(*bucket);
+                break;
+            }
+        }
+    }
+    free(profile);
+}
+
+/* Renumber the postings once groups are reclaimed, see grps_reclaim(). Stale
+ * postings of the reclaimed groups are dropped. */
+static void
+qgram_index_remap(struct qgram_index *const idx, const uint32_t *const remap,
+        const size_t n) {
+    size_t i, j, k;
+    for (i = 0; i < QGRAM_N_BUCKETS; i++) {
+        darray_posting *const bucket = &idx->buckets[i];
+        for (j = 0, k = 0; j < darray_size(*bucket); j++) {
+            const uint32_t id = remap[bucket->item[j].id];
+            if (id != GRP_RECLAIMED) {
+                bucket->item[k].id = id;
+                bucket->item[k++].count = bucket->item[j].count;
+            }
+        }
+        darray_resize(*bucket, k);
+    }
+    darray_resize(idx->shared, n);
+}
+
+/* Count the q-grams each group key shares with str. If this fails the filter
+ * passes all groups. */
+static void
+qgram_index_count(struct qgram_index *const idx, const char *const str,
+        const size_t len) {
+    struct qgram_posting *profile;
+    struct qgram_posting *gram;
+    if (!idx) {
+        return;
+    }
+    idx->valid = false;
+    profile = qgram_profile(idx->q, str, len);
+    if (!profile) {
+        return;
+    }
+    memset(idx->shared.item, 0, darray_size(idx->shared) * sizeof(uint32_t));
+    for (gram = profile; gram->count; gram++) {
+        const struct qgram_posting *posting;
+        darray_foreach(posting, idx->buckets[gram->id]) {
+            idx->shared.item[posting->id] +=
+                gram->count < posting->count ? gram->count : posting->count;
+        }
+    }
+    idx->valid = true;
+    free(profile);
+}
+
+static inline bool
+should_grp_score_qgram(const struct qgram_index *const idx, const int i,
+        const int lmin, const size_t la, const size_t lb) {
+    long bound;
+    if (!idx || !idx->valid) {
+        return true;
+    }
+    bound = (long)lmin - idx->q + 1 -
+        (long)(idx->q - 1) * ((long)la + (long)lb - 2 * lmin);
+    return bound <= 0 || darray_item(idx->shared, i) >= (uint32_t)bound;
+}
+
+/* Candidate filtering - MinHash locality sensitive hashing[6]
+ *
+ * The q-gram filter above is exact, but must still visit every group sharing a
+ * q-gram with the query, which for short descriptions is most of them. For
+ * very large group counts we can instead trade recall for speed: the set of
+ * shingles of each group key is summarised by a MinHash signature of
+ * bands * rows values, the probability of two values agreeing being the
+ * Jaccard similarity J of the shingle sets. Each band of rows values is hashed
+ * into a bucket, and only groups colliding with the query in at least one band
+ * are scored. A group is found with probability
+ *
+ *     1 - (1 - J^rows)^bands
+ *
+ * so increasing bands improves recall, while increasing rows prunes more
+ * dissimilar groups. Unlike the exact filters this can change the groups that
+ * are found.
+ *
+ * [6] Broder, A. Z., "On the resemblance and containment of documents",
+ *     Compression and Complexity of Sequences (1997)
+ */
+#define MINHASH_SHINGLE 3
+#define MINHASH_BUCKET_BITS 16
+#define MINHASH_N_BUCKETS (1 << MINHASH_BUCKET_BITS)
+#define MINHASH_MAX 1024
+
+struct minhash_index {
+    int bands;
+    int rows;
+    darray_u32 *buckets;
+    darray_u32 marks;
+    uint32_t mark;
+    bool valid;
+    unsigned long pruned;
+};
+
+/* MurmurHash3 finaliser, used to derive the family of hash functions */
+static inline uint32_t
+minhash_mix(uint32_t h) {
+    h ^= h >> 16;
+    h *= 0x85ebca6bu;
+    h ^= h >> 13;
+    h *= 0xc2b2ae35u;
+    h ^= h >> 16;
+    return h;
+}
+
+/* Hash each band of the MinHash signature of str to a bucket. keys must have
+ * space for idx->bands values. */
+static bool
+minhash_keys(const struct minhash_index *const idx, const char *const str,
+        const size_t len, uint32_t *const keys) {
+    const int n = idx->bands * idx->rows;
+    uint32_t *const sig = malloc(n * sizeof(uint32_t));
+    size_t i;
+    int j, k;
+    if (!sig) {
+        return false;
+    }
+    for (j = 0; j < n; j++) {
+        sig[j] = UINT32_MAX;
+    }
+    /* Strings shorter than a shingle are treated as a single shingle */
+    for (i = 0; i == 0 || i + MINHASH_SHINGLE <= len; i++) {
+        uint32_t x = 2166136261u;
+        for (k = 0; k < MINHASH_SHINGLE && i + k < len; k++) {
+            x = (x ^ (unsigned char)str[i + k]) * 16777619u;
+        }
+        for (j = 0; j < n; j++) {
+            const uint32_t h = minhash_mix(x + (uint32_t)(j + 1) * 0x9e3779b9u);
+            sig[j] = h < sig[j] ? h : sig[j];
+        }
+    }
+    for (j = 0; j < idx->bands; j++) {
+        uint32_t h = 2166136261u ^ (uint32_t)j;
+        for (k = 0; k < idx->rows; k++) {
+            h = minhash_mix(h ^ sig[j * idx->rows + k]);
+        }
+        keys[j] = j * MINHASH_N_BUCKETS + (h & (MINHASH_N_BUCKETS - 1));
+    }
+    free(sig);
+    return true;
+}
+
+static void
+free_minhash_index(struct minhash_index *idx) {
+    size_t i;
+    for (i = 0; i < (size_t)idx->bands * MINHASH_N_BUCKETS; i++) {
+        darray_free(idx->buckets[i]);
+    }
+    darray_free(idx->marks);
+}
+
+static struct minhash_index *
+new_minhash_index(const tal_t *const tctx, const int bands, const int rows) {
+    struct minhash_index *idx = talz(tctx, struct minhash_index);
+    if (!idx) {
+        return NULL;
+    }
+    idx->bands = bands;
+    idx->rows = rows;
+    idx->buckets = tal_arrz(idx, darray_u32, bands * MINHASH_N_BUCKETS);
+    if (!idx->buckets) {
+        return tal_free(idx);
+    }
+    darray_init(idx->marks);
+    tal_add_destructor(idx, free_minhash_index);
+    return idx;
+}
+
+static bool
+minhash_index_post(struct minhash_index *const idx, const uint32_t id,
+        const char *const key, const size_t len) {
+    uint32_t *const keys = malloc(idx->bands * sizeof(uint32_t));
+    int j;
+    if (!keys || !minhash_keys(idx, key, len, keys)) {
+        free(keys);
+        return false;
+    }
+    for (j = 0; j < idx->bands; j++) {
+        darray_push(idx->buckets[keys[j]], id);
+    }
+    free(keys);
+    return true;
+}
+
+static bool
+minhash_index_add(struct minhash_index *const idx, const uint32_t id,
+        const char *const key, const size_t len) {
+    if (!minhash_index_post(idx, id, key, len)) {
+        return false;
+    }
+    darray_push(idx->marks, 0);
+    return true;
+}
+
+/* Withdraw key's bands for group id. If this fails the group remains a
+ * candidate for queries colliding with its stale bands. */
+static void
+minhash_index_remove(struct minhash_index *const idx, const uint32_t id,
+        const char *const key, const size_t len) {
+    uint32_t *const keys = malloc(idx->bands * sizeof(uint32_t));
+    int j;
+    if (!keys || !minhash_keys(idx, key, len, keys)) {
+        free(keys);
+        return;
+    }
+    for (j = 0; j < idx->bands; j++) {
+        darray_u32 *const bucket = &idx->buckets[keys[j]];
+        size_t i;
+        for (i = 0; i < darray_size(*bucket); i++) {
+            if (bucket->item[i] == id) {
+                bucket->item[i] = darray_pop(*bucket);
+                break;
+            }
+        }
+    }
+    free(keys);
+}
+
+/* See qgram_index_remap() */
+static void
+minhash_index_remap(struct minhash_index *const idx,
+        const uint32_t *const remap, const size_t n) {
+    size_t i, j, k;
+    for (i = 0; i < (size_t)idx->bands * MINHASH_N_BUCKETS; i++) {
+        darray_u32 *const bucket = &idx->buckets[i];
+        for (j = 0, k = 0; j < darray_size(*bucket); j++) {
+            const uint32_t id = remap[bucket->item[j]];
+            if (id != GRP_RECLAIMED) {
+                bucket->item[k++] = id;
+            }
+        }
+        darray_resize(*bucket, k);
+    }
+    darray_resize(idx->marks, n);
+}
+
+/* Mark the groups colliding with str in at least one band. If this fails all
+ * groups are scored. */
+static void
+minhash_index_mark(struct minhash_index *const idx, const char *const str,
+        const size_t len) {
+    uint32_t *keys;
+    int j;
+    if (!idx) {
+        return;
+    }
+    idx->valid = false;
+    keys = malloc(idx->bands * sizeof(uint32_t));
+    if (!keys || !minhash_keys(idx, str, len, keys)) {
+        free(keys);
+        return;
+    }
+    if (++idx->mark == 0) {
+        memset(idx->marks.item, 0, darray_size(idx->marks) * sizeof(uint32_t));
+        idx->mark = 1;
+    }
+    for (j = 0; j < idx->bands; j++) {
+        const uint32_t *id;
+        darray_foreach(id, idx->buckets[keys[j]]) {
+            idx->marks.item[*id] = idx->mark;
+        }
+    }
+    idx->valid = true;
+    free(keys);
+}
+
+static inline bool
+should_grp_score_minhash(const struct minhash_index *const idx, const int i) {
+    return !idx || !idx->valid || darray_item(idx->marks, i) == idx->mark;
+}
+
+/* Candidate selection - merchant partitions
+ *
+ * Bank descriptions mostly lead with the merchant's name, behind prefixes
+ * added by the bank such as "VISA DEBIT PURCHASE CARD" and the card number.
+ * Partitioning buckets the groups by a hash of the leading tokens of their
+ * key, after stripping a known prefix and skipping tokens without letters. A
+ * search first scores the groups in the query's bucket, and only scores all
+ * the groups if none of those are acceptable. Like the MinHash index this can
+ * change the groups that are found: a better group in another bucket is
+ * missed if the query's bucket has an acceptable one.
+ */
+struct partition_bucket {
+    size_t hash;
+    /* Positions of the groups in ctx->grps, ascending */
+    darray_u32 grps;
+};
+
+static inline const size_t *
+partition_bucket_key(const struct partition_bucket *const b) {
+    return &b->hash;
+}
+
+static inline size_t
+partition_key_hash(const size_t *const key) {
+    return *key;
+}
+
+static inline bool
+partition_bucket_eq(const struct partition_bucket *const b,
+        const size_t *const key) {
+    return b->hash == *key;
+}
+
+HTABLE_DEFINE_TYPE(struct partition_bucket, partition_bucket_key,
+        partition_key_hash, partition_bucket_eq, partition_table);
+
+struct partition {
+    struct partition_table table;
+    int tokens;
+    /* tal array of prefixes stripped from the start of strings */
+    char **prefixes;
+    /* The bucket of the current query, or NULL to score all groups */
+    const struct partition_bucket *bucket;
+};
+
+static inline bool
+partition_is_space(const char c) {
+    return isspace((unsigned char)c);
+}
+
+/* Hash the leading tokens of str that identify the merchant. Buckets are
+ * only compared by hash, as a collision merely adds candidates. */
+static size_t
+partition_key(const struct partition *const part, const char *str) {
+    size_t h = 0;
+    size_t i;
+    int n;
+
+    while (partition_is_space(*str)) {
+        str++;
+    }
+    for (i = 0; i < tal_count(part->prefixes); i++) {
+        const size_t len = strlen(part->prefixes[i]);
+        if (!strncmp(str, part->prefixes[i], len) &&
+                (!str[len] || partition_is_space(str[len]))) {
+            str += len;
+            break;
+        }
+    }
+    for (n = 0; n < part->tokens && *str; ) {
+        const char *end;
+        bool alpha = false;
+        while (partition_is_space(*str)) {
+            str++;
+        }
+        for (end = str; *end && !partition_is_space(*end); end++) {
+            alpha = alpha || isalpha((unsigned char)*end);
+        }
+        if (alpha) {
+            h = hash(str, end - str, h + n);
+            n++;
+        }
+        str = end;
+    }
+    return h;
+}
+
+static void
+free_partition(struct partition *part) {
+    struct partition_table_iter it;
+    struct partition_bucket *b;
+    for (b = partition_table_first(&part->table, &it); b;
+            b = partition_table_next(&part->table, &it)) {
+        darray_free(b->grps);
+        free(b);
+    }
+    partition_table_clear(&part->table);
+}
+
+static struct partition *
+new_partition(const tal_t *const tctx, const char *const *const prefixes,
+        const size_t n_prefixes, const int tokens) {
+    struct partition *part = talz(tctx, struct partition);
+    size_t i;
+    if (!part) {
+        return NULL;
+    }
+    part->tokens = tokens;
+    partition_table_init(&part->table);
+    tal_add_destructor(part, free_partition);
+    part->prefixes = tal_arr(part, char *, n_prefixes);
+    if (!part->prefixes) {
+        return tal_free(part);
+    }
+    for (i = 0; i < n_prefixes; i++) {
+        part->prefixes[i] = tal_strdup(part->prefixes, prefixes[i]);
+        if (!part->prefixes[i]) {
+            return tal_free(part);
+        }
+    }
+    return part;
+}
+
+static bool
+partition_add(struct partition *const part, const uint32_t id,
+        const size_t key) {
+    struct partition_bucket *b = partition_table_get(&part->table, &key);
+    size_t i;
+    if (!b) {
+        b = malloc(sizeof(*b));
+        if (!b) {
+            return false;
+        }
+        b->hash = key;
+        darray_init(b->grps);
+        if (!partition_table_add(&part->table, b)) {
+            free(b);
+            return false;
+        }
+    }
+    /* Groups are mostly appended, but re-keyed groups may land earlier */
+    darray_push(b->grps, id);
+    for (i = darray_size(b->grps) - 1; i && b->grps.item[i - 1] > id; i--) {
+        b->grps.item[i] = b->grps.item[i - 1];
+    }
+    b->grps.item[i] = id;
+    return true;
+}
+
+static void
+partition_remove(struct partition *const part, const uint32_t id,
+        const size_t key) {
+    struct partition_bucket *const b = partition_table_get(&part->table, &key);
+    size_t i;
+    if (!b) {
+        return;
+    }
+    for (i = 0; i < darray_size(b->grps); i++) {
+        if (b->grps.item[i] == id) {
+            memmove(&b->grps.item[i], &b->grps.item[i + 1],
+                    (darray_size(b->grps) - i - 1) * sizeof(*b->grps.item));
+            darray_resize(b->grps, darray_size(b->grps) - 1);
+            break;
+        }
+    }
+    if (!darray_size(b->grps)) {
+        if (part->bucket == b) {
+            part->bucket = NULL;
+        }
+        partition_table_del(&part->table, b);
+        darray_free(b->grps);
+        free(b);
+    }
+}
+
+/* Renumber the groups of the buckets once groups are reclaimed, see
+ * grps_reclaim(). Reclaimed groups have already been removed, and the
+ * renumbering keeps the positions ascending. */
+static void
+partition_remap(struct partition *const part, const uint32_t *const remap) {
+    struct partition_table_iter it;
+    struct partition_bucket *b;
+    uint32_t *id;
+    for (b = partition_table_first(&part->table, &it); b;
+            b = partition_table_next(&part->table, &it)) {
+        darray_foreach(id, b->grps) {
+            *id = remap[*id];
+        }
+    }
+}
+
+/* Work done by a thread while scoring, see struct strgrp_stats */
+struct score_counts {
+    unsigned long scanned;
+    unsigned long rejected_len;
+    unsigned long rejected;
+    unsigned long pruned;
+    unsigned long lcs;
+    unsigned long cheap;
+    unsigned long long cells;
+    unsigned long thresholds;
+};
+
+/* Score caching
+ *
+ * Descriptions recur between runs over the same database, and are scored
+ * against the same group keys each time. The cache maps a (group key, string)
+ * pair to the LCS length found for it, bounded to the most recently used
+ * entries. A comparison abandoned below lmin only records that the length is
+ * less than lmin, so it answers later comparisons with at least that lmin.
+ *
+ * The scoring threads only look entries up, and note their hits and new
+ * lengths in their scratch space. Each thread merges its notes into the cache
+ * under the instance's lock once every thread has finished scoring, so the
+ * threads contend once per search rather than once per comparison. Entries
+ * are drawn from chunks and recycled on eviction along with the buffer
+ * holding their strings, so merging rarely allocates.
+ */
+struct score_key {
+    const char *grp;
+    const char *str;
+    size_t hash;
+};
+
+struct score_entry {
+    /* In the LRU list, or the free list if unused */
+    struct list_node lru;
+    struct score_key key;
+    int lcs;
+    int lmin;
+    char *data;
+    size_t data_size;
+};
+
+/* A thread's hit on an entry, or a length it found for a pair */
+struct score_pending {
+    struct score_key key;
+    int lcs;
+    int lmin;
+    bool hit;
+};
+
+#define SCORE_CACHE_CHUNK 1024
+
+static inline const struct score_key *
+score_entry_key(const struct score_entry *const e) {
+    return &e->key;
+}
+
+static inline size_t
+score_key_hash(const struct score_key *const k) {
+    return k->hash;
+}
+
+static inline bool
+score_entry_eq(const struct score_entry *const e,
+        const struct score_key *const k) {
+    return e->key.hash == k->hash && streq(e->key.grp, k->grp) &&
+        streq(e->key.str, k->str);
+}
+
+HTABLE_DEFINE_TYPE(struct score_entry, score_entry_key, score_key_hash,
+        score_entry_eq, score_table);
+
+struct score_cache {
+    struct score_table table;
+    /* Most recently used first */
+    struct list_head lru;
+    struct list_head free;
+#if HAVE_OPENMP
+    omp_lock_t lock;
+#endif
+    size_t size;
+    size_t n;
+    unsigned long hits;
+    unsigned long misses;
+    unsigned long evictions;
+};
+
+static inline size_t
+score_key_combine(const size_t grp, const size_t str) {
+    return hash64(&str, 1, grp);
+}
+
+static void
+score_cache_remove(struct score_cache *const cache,
+        struct score_entry *const e) {
+    score_table_del(&cache->table, e);
+    list_del(&e->lru);
+    list_add(&cache->free, &e->lru);
+    cache->n--;
+}
+
+/* The entries themselves are freed with their chunks */
+static void
+free_score_cache(struct score_cache *cache) {
+    struct score_entry *e;
+    list_for_each(&cache->lru, e, lru) {
+        free(e->data);
+    }
+    list_for_each(&cache->free, e, lru) {
+        free(e->data);
+    }
+    score_table_clear(&cache->table);
+#if HAVE_OPENMP
+    omp_destroy_lock(&cache->lock);
+#endif
+}
+
+static struct score_cache *
+new_score_cache(const tal_t *const tctx, const size_t size) {
+    struct score_cache *cache = talz(tctx, struct score_cache);
+    if (!cache) {
+        return NULL;
+    }
+    cache->size = size;
+    score_table_init(&cache->table);
+    list_head_init(&cache->lru);
+    list_head_init(&cache->free);
+#if HAVE_OPENMP
+    omp_init_lock(&cache->lock);
+#endif
+    tal_add_destructor(cache, free_score_cache);
+    return cache;
+}
+
+/* Take an unused entry, allocating a chunk of them if there are none */
+static struct score_entry *
+score_entry_new(struct score_cache *const cache) {
+    const size_t n = cache->size < SCORE_CACHE_CHUNK ?
+        cache->size : SCORE_CACHE_CHUNK;
+    struct score_entry *e = list_pop(&cache->free, struct score_entry, lru);
+    size_t i;
+    if (e) {
+        return e;
+    }
+    e = tal_arrz(cache, struct score_entry, n);
+    if (!e) {
+        return NULL;
+    }
+    for (i = 1; i < n; i++) {
+        list_add(&cache->free, &e[i].lru);
+    }
+    return e;
+}
+
+/* Find the LCS length for the pair if the entry is good for lmin. The cache
+ * is not modified, so the scoring threads may look up entries together. */
+static bool
+score_cache_get(const struct score_cache *const cache,
+        const struct score_key *const key, const int lmin, int *const lcs) {
+    const struct score_entry *const e = score_table_get(&cache->table, key);
+    if (!e || (e->lcs < e->lmin && lmin < e->lmin)) {
+        return false;
+    }
+    *lcs = e->lcs;
+    return true;
+}
+
+static void
+score_cache_put(struct score_cache *const cache,
+        const struct score_key *const key, const int lcs, const int lmin) {
+    struct score_entry *e = score_table_get(&cache->table, key);
+    size_t grp_len, str_len;
+    char *data;
+    if (e) {
+        list_del(&e->lru);
+    } else {
+        if (cache->n == cache->size) {
+            score_cache_remove(cache,
+                    list_tail(&cache->lru, struct score_entry, lru));
+            cache->evictions++;
+        }
+        e = score_entry_new(cache);
+        if (!e) {
+            return;
+        }
+        grp_len = strlen(key->grp) + 1;
+        str_len = strlen(key->str) + 1;
+        if (e->data_size < grp_len + str_len) {
+            data = realloc(e->data, grp_len + str_len);
+            if (!data) {
+                list_add(&cache->free, &e->lru);
+                return;
+            }
+            e->data = data;
+            e->data_size = grp_len + str_len;
+        }
+        memcpy(e->data, key->grp, grp_len);
+        memcpy(e->data + grp_len, key->str, str_len);
+        e->key.grp = e->data;
+        e->key.str = e->data + grp_len;
+        e->key.hash = key->hash;
+        if (!score_table_add(&cache->table, e)) {
+            list_add(&cache->free, &e->lru);
+            return;
+        }
+        cache->n++;
+    }
+    list_add(&cache->lru, &e->lru);
+    e->lcs = lcs;
+    e->lmin = lmin;
+}
+
+/* Note a thread's use of the cache, to be merged by score_cache_merge() */
+static void
+score_pending_add(struct lcs_scratch *const scratch,
+        const struct score_key *const key, const int lcs, const int lmin,
+        const bool hit) {
+    struct score_pending op;
+    op.key = *key;
+    op.lcs = lcs;
+    op.lmin = lmin;
+    op.hit = hit;
+    darray_push(scratch->pending, op);
+}
+
+/* Apply a thread's hits and new lengths to the cache, once no thread is
+ * looking up entries. The keys noted are the group keys and the query, which
+ * remain valid for the search. */
+static void
+score_cache_merge(struct score_cache *const cache,
+        struct lcs_scratch *const scratch) {
+    const struct score_pending *op;
+    struct score_entry *e;
+    if (!cache || !darray_size(scratch->pending)) {
+        return;
+    }
+#if HAVE_OPENMP
+    omp_set_lock(&cache->lock);
+#endif
+    darray_foreach(op, scratch->pending) {
+        if (!op->hit) {
+            cache->misses++;
+            score_cache_put(cache, &op->key, op->lcs, op->lmin);
+            continue;
+        }
+        cache->hits++;
+        /* Another thread may have evicted the entry since */
+        e = score_table_get(&cache->table, &op->key);
+        if (e) {
+            list_del(&e->lru);
+            list_add(&cache->lru, &e->lru);
+        }
+    }
+#if HAVE_OPENMP
+    omp_unset_lock(&cache->lock);
+#endif
+    darray_resize(scratch->pending, 0);
+}
+
+/* Record a group's score relative to the threshold it was measured against,
+ * or to the instance's threshold if it passes that */
+static inline void
+grp_scored(const struct strgrp *const ctx, const int i, const double score,
+        const double threshold) {
+    col_at(ctx, score, i) =
+        score - (score >= threshold ? ctx->threshold : threshold);
+}
+
+/* Compare the string with the keys of the groups waiting in a batch using
+ * the instance's SIMD kernel, and record their scores */
+static void
+lcs_batch_flush(const struct strgrp *const ctx,
+        const struct lcs_pattern *const p, struct lcs_scratch *const scratch,
+        struct lcs_batch *const batch) {
+    int lcs[LCS_LANES_MAX];
+    int l;
+    if (!batch->n) {
+        return;
+    }
+    lcs_kernels[ctx->kernel].fn(p, batch, lcs);
+    for (l = 0; l < batch->n; l++) {
+        struct strgrp_grp *const grp = batch->grps[l];
+#ifdef STRGRP_CHECK_LCS
+        assert(lcs[l] == lcs_bp_word(p, grp->key, batch->lens[l],
+                    batch->lmins[l]));
+#endif
+        if (ctx->cache) {
+            struct score_key key;
+            key.grp = grp->key;
+            key.str = p->str;
+            key.hash = score_key_combine(grp->hash, p->hash);
+            score_pending_add(scratch, &key, lcs[l], batch->lmins[l], false);
+        }
+        grp_scored(ctx, grp->index, nlcs_len(lcs[l], p->len, batch->lens[l]),
+                batch->thresholds[l]);
+    }
+    batch->n = 0;
+}
+
+/* Queue the comparison of the string with a group's key for the instance's
+ * SIMD kernel, in a batch with keys of similar length. Returns false if the
+ * comparison must be made now. */
+static bool
+lcs_batch_add(const struct strgrp *const ctx, struct strgrp_grp *const grp,
+        const struct lcs_pattern *const p, const int lmin,
+        const double threshold, struct lcs_scratch *const scratch) {
+    const int lanes = lcs_kernels[ctx->kernel].lanes;
+    const size_t len = col_at(ctx, key_len, grp->index);
+    struct lcs_batch *batch;
+    size_t class;
+    /* The kernels hold single-word patterns, and lcs_bp_word() answers
+     * unreachable lmins without comparing */
+    if (lanes < 2 || p->n_words != 1 || (ssize_t)len < lmin ||
+            (ssize_t)p->len < lmin) {
+        return false;
+    }
+    class = len / 16;
+    batch = &scratch->batches[class < LCS_BATCH_CLASSES ?
+        class : LCS_BATCH_CLASSES - 1];
+    batch->grps[batch->n] = grp;
+    batch->lens[batch->n] = len;
+    batch->lmins[batch->n] = lmin;
+    batch->thresholds[batch->n] = threshold;
+    if (++batch->n == lanes) {
+        lcs_batch_flush(ctx, p, scratch, batch);
+    }
+    return true;
+}
+
+/* Complete the comparisons waiting in a thread's batches */
+static void
+lcs_batches_flush(const struct strgrp *const ctx,
+        const struct lcs_pattern *const p, struct lcs_scratch *const scratch) {
+    int i;
+    for (i = 0; i < LCS_BATCH_CLASSES; i++) {
+        lcs_batch_flush(ctx, p, scratch, &scratch->batches[i]);
+    }
+}
+
+/* Score a group key as for grp_score(), consulting the cache if there is one.
+ * Returns false if the comparison waits in a batch, see lcs_batch_add(). */
+static bool
+grp_score_cached(const struct strgrp *const ctx, struct strgrp_grp *const grp,
+        const struct lcs_pattern *const p, const int lmin,
+        const double threshold, struct lcs_scratch *const scratch,
+        struct score_counts *const counts, double *const score) {
+    struct score_cache *const cache = ctx->cache;
+    struct score_key key;
+    bool hit = false;
+    int lcs;
+    if (cache) {
+        key.grp = grp->key;
+        key.str = p->str;
+        key.hash = score_key_combine(grp->hash, p->hash);
+        hit = score_cache_get(cache, &key, lmin, &lcs);
+        if (hit) {
+            score_pending_add(scratch, &key, lcs, lmin, true);
+        }
+    }
+    if (!hit) {
+        counts->lcs++;
+        counts->cells += p->len * grp_col(grp, key_len);
+        if (lcs_batch_add(ctx, grp, p, lmin, threshold, scratch)) {
+            return false;
+        }
+        if (!cache) {
+            *score = grp_score(grp, p, lmin, scratch);
+            return true;
+        }
+        lcs = lcs_bp(p, grp->key, grp_col(grp, key_len), lmin, scratch);
+        score_pending_add(scratch, &key, lcs, lmin, false);
+    }
+    *score = nlcs_len(lcs, p->len, grp_col(grp, key_len));
+    return true;
+}
+
+/* Cheap metrics
+ *
+ * Token Jaccard and bigram cosine similarity compare profiles of the strings:
+ * the hashes of their distinct tokens, and the counts of their distinct
+ * bigrams. The string is padded at either end so that single characters still
+ * form bigrams. Both are kept sorted, so each metric is a merge of two short
+ * arrays, against the O(|a||b| / w) words of the bit-parallel LCS. Group keys
+ * keep their profile while a cheap metric is in use, and the query's is built
+ * with its pattern.
+ *
+ * Used as a screen, a cheap metric decides the pairs it scores further than a
+ * margin from the threshold, and only the remainder are scored by LCS.
+ */
+static inline size_t
+metric_n_tokens(const size_t len) {
+    return len / 2 + 1;
+}
+
+static inline size_t
+metric_n_grams(const size_t len) {
+    return len + 1;
+}
+
+/* Profiles are short, so insertion sort beats qsort() */
+static void
+sort_u32(uint32_t *const v, const size_t n) {
+    size_t i, j;
+    for (i = 1; i < n; i++) {
+        const uint32_t x = v[i];
+        for (j = i; j && v[j - 1] > x; j--) {
+            v[j] = v[j - 1];
+        }
+        v[j] = x;
+    }
+}
+
+/* Profile str, whose arrays must have room for the tokens and grams of len
+ * characters */
+static void
+metric_profile_fill(struct metric_profile *const m, const char *const str,
+        const size_t len) {
+    uint32_t h = 0;
+    unsigned char prev = 0;
+    double norm = 0;
+    size_t i, n;
+    bool token = false;
+
+    for (i = 0, n = 0; i <= len; i++) {
+        const unsigned char c = i < len ? str[i] : '\0';
+        if (isalnum(c)) {
+            /* FNV-1a */
+            h = ((token ? h : 2166136261u) ^ c) * 16777619u;
+            token = true;
+        } else if (token) {
+            m->tokens[n++] = h;
+            token = false;
+        }
+    }
+    sort_u32(m->tokens, n);
+    for (i = 0, m->n_tokens = 0; i < n; i++) {
+        if (!m->n_tokens || m->tokens[m->n_tokens - 1] != m->tokens[i]) {
+            m->tokens[m->n_tokens++] = m->tokens[i];
+        }
+    }
+
+    /* Insert each bigram in order, counting repeats */
+    for (i = 0, m->n_grams = 0; len && i <= len; i++) {
+        const unsigned char c = i < len ? str[i] : '\0';
+        const uint32_t id = ((uint32_t)prev << CHAR_BIT) | c;
+        size_t j = m->n_grams;
+        prev = c;
+        while (j && m->grams[j - 1].id > id) {
+            j--;
+        }
+        if (j && m->grams[j - 1].id == id) {
+            m->grams[j - 1].count++;
+            continue;
+        }
+        memmove(&m->grams[j + 1], &m->grams[j],
+                (m->n_grams - j) * sizeof(*m->grams));
+        m->grams[j].id = id;
+        m->grams[j].count = 1;
+        m->n_grams++;
+    }
+    m->total = len ? len + 1 : 0;
+    m->peak = 0;
+    for (i = 0; i < m->n_grams; i++) {
+        const uint32_t count = m->grams[i].count;
+        norm += (double)count * count;
+        m->peak = count > m->peak ? count : m->peak;
+    }
+    m->norm = sqrt(norm);
+}
+
+static struct metric_profile *
+new_metric_profile(const tal_t *const tctx, const char *const str,
+        const size_t len) {
+    struct metric_profile *m = tal(tctx, struct metric_profile);
+    if (!m) {
+        return NULL;
+    }
+    m->tokens = tal_arr(m, uint32_t, metric_n_tokens(len));
+    m->grams = tal_arr(m, struct qgram_posting, metric_n_grams(len));
+    if (!m->tokens || !m->grams) {
+        return tal_free(m);
+    }
+    metric_profile_fill(m, str, len);
+    return m;
+}
+
+/* Profile str in the scratch space, which the profile is valid until reused */
+static const struct metric_profile *
+metric_scratch_profile(struct metric_scratch *const s, const char *const str,
+        const size_t len) {
+    struct metric_profile *const m = &s->profile;
+    if (len > s->len || !m->tokens) {
+        uint32_t *const tokens =
+            realloc(m->tokens, metric_n_tokens(len) * sizeof(*m->tokens));
+        struct qgram_posting *grams;
+        if (!tokens) {
+            return NULL;
+        }
+        m->tokens = tokens;
+        grams = realloc(m->grams, metric_n_grams(len) * sizeof(*m->grams));
+        if (!grams) {
+            return NULL;
+        }
+        m->grams = grams;
+        s->len = len;
+    }
+    metric_profile_fill(m, str, len);
+    return m;
+}
+
+static void
+metric_scratch_free(struct metric_scratch *const s) {
+    free(s->profile.tokens);
+    free(s->profile.grams);
+}
+
+static double
+metric_jaccard(const struct metric_profile *const a,
+        const struct metric_profile *const b) {
+    size_t i = 0, j = 0, shared = 0;
+    if (!a->n_tokens && !b->n_tokens) {
+        return 1.0;
+    }
+    while (i < a->n_tokens && j < b->n_tokens) {
+        if (a->tokens[i] < b->tokens[j]) {
+            i++;
+        } else if (a->tokens[i] > b->tokens[j]) {
+            j++;
+        } else {
+            shared++;
+            i++;
+            j++;
+        }
+    }
+    return (double)shared / (a->n_tokens + b->n_tokens - shared);
+}
+
+static double
+metric_cosine(const struct metric_profile *const a,
+        const struct metric_profile *const b) {
+    size_t i = 0, j = 0;
+    double dot = 0;
+    if (!a->n_grams || !b->n_grams) {
+        return a->n_grams == b->n_grams ? 1.0 : 0.0;
+    }
+    while (i < a->n_grams && j < b->n_grams) {
+        if (a->grams[i].id < b->grams[j].id) {
+            i++;
+        } else if (a->grams[i].id > b->grams[j].id) {
+            j++;
+        } else {
+            dot += (double)a->grams[i].count * b->grams[j].count;
+            i++;
+            j++;
+        }
+    }
+    return dot / (a->norm * b->norm);
+}
+
+/* The Jaccard index is at most the ratio of the numbers of distinct tokens */
+static inline bool
+should_grp_score_tokens(const double threshold,
+        const struct metric_profile *const a,
+        const struct metric_profile *const b) {
+    const size_t lo = a->n_tokens < b->n_tokens ? a->n_tokens : b->n_tokens;
+    const size_t hi = a->n_tokens < b->n_tokens ? b->n_tokens : a->n_tokens;
+    return !hi || threshold <= (double)lo / hi;
+}
+
+/* Each bigram of a meets at most the peak count of b in their dot product, so
+ * the cosine similarity is bounded by the sums and peaks of the counts. For
+ * strings with few repeated bigrams this approaches the ratio of their
+ * lengths. */
+static inline bool
+should_grp_score_grams(const double threshold,
+        const struct metric_profile *const a,
+        const struct metric_profile *const b) {
+    const double ab = (double)a->total * b->peak;
+    const double ba = (double)b->total * a->peak;
+    if (!a->n_grams || !b->n_grams) {
+        return true;
+    }
+    return threshold * a->norm * b->norm <= (ab < ba ? ab : ba);
+}
+
+static inline double
+metric_score(const enum strgrp_metric metric,
+        const struct metric_profile *const a,
+        const struct metric_profile *const b) {
+    return metric == STRGRP_METRIC_JACCARD ?
+        metric_jaccard(a, b) : metric_cosine(a, b);
+}
+
+/* Whether the strings and group keys need profiles */
+static inline bool
+metric_profiled(const enum strgrp_metric metric,
+        const enum strgrp_metric screen) {
+    return metric != STRGRP_METRIC_LCS || screen != STRGRP_METRIC_LCS;
+}
+
+/* Structure management */
+
+/* Items and variants are created in large numbers, so they are carved from
+ * the instance's pool rather than allocated individually, and their keys from
+ * the key arena. The pools only release memory with the instance, so the
+ * storage of removed items, variants and keys is kept on free lists threaded
+ * through the storage itself for reuse. Keys are binned by size: a freed key
+ * of n bytes serves requests of up to n rounded down to KEY_GRAIN, and keys
+ * too short to hold the link or too long for the bins are not reused.
+ *
+ * Items bearing the same string in a group share a variant, so the string is
+ * stored once and the group's threshold is maintained over its distinct
+ * strings. Identical strings are perfectly similar, so the minimum similarity
+ * of the variants is that of the items. */
+static inline void
+recycle(void **const head, void *const block) {
+    memcpy(block, head, sizeof(*head));
+    *head = block;
+}
+
+static inline void *
+reuse(void **const head) {
+    void *const block = *head;
+    if (block) {
+        memcpy(head, block, sizeof(*head));
+    }
+    return block;
+}
+
+static struct strgrp_item *
+item_alloc(struct strgrp *const ctx) {
+    struct strgrp_item *const i = reuse(&ctx->free_items);
+    return i ? i : block_pool_alloc(ctx->pool, sizeof(*i));
+}
+
+static inline void
+item_free(struct strgrp *const ctx, struct strgrp_item *const i) {
+    recycle(&ctx->free_items, i);
+}
+
+/* Copy str, of length len, into the key arena */
+static char *
+key_dup(struct strgrp *const ctx, const char *const str, const size_t len) {
+    const size_t bin = (len + KEY_GRAIN) / KEY_GRAIN;
+    char *key = bin < KEY_BINS ? reuse(&ctx->free_keys[bin]) : NULL;
+    if (!key) {
+        key = block_pool_alloc_align(ctx->keys, len + 1, 1);
+        if (!key) {
+            return NULL;
+        }
+    }
+    memcpy(key, str, len + 1);
+    return key;
+}
+
+static inline void
+key_free(struct strgrp *const ctx, const char *const key, const size_t len) {
+    const size_t bin = (len + 1) / KEY_GRAIN;
+    if (bin && bin < KEY_BINS) {
+        recycle(&ctx->free_keys[bin], (char *)key);
+    }
+}
+
+/* Free a variant no item bears. Its key is freed too, unless borrowed or kept
+ * by a dissolved group, see grp_dissolve(). */
+static void
+variant_free(struct strgrp *const ctx, struct strgrp_variant *const v,
+        const bool keep_key) {
+    if (!v->borrowed && !keep_key) {
+        key_free(ctx, v->key, v->key_len);
+    }
+    recycle(&ctx->free_variants, v);
+}
+
+static struct strgrp_variant *
+grp_variant_find(const struct strgrp *const ctx,
+        const struct strgrp_grp *const grp, const char *const str,
+        const size_t len, const size_t h) {
+    const struct strgrp_variant k = {
+        .grp = grp, .key = str, .key_len = len, .hash = h,
+    };
+    return variant_table_get(&ctx->variants, &k);
+}
+
+/* Provide the variant of grp for str, hashed h, adding it if the group has
+ * none. The string is copied unless it is borrowed, i.e. lives as long as the
+ * instance. */
+static struct strgrp_variant *
+grp_variant_enter(struct strgrp *const ctx, struct strgrp_grp *const grp,
+        const char *const str, const size_t len, const size_t h,
+        const bool borrowed) {
+    struct strgrp_variant *v = grp_variant_find(ctx, grp, str, len, h);
+    if (v) {
+        return v;
+    }
+    v = reuse(&ctx->free_variants);
+    if (!v) {
+        v = block_pool_alloc(ctx->pool, sizeof(*v));
+        if (!v) {
+            return NULL;
+        }
+    }
+    v->grp = grp;
+    v->key = borrowed ? str : key_dup(ctx, str, len);
+    v->key_len = len;
+    v->hash = h;
+    v->count = 0;
+    v->borrowed = borrowed;
+    if (!v->key) {
+        recycle(&ctx->free_variants, v);
+        return NULL;
+    }
+    if (!variant_table_add(&ctx->variants, v)) {
+        variant_free(ctx, v, false);
+        return NULL;
+    }
+    darray_push(grp->variants, v);
+    return v;
+}
+
+/* Remove a variant no item of grp bears, returning its position */
+static size_t
+grp_variant_drop(struct strgrp *const ctx, struct strgrp_grp *const grp,
+        struct strgrp_variant *const v) {
+    size_t j;
+    variant_table_del(&ctx->variants, v);
+    for (j = 0; darray_item(grp->variants, j) != v; j++);
+    memmove(&grp->variants.item[j], &grp->variants.item[j + 1],
+            (darray_size(grp->variants) - j - 1) * sizeof(*grp->variants.item));
+    darray_resize(grp->variants, darray_size(grp->variants) - 1);
+    variant_free(ctx, v, false);
+    return j;
+}
+
+/* The threshold only needs updating once the group is large enough and has
+ * variants beyond the first n_low */
+static void
+append_item(const struct strgrp *const ctx, struct strgrp_grp *const grp,
+        struct strgrp_item *const i, struct strgrp_variant *const v) {
+    i->variant = v;
+    v->count++;
+    darray_push(grp->items, i);
+    grp_col(grp, n_items)++;
+    grp_col(grp, dirty) = grp_col(grp, n_items) >= ctx->size &&
+        grp->n_low < (ssize_t)darray_size(grp->variants);
+}
+
+/* See grp_variant_enter() for borrowed */
+static bool
+add_item(struct strgrp *const ctx, struct strgrp_grp *const grp,
+        const char *const str, const size_t len, const size_t h,
+        const bool borrowed, void *const data) {
+    struct strgrp_item *const i = item_alloc(ctx);
+    struct strgrp_variant *const v =
+        i ? grp_variant_enter(ctx, grp, str, len, h, borrowed) : NULL;
+    if (!v) {
+        if (i) {
+            item_free(ctx, i);
+        }
+        return false;
+    }
+    i->value = data;
+    append_item(ctx, grp, i, v);
+    return true;
+}
+
+static void
+free_grp(struct strgrp_grp *grp) {
+    darray_free(grp->items);
+    darray_free(grp->variants);
+}
+
+/* Release a group and the storage of its items, variants and key. The group
+ * must not be indexed. */
+static void
+grp_free(struct strgrp *const ctx, struct strgrp_grp *const grp) {
+    struct strgrp_variant **v;
+    struct strgrp_item **item;
+    darray_foreach(item, grp->items) {
+        item_free(ctx, *item);
+    }
+    darray_foreach(v, grp->variants) {
+        variant_table_del(&ctx->variants, *v);
+        variant_free(ctx, *v, false);
+    }
+    if (grp->owns_key) {
+        key_free(ctx, grp->key, strlen(grp->key));
+    }
+    tal_free(grp);
+}
+
+static void
+grp_cols_init(struct grp_cols *const cols) {
+    darray_init(cols->key_len);
+    darray_init(cols->n_items);
+    darray_init(cols->hist);
+    darray_init(cols->score);
+    darray_init(cols->epoch);
+    darray_init(cols->threshold);
+    darray_init(cols->dirty);
+}
+
+/* Provide the metadata of n groups, see struct grp_cols */
+static void
+grp_cols_resize(struct grp_cols *const cols, const size_t n) {
+    darray_resize(cols->key_len, n);
+    darray_resize(cols->n_items, n);
+    darray_resize(cols->hist, n);
+    darray_resize(cols->score, n);
+    darray_resize(cols->epoch, n);
+    darray_resize(cols->threshold, n);
+    darray_resize(cols->dirty, n);
+}
+
+/* Copy the metadata of the group at position i to position j */
+static void
+grp_cols_move(struct grp_cols *const cols, const size_t i, const size_t j) {
+    cols->key_len.item[j] = cols->key_len.item[i];
+    cols->n_items.item[j] = cols->n_items.item[i];
+    cols->hist.item[j] = cols->hist.item[i];
+    cols->score.item[j] = cols->score.item[i];
+    cols->epoch.item[j] = cols->epoch.item[i];
+    cols->threshold.item[j] = cols->threshold.item[i];
+    cols->dirty.item[j] = cols->dirty.item[i];
+}
+
+static void
+grp_cols_free(struct grp_cols *const cols) {
+    darray_free(cols->key_len);
+    darray_free(cols->n_items);
+    darray_free(cols->hist);
+    darray_free(cols->score);
+    darray_free(cols->epoch);
+    darray_free(cols->threshold);
+    darray_free(cols->dirty);
+}
+
+/* Allocate an empty group with the key at the next position. The key must
+ * outlive the group, unless the group is given the key of its first variant
+ * as by new_grp(). */
+static struct strgrp_grp *
+grp_alloc(struct strgrp *const ctx, const char *const key) {
+    struct strgrp_grp *b;
+    size_t len;
+    if (!key) {
+        return NULL;
+    }
+    b = talz(ctx, struct strgrp_grp);
+    if (!b) {
+        return NULL;
+    }
+    len = strlen(key);
+    b->ctx = ctx;
+    b->key = key;
+    b->index = ctx->n_grps;
+    grp_cols_resize(&ctx->cols, b->index + 1);
+    grp_col(b, key_len) = len;
+    grp_col(b, n_items) = 0;
+    grp_col(b, score) = 0;
+    grp_col(b, epoch) = 0;
+    b->hash = hash(key, len, 0);
+    grp_col(b, hist) = new_char_counts(b, key, len);
+    if (!grp_col(b, hist)) {
+        return tal_free(b);
+    }
+    if (metric_profiled(ctx->metric, ctx->screen)) {
+        b->profile = new_metric_profile(b, key, len);
+        if (!b->profile) {
+            return tal_free(b);
+        }
+    }
+    darray_init(b->items);
+    darray_init(b->variants);
+    tal_add_destructor(b, free_grp);
+    return b;
+}
+
+static struct strgrp_grp *
+new_grp(struct strgrp *const ctx, const char *const str,
+        void *const data) {
+    struct strgrp_grp *b = grp_alloc(ctx, str);
+    if (!b) {
+        return NULL;
+    }
+    grp_col(b, threshold) = ctx->threshold;
+    grp_col(b, dirty) = false;
+    b->low = 1.0;
+    b->n_low = 0;
+    if (!add_item(ctx, b, str, grp_col(b, key_len), b->hash, false, data)) {
+        return tal_free(b);
+    }
+    /* The key shares the storage of the first variant */
+    b->key = darray_item(b->variants, 0)->key;
+    return b;
+}
+
+static struct strgrp_grp *
+add_grp(struct strgrp *const ctx, const char *const str,
+        void *const data) {
+    struct strgrp_grp *b = new_grp(ctx, str, data);
+    if (!b) {
+        return NULL;
+    }
+    if (ctx->qgrams && !qgram_index_add(ctx->qgrams, b->index, b->key,
+                grp_col(b, key_len))) {
+        grp_free(ctx, b);
+        return NULL;
+    }
+    if (ctx->minhash && !minhash_index_add(ctx->minhash, b->index, b->key,
+                grp_col(b, key_len))) {
+        if (ctx->qgrams) {
+            qgram_index_remove(ctx->qgrams, b->index, b->key,
+                    grp_col(b, key_len));
+            darray_resize(ctx->qgrams->shared, b->index);
+        }
+        grp_free(ctx, b);
+        return NULL;
+    }
+    if (ctx->partition) {
+        b->part = partition_key(ctx->partition, b->key);
+        if (!partition_add(ctx->partition, b->index, b->part)) {
+            if (ctx->qgrams) {
+                qgram_index_remove(ctx->qgrams, b->index, b->key,
+                        grp_col(b, key_len));
+                darray_resize(ctx->qgrams->shared, b->index);
+            }
+            if (ctx->minhash) {
+                minhash_index_remove(ctx->minhash, b->index, b->key,
+                        grp_col(b, key_len));
+                darray_resize(ctx->minhash->marks, b->index);
+            }
+            grp_free(ctx, b);
+            return NULL;
+        }
+    }
+    darray_push(ctx->grps, b);
+    ctx->n_grps++;
+    return b;
+}
+
+static struct strgrp_grp *
+known_get(const struct strgrp *const ctx, const char *const str,
+        const size_t h) {
+    const struct known_key key = { str, h };
+    const struct known_entry *const e = known_table_get(&ctx->known, &key);
+    return e ? e->grp : NULL;
+}
+
+/* Map str, of length len and hash h, to grp. Failing to allocate only costs
+ * the exact match, as str is then scored against the groups. */
+static void
+cache(struct strgrp *const ctx, struct strgrp_grp *const grp,
+        const char *const str, const size_t len, const size_t h) {
+    const struct known_key key = { str, h };
+    struct known_entry *e = known_table_get(&ctx->known, &key);
+    if (e) {
+        e->grp = grp;
+        return;
+    }
+    e = malloc(sizeof(*e) + len + 1);
+    if (!e) {
+        return;
+    }
+    memcpy(e->data, str, len + 1);
+    e->key.str = e->data;
+    e->key.hash = h;
+    e->grp = grp;
+    if (!known_table_add(&ctx->known, e)) {
+        free(e);
+    }
+}
+
+static void
+uncache(struct strgrp *const ctx, const struct strgrp_grp *const grp,
+        const char *const str, const size_t len) {
+    const struct known_key key = { str, known_hash(str, len) };
+    struct known_entry *const e = known_table_get(&ctx->known, &key);
+    if (e && e->grp == grp) {
+        known_table_del(&ctx->known, e);
+        free(e);
+    }
+}
+
+static void
+known_free(struct known_table *const known) {
+    struct known_table_iter iter;
+    struct known_entry *e;
+    for (e = known_table_first(known, &iter); e;
+            e = known_table_next(known, &iter)) {
+        free(e);
+    }
+    known_table_clear(known);
+}
+
+/* Replace the key of a group with that of one of its variants, moving it in
+ * the candidate indexes. The group is unchanged if this fails. */
+static bool
+grp_set_key(struct strgrp *const ctx, struct strgrp_grp *const grp,
+        const char *const key) {
+    const size_t len = strlen(key);
+    const size_t part =
+        ctx->partition ? partition_key(ctx->partition, key) : grp->part;
+    struct char_count *const hist = new_char_counts(grp, key, len);
+    struct metric_profile *profile = NULL;
+    if (!hist) {
+        goto fail;
+    }
+    if (grp->profile) {
+        profile = new_metric_profile(grp, key, len);
+        if (!profile) {
+            goto fail;
+        }
+    }
+    if (ctx->qgrams && !qgram_index_post(ctx->qgrams, grp->index, key, len)) {
+        goto fail;
+    }
+    if (ctx->minhash &&
+            !minhash_index_post(ctx->minhash, grp->index, key, len)) {
+        if (ctx->qgrams) {
+            qgram_index_remove(ctx->qgrams, grp->index, key, len);
+        }
+        goto fail;
+    }
+    if (part != grp->part &&
+            !partition_add(ctx->partition, grp->index, part)) {
+        if (ctx->qgrams) {
+            qgram_index_remove(ctx->qgrams, grp->index, key, len);
+        }
+        if (ctx->minhash) {
+            minhash_index_remove(ctx->minhash, grp->index, key, len);
+        }
+        goto fail;
+    }
+    if (ctx->qgrams) {
+        qgram_index_remove(ctx->qgrams, grp->index, grp->key,
+                grp_col(grp, key_len));
+    }
+    if (ctx->minhash) {
+        minhash_index_remove(ctx->minhash, grp->index, grp->key,
+                grp_col(grp, key_len));
+    }
+    if (part != grp->part) {
+        partition_remove(ctx->partition, grp->index, grp->part);
+    }
+    tal_free(grp_col(grp, hist));
+    tal_free(grp->profile);
+    grp->key = key;
+    grp_col(grp, key_len) = len;
+    grp->hash = hash(key, len, 0);
+    grp_col(grp, hist) = hist;
+    grp->profile = profile;
+    grp->part = part;
+    return true;
+
+fail:
+    tal_free(hist);
+    tal_free(profile);
+    return false;
+}
+
+/* Restart the dynamic threshold of a group, whose items have changed */
+static void
+grp_reset_threshold(const struct strgrp *const ctx,
+        struct strgrp_grp *const grp) {
+    grp_col(grp, threshold) = ctx->threshold;
+    grp->low = 1.0;
+    grp->n_low = 0;
+    grp_col(grp, dirty) = ctx->size > 0 && grp_col(grp, n_items) >= ctx->size;
+}
+
+/* Empty a group and withdraw it from the candidate indexes. The group keeps
+ * its key, and its position until reclaimed by grps_reclaim(), but it is
+ * skipped by searches and iteration. */
+static void
+grp_dissolve(struct strgrp *const ctx, struct strgrp_grp *const grp,
+        void (*cb)(void *data)) {
+    struct strgrp_variant **v;
+    struct strgrp_item **item;
+    darray_foreach(v, grp->variants) {
+        const bool key = (*v)->key == grp->key;
+        uncache(ctx, grp, (*v)->key, (*v)->key_len);
+        variant_table_del(&ctx->variants, *v);
+        if (key) {
+            grp->owns_key = !(*v)->borrowed;
+        }
+        variant_free(ctx, *v, key);
+    }
+    darray_foreach(item, grp->items) {
+        if (cb) {
+            cb((*item)->value);
+        }
+        item_free(ctx, *item);
+    }
+    darray_free(grp->items);
+    darray_init(grp->items);
+    darray_free(grp->variants);
+    darray_init(grp->variants);
+    grp_col(grp, n_items) = 0;
+    grp_reset_threshold(ctx, grp);
+    if (ctx->qgrams) {
+        qgram_index_remove(ctx->qgrams, grp->index, grp->key,
+                grp_col(grp, key_len));
+    }
+    if (ctx->minhash) {
+        minhash_index_remove(ctx->minhash, grp->index, grp->key,
+                grp_col(grp, key_len));
+    }
+    if (ctx->partition) {
+        partition_remove(ctx->partition, grp->index, grp->part);
+    }
+    if (!grp->holds) {
+        ctx->n_dissolved++;
+    }
+}
+
+/* Detach the i'th item from its group. A group losing the last item bearing
+ * its key is re-keyed with its first remaining item, and a group losing its
+ * last item is dissolved. Returns NULL if i is out of range or re-keying
+ * fails, in which case the group is unchanged. */
+static struct strgrp_item *
+grp_take_item(struct strgrp *const ctx, struct strgrp_grp *const grp,
+        const size_t i) {
+    struct strgrp_variant *v;
+    struct strgrp_item *item;
+    bool last;
+    if (i >= (size_t)grp_col(grp, n_items)) {
+        return NULL;
+    }
+    item = darray_item(grp->items, i);
+    v = item->variant;
+    last = v->count == 1;
+    if (last && grp_col(grp, n_items) > 1 && streq(v->key, grp->key) &&
+            !grp_set_key(ctx, grp,
+                darray_item(grp->items, !i)->variant->key)) {
+        return NULL;
+    }
+    if (last) {
+        uncache(ctx, grp, v->key, v->key_len);
+    }
+    memmove(&grp->items.item[i], &grp->items.item[i + 1],
+            (grp_col(grp, n_items) - i - 1) * sizeof(*grp->items.item));
+    darray_resize(grp->items, grp_col(grp, n_items) - 1);
+    grp_col(grp, n_items)--;
+    v->count--;
+    if (!grp_col(grp, n_items)) {
+        grp_dissolve(ctx, grp, NULL);
+    } else if (last && (ssize_t)grp_variant_drop(ctx, grp, v) < grp->n_low) {
+        /* The minimum similarity only covers the first n_low variants */
+        grp_reset_threshold(ctx, grp);
+    }
+    return item;
+}
+
+/* Dissolved groups that are not held are reclaimed once there are
+ * GRPS_RECLAIM_MIN of them and they make up a quarter of the positions. Every
+ * search visits the dissolved groups, and reclaiming them renumbers the
+ * groups after them in the candidate indexes, so waiting for a share of the
+ * positions bounds both costs per dissolved group. */
+#define GRPS_RECLAIM_MIN 64
+
+/* Free the dissolved groups that are not held, moving the remaining groups
+ * down in order. Positions are renumbered in the candidate indexes and the
+ * live iterators. If this fails to allocate the groups stay dissolved. */
+static void
+grps_reclaim(struct strgrp *const ctx) {
+    struct strgrp_iter *iter;
+    uint32_t *remap;
+    unsigned int i, n;
+    if (ctx->n_dissolved < GRPS_RECLAIM_MIN ||
+            ctx->n_dissolved < ctx->n_grps / 4) {
+        return;
+    }
+    remap = malloc(ctx->n_grps * sizeof(*remap));
+    if (!remap) {
+        return;
+    }
+    for (i = 0, n = 0; i < ctx->n_grps; i++) {
+        struct strgrp_grp *const grp = darray_item(ctx->grps, i);
+        if (!col_at(ctx, n_items, i) && !grp->holds) {
+            remap[i] = GRP_RECLAIMED;
+            grp_free(ctx, grp);
+            continue;
+        }
+        remap[i] = n;
+        if (n != i) {
+            grp_cols_move(&ctx->cols, i, n);
+            darray_item(ctx->grps, n) = grp;
+            grp->index = n;
+        }
+        n++;
+    }
+    if (ctx->qgrams) {
+        qgram_index_remap(ctx->qgrams, remap, n);
+    }
+    if (ctx->minhash) {
+        minhash_index_remap(ctx->minhash, remap, n);
+    }
+    if (ctx->partition) {
+        partition_remap(ctx->partition, remap);
+    }
+    /* An iterator resumes at the first remaining group it hasn't visited */
+    list_for_each(&ctx->iters, iter, list) {
+        for (i = iter->i; i < ctx->n_grps && remap[i] == GRP_RECLAIMED; i++);
+        iter->i = i < ctx->n_grps ? (int)remap[i] : (int)n;
+    }
+    darray_resize(ctx->grps, n);
+    grp_cols_resize(&ctx->cols, n);
+    ctx->n_grps = n;
+    ctx->n_dissolved = 0;
+    free(remap);
+}
+
+/* Apply the filters in increasing order of cost, providing the minimum LCS
+ * length a group must reach if it should be scored */
+static inline bool
+should_grp_score(const struct strgrp *const ctx, const int i,
+        const struct lcs_pattern *const p, const double threshold,
+        int *const lmin, struct score_counts *const counts) {
+    const size_t key_len = col_at(ctx, key_len, i);
+    if (!should_grp_score_len(threshold, key_len, p->len)) {
+        counts->rejected_len++;
+        return false;
+    }
+    *lmin = nlcs_lmin(threshold, p->len, key_len);
+    if (!should_grp_score_qgram(ctx->qgrams, i, *lmin, p->len, key_len) ||
+            !should_grp_score_hist(p, col_at(ctx, hist, i), *lmin)) {
+        counts->rejected++;
+        return false;
+    }
+    return true;
+}
+
+/* Score a group against the query with the instance's metric, screening the
+ * pair first in a cascade. Returns false if the filters show the group cannot
+ * reach threshold or its comparison waits in a batch, otherwise provides its
+ * score. */
+static inline bool
+grp_measure(const struct strgrp *const ctx, const int i,
+        const struct lcs_pattern *const p, const double threshold,
+        struct lcs_scratch *const scratch, struct score_counts *const counts,
+        double *const score) {
+    struct strgrp_grp *const grp = darray_item(ctx->grps, i);
+    int lmin;
+    if ((ctx->metric == STRGRP_METRIC_JACCARD &&
+                !should_grp_score_tokens(threshold, p->profile, grp->profile)) ||
+            (ctx->metric == STRGRP_METRIC_COSINE &&
+                !should_grp_score_grams(threshold, p->profile, grp->profile))) {
+        counts->rejected_len++;
+        return false;
+    }
+    if (ctx->metric != STRGRP_METRIC_LCS) {
+        counts->cheap++;
+        *score = metric_score(ctx->metric, p->profile, grp->profile);
+        return true;
+    }
+    if (!should_grp_score(ctx, i, p, threshold, &lmin, counts)) {
+        return false;
+    }
+    if (ctx->screen != STRGRP_METRIC_LCS) {
+        const double screened = metric_score(ctx->screen, p->profile,
+                grp->profile);
+        counts->cheap++;
+        if (screened >= threshold + ctx->margin ||
+                screened < threshold - ctx->margin) {
+            *score = screened;
+            return true;
+        }
+    }
+    return grp_score_cached(ctx, grp, p, lmin, threshold, scratch, counts,
+            score);
+}
+
+/* Accumulate a thread's counts into the instance's statistics */
+static void
+score_counts_add(struct strgrp *const ctx,
+        const struct score_counts *const counts) {
+#if HAVE_OPENMP
+    #pragma omp critical(strgrp_stats)
+#endif
+    {
+        ctx->stats.scanned += counts->scanned;
+        ctx->stats.rejected_len += counts->rejected_len;
+        ctx->stats.rejected += counts->rejected;
+        ctx->stats.lcs += counts->lcs;
+        ctx->stats.cheap += counts->cheap;
+        ctx->stats.cells += counts->cells;
+        ctx->stats.thresholds += counts->thresholds;
+        if (counts->pruned) {
+            ctx->minhash->pruned += counts->pruned;
+        }
+    }
+}
+
+/* The scratch space of the calling thread, see score_reserve() */
+static inline struct lcs_scratch *
+thread_scratch(const struct strgrp *const ctx) {
+#if HAVE_OPENMP
+    return &ctx->scratch[omp_get_thread_num()];
+#else
+    return ctx->scratch;
+#endif
+}
+
+/* The positions of the n groups to score for the current query, or NULL to
+ * score all of them */
+static inline const uint32_t *
+score_candidates(const struct strgrp *const ctx, int *const n) {
+    const struct partition_bucket *const bucket =
+        ctx->partition ? ctx->partition->bucket : NULL;
+    *n = bucket ? (int)darray_size(bucket->grps) : ctx->n_grps;
+    return bucket ? bucket->grps.item : NULL;
+}
+
+/* The scoring functions share the groups between the threads of the
+ * enclosing parallel region, see score() */
+static void
+grps_score(struct strgrp *const ctx, const struct lcs_pattern *const p) {
+    const struct minhash_index *const minhash = ctx->minhash;
+    const int chunk = ctx->schedule.chunk;
+    struct lcs_scratch *const scratch = thread_scratch(ctx);
+    struct score_counts counts = { 0 };
+    int n, j;
+    const uint32_t *const ids = score_candidates(ctx, &n);
+// Keep ccanlint happy in reduced feature mode
+#if HAVE_OPENMP
+    #pragma omp for schedule(dynamic, chunk) nowait
+#endif
+    for (j = 0; j < n; j++) {
+        const int i = ids ? (int)ids[j] : j;
+        double score;
+        col_at(ctx, score, i) = -1.0;
+        col_at(ctx, epoch, i) = ctx->epoch;
+        if (!col_at(ctx, n_items, i)) {
+            continue;
+        }
+        counts.scanned++;
+        if (!should_grp_score_minhash(minhash, i)) {
+            counts.pruned++;
+        } else if (grp_measure(ctx, i, p, ctx->threshold, scratch, &counts,
+                    &score)) {
+            grp_scored(ctx, i, score, ctx->threshold);
+        }
+    }
+    /* The loop doesn't wait, so the scores are complete once every thread
+     * has flushed its batches, and the cache may then be written */
+    lcs_batches_flush(ctx, p, scratch);
+#if HAVE_OPENMP
+    #pragma omp barrier
+#endif
+    score_cache_merge(ctx->cache, scratch);
+    score_counts_add(ctx, &counts);
+}
+
+/* Maintain the minimum pairwise similarity of the group's items
+ * incrementally, comparing only the items added since the last update against
+ * their predecessors. If ctx->samples is set each new item is compared against
+ * at most that many predecessors, evenly spaced through the group. Items are
+ * compared by the instance's metric, but not screened: building the profiles
+ * of the items costs more than the LCS they would save. */
+static void
+grp_update_threshold(const struct strgrp *const ctx, struct strgrp_grp *grp,
+        struct lcs_scratch *const scratch, struct score_counts *const counts) {
+    double low = grp->low;
+    ssize_t i;
+    counts->thresholds++;
+    for (i = grp->n_low; i < (ssize_t)darray_size(grp->variants); i++) {
+        const struct strgrp_variant *a = darray_item(grp->variants, i);
+        const ssize_t n = (ctx->samples > 0 && i > ctx->samples) ?
+            ctx->samples : i;
+        struct lcs_pattern pa;
+        ssize_t k;
+        bool ready;
+        if (ctx->metric == STRGRP_METRIC_LCS) {
+            ready = lcs_pattern_init(&pa, a->key, a->key_len, &scratch->masks);
+        } else {
+            pa.profile = metric_scratch_profile(&scratch->items[0], a->key,
+                    a->key_len);
+            ready = pa.profile != NULL;
+        }
+        if (!ready) {
+            break;
+        }
+        for (k = 0; k < n; k++) {
+            const struct strgrp_variant *b =
+                darray_item(grp->variants, k * i / n);
+            double score;
+            if (ctx->metric == STRGRP_METRIC_LCS) {
+                score = nlcs(&pa, b->key, b->key_len, scratch);
+                counts->lcs++;
+                counts->cells += pa.len * b->key_len;
+            } else {
+                const struct metric_profile *const pb = metric_scratch_profile(
+                        &scratch->items[1], b->key, b->key_len);
+                if (!pb) {
+                    break;
+                }
+                score = metric_score(ctx->metric, pa.profile, pb);
+                counts->cheap++;
+            }
+            low = low < score ? low : score;
+        }
+        if (k < n) {
+            break;
+        }
+    }
+    grp->low = low;
+    grp->n_low = i;
+
+    /* Adjust low to capture extra variation */
+    low -= 0.03;
+    grp_col(grp, threshold) = low > ctx->threshold ? low : ctx->threshold;
+}
+
+static void
+grps_score_dynamic(struct strgrp *const ctx,
+        const struct lcs_pattern *const p) {
+    const struct minhash_index *const minhash = ctx->minhash;
+    const int chunk = ctx->schedule.chunk;
+    struct lcs_scratch *const scratch = thread_scratch(ctx);
+    struct score_counts counts = { 0 };
+    int n, j;
+    const uint32_t *const ids = score_candidates(ctx, &n);
+// Keep ccanlint happy in reduced feature mode
+#if HAVE_OPENMP
+    #pragma omp for schedule(dynamic, chunk) nowait
+#endif
+    for (j = 0; j < n; j++) {
+        const int i = ids ? (int)ids[j] : j;
+        double score;
+        col_at(ctx, score, i) = -2.0;
+        col_at(ctx, epoch, i) = ctx->epoch;
+        if (!col_at(ctx, n_items, i)) {
+            continue;
+        }
+        counts.scanned++;
+        /* Pruned groups defer updating their threshold until scored */
+        if (!should_grp_score_minhash(minhash, i)) {
+            counts.pruned++;
+            continue;
+        }
+        if (col_at(ctx, dirty, i)) {
+            grp_update_threshold(ctx, darray_item(ctx->grps, i), scratch,
+                    &counts);
+            col_at(ctx, dirty, i) = false;
+        }
+        if (grp_measure(ctx, i, p, col_at(ctx, threshold, i), scratch,
+                    &counts, &score)) {
+            grp_scored(ctx, i, score, col_at(ctx, threshold, i));
+        }
+    }
+    /* See grps_score() */
+    lcs_batches_flush(ctx, p, scratch);
+#if HAVE_OPENMP
+    #pragma omp barrier
+#endif
+    score_cache_merge(ctx->cache, scratch);
+    score_counts_add(ctx, &counts);
+}
+
+struct strgrp *
+strgrp_new_dynamic(const double threshold, int size) {
+    struct strgrp *ctx = talz(NULL, struct strgrp);
+    if (!ctx) {
+        return NULL;
+    }
+    ctx->pool = block_pool_new(NULL);
+    ctx->keys = block_pool_new(NULL);
+    ctx->scratch = tal_arrz(ctx, struct lcs_scratch, 1);
+    if (!ctx->pool || !ctx->keys || !ctx->scratch) {
+        if (ctx->pool) {
+            block_pool_free(ctx->pool);
+        }
+        if (ctx->keys) {
+            block_pool_free(ctx->keys);
+        }
+        return tal_free(ctx);
+    }
+    ctx->threshold = threshold;
+    ctx->size = size;
+    ctx->score = size > 0 ? grps_score_dynamic : grps_score;
+    ctx->schedule.chunk = 1;
+    /* The SIMD kernels are opt-in as they are rarely faster, see
+     * strgrp_kernel() */
+    ctx->kernel = STRGRP_KERNEL_SCALAR;
+    known_table_init(&ctx->known);
+    variant_table_init(&ctx->variants);
+    list_head_init(&ctx->iters);
+    // n threads compare strings
+    darray_init(ctx->grps);
+    grp_cols_init(&ctx->cols);
+    return ctx;
+}
+
+struct strgrp *
+strgrp_new(const double threshold) {
+    return strgrp_new_dynamic(threshold, 0);
+}
+
+bool
+strgrp_index_qgrams(struct strgrp *const ctx, const int q) {
+    struct qgram_index *idx;
+    int i;
+    if (q < 1 || q > QGRAM_MAX) {
+        return false;
+    }
+    idx = new_qgram_index(ctx, q);
+    if (!idx) {
+        return false;
+    }
+    for (i = 0; i < ctx->n_grps; i++) {
+        const struct strgrp_grp *grp = darray_item(ctx->grps, i);
+        /* Dissolved groups keep their position but are not indexed */
+        if (!grp_col(grp, n_items)) {
+            darray_push(idx->shared, 0);
+            continue;
+        }
+        if (!qgram_index_add(idx, i, grp->key, grp_col(grp, key_len))) {
+            tal_free(idx);
+            return false;
+        }
+    }
+    tal_free(ctx->qgrams);
+    ctx->qgrams = idx;
+    return true;
+}
+
+bool
+strgrp_index_minhash(struct strgrp *const ctx, const int bands,
+        const int rows) {
+    struct minhash_index *idx;
+    int i;
+    if (bands < 1 || rows < 1 || bands * rows > MINHASH_MAX) {
+        return false;
+    }
+    idx = new_minhash_index(ctx, bands, rows);
+    if (!idx) {
+        return false;
+    }
+    for (i = 0; i < ctx->n_grps; i++) {
+        const struct strgrp_grp *grp = darray_item(ctx->grps, i);
+        if (!grp_col(grp, n_items)) {
+            darray_push(idx->marks, 0);
+            continue;
+        }
+        if (!minhash_index_add(idx, i, grp->key, grp_col(grp, key_len))) {
+            tal_free(idx);
+            return false;
+        }
+    }
+    if (ctx->minhash) {
+        idx->pruned = ctx->minhash->pruned;
+    }
+    tal_free(ctx->minhash);
+    ctx->minhash = idx;
+    return true;
+}
+
+bool
+strgrp_partition(struct strgrp *const ctx, const char *const *const prefixes,
+        const size_t n_prefixes, const int tokens) {
+    struct partition *part;
+    size_t *keys;
+    int i;
+    if (tokens < 0) {
+        return false;
+    }
+    if (!tokens) {
+        ctx->partition = tal_free(ctx->partition);
+        return true;
+    }
+    part = new_partition(ctx, prefixes, n_prefixes, tokens);
+    keys = part ? tal_arr(part, size_t, ctx->n_grps) : NULL;
+    if (!keys) {
+        tal_free(part);
+        return false;
+    }
+    for (i = 0; i < ctx->n_grps; i++) {
+        const struct strgrp_grp *grp = darray_item(ctx->grps, i);
+        keys[i] = partition_key(part, grp->key);
+        if (grp_col(grp, n_items) && !partition_add(part, i, keys[i])) {
+            tal_free(part);
+            return false;
+        }
+    }
+    for (i = 0; i < ctx->n_grps; i++) {
+        darray_item(ctx->grps, i)->part = keys[i];
+    }
+    tal_free(keys);
+    tal_free(ctx->partition);
+    ctx->partition = part;
+    return true;
+}
+
+bool
+strgrp_sample_threshold(struct strgrp *const ctx, const int samples) {
+    struct strgrp_grp **grp;
+    if (samples < 0) {
+        return false;
+    }
+    ctx->samples = samples;
+    /* Recompute existing thresholds under the new sampling */
+    darray_foreach(grp, ctx->grps) {
+        (*grp)->low = 1.0;
+        (*grp)->n_low = 0;
+        grp_col(*grp, dirty) =
+            ctx->size > 0 && grp_col(*grp, n_items) >= ctx->size;
+    }
+    return true;
+}
+
+bool
+strgrp_metric(struct strgrp *const ctx, const enum strgrp_metric metric,
+        const enum strgrp_metric screen, const double margin) {
+    const bool profiled = metric_profiled(metric, screen);
+    struct strgrp_grp **grp;
+    if ((unsigned)metric > STRGRP_METRIC_COSINE ||
+            (unsigned)screen > STRGRP_METRIC_COSINE ||
+            (screen != metric && metric != STRGRP_METRIC_LCS) ||
+            !(margin >= 0)) {
+        return false;
+    }
+    /* Profiles are kept for all groups or none */
+    if (profiled && !metric_profiled(ctx->metric, ctx->screen)) {
+        darray_foreach(grp, ctx->grps) {
+            (*grp)->profile = new_metric_profile(*grp, (*grp)->key,
+                    grp_col(*grp, key_len));
+            if (!(*grp)->profile) {
+                darray_foreach(grp, ctx->grps) {
+                    (*grp)->profile = tal_free((*grp)->profile);
+                }
+                return false;
+            }
+        }
+    } else if (!profiled) {
+        darray_foreach(grp, ctx->grps) {
+            (*grp)->profile = tal_free((*grp)->profile);
+        }
+    }
+    ctx->metric = metric;
+    ctx->screen = screen;
+    ctx->margin = margin;
+    /* Thresholds measured by another metric no longer apply */
+    darray_foreach(grp, ctx->grps) {
+        grp_reset_threshold(ctx, *grp);
+    }
+    return true;
+}
+
+void
+strgrp_get_metric(const struct strgrp *const ctx,
+        enum strgrp_metric *const metric, enum strgrp_metric *const screen,
+        double *const margin) {
+    *metric = ctx->metric;
+    *screen = ctx->screen;
+    *margin = ctx->margin;
+}
+
+bool
+strgrp_kernel(struct strgrp *const ctx, const enum strgrp_kernel kernel) {
+    if ((unsigned)kernel > STRGRP_KERNEL_AVX512 ||
+            !lcs_kernel_supported(kernel)) {
+        return false;
+    }
+    ctx->kernel = kernel;
+    return true;
+}
+
+enum strgrp_kernel
+strgrp_get_kernel(const struct strgrp *const ctx, int *const lanes) {
+    if (lanes) {
+        *lanes = lcs_kernels[ctx->kernel].lanes;
+    }
+    return ctx->kernel;
+}
+
+bool
+strgrp_schedule(struct strgrp *const ctx, const int threads, const int chunk,
+        const unsigned int serial, const bool autotune) {
+    struct score_schedule *const sched = &ctx->schedule;
+    if (threads < 0 || chunk < 1) {
+        return false;
+    }
+    sched->threads = threads;
+    sched->chunk = chunk;
+    sched->serial = serial;
+    sched->autotune = autotune;
+    sched->cost[0] = sched->cost[1] = 0;
+    sched->calls = 0;
+    return true;
+}
+
+void
+strgrp_get_schedule(const struct strgrp *const ctx, int *const threads,
+        int *const chunk, unsigned int *const serial, bool *const autotune) {
+    *threads = ctx->schedule.threads;
+    *chunk = ctx->schedule.chunk;
+    *serial = ctx->schedule.serial;
+    *autotune = ctx->schedule.autotune;
+}
+
+unsigned long
+strgrp_minhash_pruned(const struct strgrp *const ctx) {
+    return ctx->minhash ? ctx->minhash->pruned : 0;
+}
+
+void
+strgrp_stats(const struct strgrp *const ctx, struct strgrp_stats *const stats) {
+    *stats = ctx->stats;
+}
+
+void
+strgrp_stats_reset(struct strgrp *const ctx) {
+    memset(&ctx->stats, 0, sizeof(ctx->stats));
+}
+
+/* Prepare to score the groups against the query identified by
+ * lcs_pattern_key(), querying the candidate filters */
+static bool
+score_prepare(struct strgrp *const ctx, struct lcs_pattern *const p) {
+    const double start = now();
+    if (!lcs_pattern_init(p, p->str, p->len, &ctx->pattern)) {
+        return false;
+    }
+    if (metric_profiled(ctx->metric, ctx->screen)) {
+        p->profile = metric_scratch_profile(&ctx->query, p->str, p->len);
+        if (!p->profile) {
+            return false;
+        }
+    }
+    qgram_index_count(ctx->qgrams, p->str, p->len);
+    minhash_index_mark(ctx->minhash, p->str, p->len);
+    if (ctx->partition) {
+        const size_t key = partition_key(ctx->partition, p->str);
+        ctx->partition->bucket =
+            partition_table_get(&ctx->partition->table, &key);
+        /* A merchant without groups can only be found among all groups */
+        ctx->stats.widened += !ctx->partition->bucket;
+    }
+    ctx->epoch++;
+    ctx->stats.searches++;
+    ctx->stats.prepare_time += now() - start;
+    return true;
+}
+
+/* Provide each of up to n threads with scratch space, returning the number
+ * of threads that have it */
+static int
+score_reserve(struct strgrp *const ctx, const int n) {
+    const size_t have = tal_count(ctx->scratch);
+    if ((size_t)n > have && !tal_resizez(&ctx->scratch, n)) {
+        return have;
+    }
+    return n;
+}
+
+/* The number of threads to share the scoring of the groups */
+static int
+score_threads(struct strgrp *const ctx) {
+#if HAVE_OPENMP
+    if (ctx->n_grps < ctx->schedule.serial) {
+        return 1;
+    }
+    return score_reserve(ctx, ctx->schedule.threads ?
+            ctx->schedule.threads : omp_get_max_threads());
+#else
+    return 1;
+#endif
+}
+
+#define SCHEDULE_EXPLORE 16
+#define SCHEDULE_WEIGHT 0.125
+
+/* Entering a parallel region costs more than scoring a small number of groups
+ * serially. When tuning, every SCHEDULE_EXPLORE'th search is scored the other
+ * way to maintain moving averages of the cost per group of each, and the
+ * threshold is moved to the current number of groups if the other way proves
+ * cheaper. A partitioned search counts the groups of the query's bucket. */
+static void
+score_grps_scheduled(struct strgrp *const ctx,
+        const struct lcs_pattern *const p) {
+    struct score_schedule *const sched = &ctx->schedule;
+    int n, threads;
+#if HAVE_OPENMP
+    int team;
+    bool parallel;
+    double cost;
+#endif
+
+    score_candidates(ctx, &n);
+    threads = (unsigned)n < sched->serial ? 1 : score_threads(ctx);
+#if HAVE_OPENMP
+    team = score_reserve(ctx,
+            sched->threads ? sched->threads : omp_get_max_threads());
+    parallel = threads > 1;
+
+    if (!sched->autotune || !n || team < 2) {
+        #pragma omp parallel if (parallel) num_threads(threads)
+        ctx->score(ctx, p);
+        return;
+    }
+
+    if (!(++sched->calls % SCHEDULE_EXPLORE)) {
+        parallel = !parallel;
+    }
+    cost = omp_get_wtime();
+    #pragma omp parallel if (parallel) num_threads(team)
+    ctx->score(ctx, p);
+    cost = (omp_get_wtime() - cost) / n;
+    sched->cost[parallel] = sched->cost[parallel] ?
+        sched->cost[parallel] + SCHEDULE_WEIGHT * (cost - sched->cost[parallel]) :
+        cost;
+
+    if (!sched->cost[0] || !sched->cost[1]) {
+        return;
+    }
+    if ((unsigned)n < sched->serial && sched->cost[1] < sched->cost[0]) {
+        sched->serial = n;
+    } else if ((unsigned)n >= sched->serial && sched->cost[0] < sched->cost[1]) {
+        sched->serial = n + n / 4 + 1;
+    }
+#else
+    (void)sched;
+    (void)threads;
+    ctx->score(ctx, p);
+#endif
+}
+
+static struct strgrp_grp *
+grp_best(const struct strgrp *const ctx);
+
+/* Widen a partitioned search to all groups if the query's bucket has no
+ * acceptable group. Returns true if the groups must be scored again. */
+static bool
+score_widen(struct strgrp *const ctx) {
+    struct partition *const part = ctx->partition;
+    if (!part || !part->bucket || grp_best(ctx)) {
+        return false;
+    }
+    part->bucket = NULL;
+    ctx->stats.widened++;
+    return true;
+}
+
+static void
+score_grps(struct strgrp *const ctx, const struct lcs_pattern *const p) {
+    const double start = now();
+    score_grps_scheduled(ctx, p);
+    if (score_widen(ctx)) {
+        score_grps_scheduled(ctx, p);
+    }
+    ctx->stats.score_time += now() - start;
+}
+
+static bool
+score(struct strgrp *const ctx, const char *const str) {
+    struct lcs_pattern p;
+    lcs_pattern_key(&p, str);
+    if (!score_prepare(ctx, &p)) {
+        return false;
+    }
+    score_grps(ctx, &p);
+    return true;
+}
+
+static struct strgrp_grp *
+grp_best(const struct strgrp *const ctx) {
+    int max = -1;
+    int n, j;
+    const uint32_t *const ids = score_candidates(ctx, &n);
+    for (j = 0; j < n; j++) {
+        const int curr = ids ? (int)ids[j] : j;
+
+        if (max < 0 || col_at(ctx, score, curr) > col_at(ctx, score, max)) {
+            max = curr;
+        }
+    }
+    return (max >= 0 && col_at(ctx, score, max) >= 0) ?
+        darray_item(ctx->grps, max) : NULL;
+}
+
+/* Find the group for a known string, otherwise prepare to score the groups
+ * for it. Returns true if the groups should be scored. */
+static bool
+grp_for_prepare(struct strgrp *const ctx, struct lcs_pattern *const p,
+        const char *const str, struct strgrp_grp **const pick) {
+    lcs_pattern_key(p, str);
+    *pick = NULL;
+    if (!ctx->n_grps) {
+        return false;
+    }
+
+    *pick = known_get(ctx, p->str, p->hash);
+    if (*pick) {
+        ctx->stats.exact++;
+        return false;
+    }
+
+    if (!score_prepare(ctx, p)) {
+        perror("score");
+        return false;
+    }
+    return true;
+}
+
+static struct strgrp_grp *
+grp_for(struct strgrp *const ctx, struct lcs_pattern *const p,
+        const char *const str) {
+    struct strgrp_grp *pick;
+
+    if (!grp_for_prepare(ctx, p, str, &pick)) {
+        return pick;
+    }
+
+    score_grps(ctx, p);
+
+    return grp_best(ctx);
+}
+
+struct strgrp_grp *
+strgrp_grp_for(struct strgrp *const ctx, const char *const str) {
+    struct lcs_pattern p;
+    return grp_for(ctx, &p, str);
+}
+
+struct strgrp_grp *
+strgrp_grp_exact(struct strgrp *const ctx, const char *const str) {
+    return known_get(ctx, str, known_hash(str, strlen(str)));
+}
+
+static bool score_gt(const struct strgrp_grp *a, const struct strgrp_grp *b) {
+    return grp_col(a, score) > grp_col(b, score);
+}
+
+static bool __score_gt(const void *a, const void *b) {
+    return score_gt(a, b);
+}
+
+static bool score_lt(const struct strgrp_grp *a, const struct strgrp_grp *b) {
+    return grp_col(a, score) < grp_col(b, score);
+}
+
+static bool __score_lt(const void *a, const void *b) {
+    return score_lt(a, b);
+}
+
+struct heap *
+strgrp_grps_for(struct strgrp *const ctx, const char *const str) {
+    return strgrp_grps_top(ctx, str, 0, -INFINITY);
+}
+
+/* Collect the groups scored at least min_score, keeping the best k if k is
+ * non-zero */
+static struct heap *
+grps_heap(const struct strgrp *const ctx, const size_t k,
+        const double min_score) {
+    int n, j;
+    const uint32_t *const ids = score_candidates(ctx, &n);
+    struct heap *heap;
+
+    /* Select the best k with a min-heap, then sort descending */
+    heap = heap_init(k ? __score_lt : __score_gt);
+    if (!heap) {
+        perror("heap_init");
+        return NULL;
+    }
+
+    for (j = 0; j < n; j++) {
+        const int i = ids ? (int)ids[j] : j;
+        struct strgrp_grp *curr;
+
+        if (!col_at(ctx, n_items, i) || col_at(ctx, score, i) < min_score) {
+            continue;
+        }
+
+        curr = darray_item(ctx->grps, i);
+        if (k && heap->len == k) {
+            if (!score_gt(curr, heap_peek(heap))) {
+                continue;
+            }
+            heap_pop(heap);
+        }
+
+        if (heap_push(heap, curr)) {
+            perror("heap_push");
+            heap_free(heap);
+            return NULL;
+        }
+    }
+
+    if (k) {
+        heap_ify(heap, __score_gt);
+    }
+
+    return heap;
+}
+
+struct heap *
+strgrp_grps_top(struct strgrp *const ctx, const char *const str,
+        const size_t k, const double min_score) {
+    if (ctx->n_grps && !score(ctx, str)) {
+        perror("score");
+        return NULL;
+    }
+
+    return grps_heap(ctx, k, min_score);
+}
+
+bool
+strgrp_grp_is_acceptible(struct strgrp *ctx, struct strgrp_grp *grp) {
+    if (ctx->size > 0 && grp_col(grp, dirty)) {
+        struct score_counts counts = { 0 };
+        grp_update_threshold(ctx, grp, &ctx->scratch[0], &counts);
+        grp_col(grp, dirty) = false;
+        score_counts_add(ctx, &counts);
+    }
+
+    /* Partitioned searches leave the scores of other groups as they were */
+    if (ctx->partition && grp_col(grp, epoch) != ctx->epoch) {
+        return false;
+    }
+    return grp_col(grp, score) >= 0;
+}
+
+bool
+strgrp_grp_is_dynamic(const struct strgrp *ctx, const struct strgrp_grp *grp) {
+    return ctx->size > 0 && grp_col(grp, n_items) >= ctx->size;
+}
+
+double
+strgrp_grp_score(const struct strgrp_grp *grp) {
+    return grp_col(grp, score);
+}
+
+ssize_t
+strgrp_grp_size(const struct strgrp_grp *grp) {
+    return grp_col(grp, n_items);
+}
+
+struct strgrp_grp *
+strgrp_grp_new(struct strgrp *ctx, const char *str, void *data) {
+    struct strgrp_grp *pick = add_grp(ctx, str, data);
+    if (pick) {
+        const size_t len = strlen(str);
+        cache(ctx, pick, str, len, known_hash(str, len));
+    }
+    return pick;
+}
+
+bool
+strgrp_grp_add(struct strgrp *ctx, struct strgrp_grp *grp, const char *str,
+               void *data)
+{
+    const size_t len = strlen(str);
+    const size_t h = known_hash(str, len);
+    if (!grp_col(grp, n_items) ||
+            !add_item(ctx, grp, str, len, h, false, data))
+        return false;
+
+    cache(ctx, grp, str, len, h);
+
+    return true;
+}
+
+bool
+strgrp_grp_remove(struct strgrp *const ctx, struct strgrp_grp *const grp,
+        const size_t i, void **const data) {
+    struct strgrp_item *const item = grp_take_item(ctx, grp, i);
+    if (!item) {
+        return false;
+    }
+    if (data) {
+        *data = item->value;
+    }
+    item_free(ctx, item);
+    grps_reclaim(ctx);
+    return true;
+}
+
+bool
+strgrp_grp_move(struct strgrp *const ctx, struct strgrp_grp *const from,
+        const size_t i, struct strgrp_grp *const to) {
+    const struct strgrp_variant *from_v;
+    struct strgrp_variant *to_v;
+    struct strgrp_item *item;
+    if (!grp_col(to, n_items)) {
+        return false;
+    }
+    if (from == to) {
+        return i < (size_t)grp_col(from, n_items);
+    }
+    if (i >= (size_t)grp_col(from, n_items)) {
+        return false;
+    }
+    /* Provide the item's variant in to first, as it may fail to allocate */
+    from_v = darray_item(from->items, i)->variant;
+    to_v = grp_variant_enter(ctx, to, from_v->key, from_v->key_len,
+            from_v->hash, false);
+    if (!to_v) {
+        return false;
+    }
+    item = grp_take_item(ctx, from, i);
+    if (!item) {
+        if (!to_v->count) {
+            grp_variant_drop(ctx, to, to_v);
+        }
+        return false;
+    }
+    append_item(ctx, to, item, to_v);
+    cache(ctx, to, to_v->key, to_v->key_len, to_v->hash);
+    grps_reclaim(ctx);
+    return true;
+}
+
+bool
+strgrp_grp_rekey(struct strgrp *const ctx, struct strgrp_grp *const grp,
+        const size_t i) {
+    const struct strgrp_item *item;
+    if (i >= (size_t)grp_col(grp, n_items)) {
+        return false;
+    }
+    item = darray_item(grp->items, i);
+    return streq(item->variant->key, grp->key) ||
+        grp_set_key(ctx, grp, item->variant->key);
+}
+
+void
+strgrp_grp_dissolve(struct strgrp *const ctx, struct strgrp_grp *const grp,
+        void (*cb)(void *data)) {
+    if (grp_col(grp, n_items)) {
+        grp_dissolve(ctx, grp, cb);
+        grps_reclaim(ctx);
+    }
+}
+
+void
+strgrp_grp_hold(struct strgrp_grp *const grp) {
+    if (!grp->holds++ && !grp_col(grp, n_items)) {
+        grp->ctx->n_dissolved--;
+    }
+}
+
+void
+strgrp_grp_release(struct strgrp_grp *const grp) {
+    if (!--grp->holds && !grp_col(grp, n_items)) {
+        grp->ctx->n_dissolved++;
+    }
+}
+
+/* Add the query identified by lcs_pattern_key() to pick, or to a new group */
+static struct strgrp_grp *
+insert(struct strgrp *const ctx, struct strgrp_grp *pick,
+        const struct lcs_pattern *const p, void *const data) {
+    const double start = now();
+    if (pick) {
+        if (!add_item(ctx, pick, p->str, p->len, p->hash, false, data)) {
+            return NULL;
+        }
+    } else {
+        pick = add_grp(ctx, p->str, data);
+        if (!pick) {
+            return NULL;
+        }
+    }
+    cache(ctx, pick, p->str, p->len, p->hash);
+    ctx->stats.insert_time += now() - start;
+    return pick;
+}
+
+static struct strgrp_grp *
+add(struct strgrp *const ctx, const char *const str, void *const data) {
+    struct lcs_pattern p;
+    struct strgrp_grp *const pick = grp_for(ctx, &p, str);
+    return insert(ctx, pick, &p, data);
+}
+
+struct strgrp_grp *
+strgrp_add(struct strgrp *const ctx, const char *const str, void *const data) {
+    return add(ctx, str, data);
+}
+
+/* Batched operations
+ *
+ * Each string must be scored and acted upon in turn, as adding it changes the
+ * groups the next is scored against. Rather than entering a parallel region
+ * for each string, the batched operations enter one for the whole batch: a
+ * single thread prepares each string and acts on its scores, while the team
+ * shares the scoring of the groups.
+ */
+size_t
+strgrp_add_many(struct strgrp *const ctx, const char *const *const strs,
+        void *const *const data, const size_t n,
+        struct strgrp_grp **const grps) {
+    const bool partitioned = ctx->partition != NULL;
+    struct lcs_pattern p;
+    bool scored = false;
+    bool widen = false;
+    size_t done = 0;
+    bool ok = true;
+    double start = 0;
+    int threads;
+
+    /* Groups are only added, so once there are enough to share the scoring
+     * they remain so */
+    while (done < n && score_threads(ctx) < 2) {
+        grps[done] = add(ctx, strs[done], data[done]);
+        if (!grps[done]) {
+            return done;
+        }
+        done++;
+    }
+    threads = score_threads(ctx);
+
+#if HAVE_OPENMP
+    #pragma omp parallel if (threads > 1) num_threads(threads)
+#endif
+    {
+        size_t j;
+        for (j = done; ok && j < n; j++) {
+#if HAVE_OPENMP
+            #pragma omp single
+#endif
+            {
+                scored = grp_for_prepare(ctx, &p, strs[j], &grps[j]);
+                start = now();
+            }
+            if (scored) {
+                ctx->score(ctx, &p);
+            }
+            if (partitioned) {
+#if HAVE_OPENMP
+                #pragma omp single
+#endif
+                widen = scored && score_widen(ctx);
+                if (widen) {
+                    ctx->score(ctx, &p);
+                }
+            }
+#if HAVE_OPENMP
+            #pragma omp single
+#endif
+            {
+                if (scored) {
+                    ctx->stats.score_time += now() - start;
+                    grps[j] = grp_best(ctx);
+                }
+                grps[j] = insert(ctx, grps[j], &p, data[j]);
+                ok = NULL != grps[j];
+                done += ok;
+            }
+        }
+    }
+
+    return done;
+}
+
+size_t
+strgrp_grps_top_many(struct strgrp *const ctx, const char *const *const strs,
+        const size_t n, const size_t k, const double min_score,
+        bool (*cb)(void *arg, size_t i, struct heap *heap), void *const arg) {
+    const bool partitioned = ctx->partition != NULL;
+    struct lcs_pattern p;
+    bool scored = false;
+    bool widen = false;
+    bool failed = false;
+    size_t done = 0;
+    bool ok = true;
+    double start = 0;
+    const int threads = score_threads(ctx);
+
+    /* The team tests ok for each string, so only write it after scoring */
+#if HAVE_OPENMP
+    #pragma omp parallel if (threads > 1) num_threads(threads)
+#endif
+    {
+        size_t j;
+        for (j = 0; ok && j < n; j++) {
+#if HAVE_OPENMP
+            #pragma omp single
+#endif
+            {
+                lcs_pattern_key(&p, strs[j]);
+                scored = ctx->n_grps && score_prepare(ctx, &p);
+                failed = ctx->n_grps && !scored;
+                if (failed) {
+                    perror("score");
+                }
+                start = now();
+            }
+            if (scored) {
+                ctx->score(ctx, &p);
+            }
+            if (partitioned) {
+#if HAVE_OPENMP
+                #pragma omp single
+#endif
+                widen = scored && score_widen(ctx);
+                if (widen) {
+                    ctx->score(ctx, &p);
+                }
+            }
+#if HAVE_OPENMP
+            #pragma omp single
+#endif
+            {
+                struct heap *heap;
+                if (scored) {
+                    ctx->stats.score_time += now() - start;
+                }
+                heap = failed ? NULL : grps_heap(ctx, k, min_score);
+                ok = heap && cb(arg, j, heap);
+                done += ok;
+                if (heap) {
+                    heap_free(heap);
+                }
+            }
+        }
+    }
+
+    return done;
 }
 
-#undef ROWS
+/* Snapshots
+ *
+ * A snapshot records the groups, their items and dynamic thresholds, and the
+ * items referenced by the known map, so an instance can be restored without
+ * scoring. Keys are referenced by offset and are used in place on load, so a
+ * snapshot can be mapped from a file and used directly. Offsets are relative
+ * to the start of the snapshot, sections are aligned to 8 bytes, and values
+ * are in native byte order:
+ *
+ *     header | keys | values | groups | items
+ *
+ * The items of each group are contiguous, in the order of the groups. Items
+ * bearing the same string in a group share its key, and n_low counts the
+ * group's distinct strings in the order they were first added. The
+ * prefixes of the partition lead the keys section, one after another. The
+ * candidate indexes and the partition are rebuilt from the group keys on load.
+ */
+#define SNAPSHOT_MAGIC "strgrp\0\0"
+#define SNAPSHOT_VERSION 4
+#define SNAPSHOT_BYTE_ORDER 0x01020304u
+#define SNAPSHOT_ALIGN 8
 
-static inline double
-nlcs(const char *const a, const char *const b) {
-    const double lcss = lcs(a, b);
-    const double la = (double) strlen(a);
-    const double lb = (double) strlen(b);
-    const double s = sqrt((2 * lcss * lcss) / (la * la + lb * lb));
-    return s;
-}
+struct snapshot_header {
+    char magic[8];
+    uint32_t version;
+    uint32_t byte_order;
+    double threshold;
+    double margin;
+    int32_t size;
+    int32_t samples;
+    int32_t q;
+    int32_t bands;
+    int32_t rows;
+    int32_t metric;
+    int32_t screen;
+    int32_t tokens;
+    uint32_t n_prefixes;
+    uint32_t n_grps;
+    uint64_t n_items;
+    uint64_t grps;
+    uint64_t items;
+    uint64_t prefixes;
+};
 
-static inline double
-grp_score(const struct strgrp_grp *const grp, const char *const str) {
-    return nlcs(grp->key, str);
-}
+struct snapshot_grp {
+    uint64_t key;
+    uint64_t n_items;
+    double threshold;
+    double low;
+    uint64_t n_low;
+    uint32_t dirty;
+    uint32_t pad;
+};
 
-/* Structure management */
+struct snapshot_item {
+    uint64_t key;
+    uint64_t value;
+    uint64_t value_len;
+    uint32_t known;
+    uint32_t pad;
+};
 
-static struct strgrp_item *
-new_item(tal_t *const tctx, const char *const str, void *const data) {
-    struct strgrp_item *i = talz(tctx, struct strgrp_item);
-    if (!i) {
-        return NULL;
-    }
-    i->key = tal_strdup(i, str);
-    i->value = data;
-    return i;
+static bool
+snapshot_write(FILE *const f, const void *const data, const size_t len) {
+    return !len || fwrite(data, len, 1, f) == 1;
 }
 
+/* Provide the offset of the stream relative to the snapshot start */
 static bool
-add_item(const struct strgrp *const ctx, struct strgrp_grp *const grp,
-        const char *const str, void *const data) {
-    struct strgrp_item *i = new_item(grp, str, data);
-    if (!i) {
+snapshot_tell(FILE *const f, const long start, uint64_t *const off) {
+    const long pos = ftell(f);
+    if (pos < start) {
         return false;
     }
-    darray_push(grp->items, i);
-    grp->n_items++;
-    grp->dirty = grp->n_items >= ctx->size;
+    *off = pos - start;
     return true;
 }
 
-static void
-free_grp(struct strgrp_grp *grp) {
-    darray_free(grp->items);
+static bool
+snapshot_align(FILE *const f, const long start) {
+    static const char zeros[SNAPSHOT_ALIGN];
+    uint64_t off;
+    if (!snapshot_tell(f, start, &off)) {
+        return false;
+    }
+    return !(off % SNAPSHOT_ALIGN) ||
+        snapshot_write(f, zeros, SNAPSHOT_ALIGN - off % SNAPSHOT_ALIGN);
 }
 
-static struct strgrp_grp *
-new_grp(const struct strgrp *const ctx, const char *const str,
-        void *const data) {
-    struct strgrp_grp *b = talz(ctx, struct strgrp_grp);
-    if (!b) {
-        return NULL;
+bool
+strgrp_save(struct strgrp *const ctx, FILE *const f,
+        bool (*cb)(void *arg, void *value, FILE *f), void *const arg) {
+    struct snapshot_header header = { SNAPSHOT_MAGIC };
+    struct snapshot_grp *grps = NULL;
+    struct snapshot_item *items = NULL;
+    /* The key records of the variants of a group */
+    struct snapshot_item *keys = NULL;
+    size_t n_keys = 0;
+    struct strgrp_grp *const *grp;
+    struct strgrp_item *const *item;
+    const long start = ftell(f);
+    uint64_t n_items = 0;
+    uint64_t end;
+    size_t i, j, k;
+    bool ok = false;
+
+    if (start < 0) {
+        return false;
     }
-    b->key = tal_strdup(b, str);
-    b->key_len = strlen(str);
-    b->n_items = 0;
-    b->threshold = ctx->threshold;
-    b->dirty = false;
-    darray_init(b->items);
-    tal_add_destructor(b, free_grp);
-    if (!add_item(ctx, b, str, data)) {
-        return tal_free(b);
+    darray_foreach(grp, ctx->grps) {
+        n_items += grp_col(*grp, n_items);
     }
-    return b;
-}
-
-static struct strgrp_grp *
-add_grp(struct strgrp *const ctx, const char *const str,
-        void *const data) {
-    struct strgrp_grp *b = new_grp(ctx, str, data);
-    if (!b) {
-        return NULL;
+    grps = calloc(ctx->n_grps + 1, sizeof(*grps));
+    items = calloc(n_items + 1, sizeof(*items));
+    if (!grps || !items) {
+        goto cleanup;
     }
-    darray_push(ctx->grps, b);
-    ctx->n_grps++;
-    return b;
-}
-
-static inline void
-cache(struct strgrp *const ctx, struct strgrp_grp *const grp,
-        const char *const str) {
-    *(stringmap_enter(ctx->known, str)) = grp;
-}
 
-static void
-grps_score(struct strgrp *const ctx, const char *const str) {
-    int i;
-// Keep ccanlint happy in reduced feature mode
-#if HAVE_OPENMP
-    #pragma omp parallel for schedule(dynamic)
-#endif
-    for (i = 0; i < ctx->n_grps; i++) {
-        struct strgrp_grp *grp = darray_item(ctx->grps, i);
-        grp->score = -1.0;
-        if (should_grp_score_len(ctx->threshold, grp, str)) {
-            grp->score = grp_score(grp, str) - ctx->threshold;
-        }
+    header.version = SNAPSHOT_VERSION;
+    header.byte_order = SNAPSHOT_BYTE_ORDER;
+    header.threshold = ctx->threshold;
+    header.size = ctx->size;
+    header.samples = ctx->samples;
+    header.q = ctx->qgrams ? ctx->qgrams->q : 0;
+    header.bands = ctx->minhash ? ctx->minhash->bands : 0;
+    header.rows = ctx->minhash ? ctx->minhash->rows : 0;
+    header.metric = ctx->metric;
+    header.screen = ctx->screen;
+    header.margin = ctx->margin;
+    header.tokens = ctx->partition ? ctx->partition->tokens : 0;
+    header.n_prefixes =
+        ctx->partition ? tal_count(ctx->partition->prefixes) : 0;
+    header.n_grps = ctx->n_grps;
+    header.n_items = n_items;
+    /* Reserve the header, which is written once the offsets are known */
+    if (!snapshot_write(f, &header, sizeof(header)) ||
+            !snapshot_tell(f, start, &header.prefixes)) {
+        goto cleanup;
     }
-}
-
-static void
-grp_update_threshold(const struct strgrp *const ctx, struct strgrp_grp *grp) {
-    double low = 1.0;
-    ssize_t i;
-    for (i = 0; i < grp->n_items; i++) {
-        struct strgrp_item *a = darray_item(grp->items, i);
-	int32_t j;
-	for (j = i + 1; j < grp->n_items; j++) {
-	    struct strgrp_item *b = darray_item(grp->items, j);
-	    double score;
-	    score = nlcs(a->key, b->key);
-	    low = low < score ? low : score;
-	}
+    for (i = 0; i < header.n_prefixes; i++) {
+        const char *const prefix = ctx->partition->prefixes[i];
+        if (!snapshot_write(f, prefix, strlen(prefix) + 1)) {
+            goto cleanup;
+        }
     }
 
-    /* Adjust low to capture extra variation */
-    low -= 0.03;
-    grp->threshold = low > ctx->threshold ? low : ctx->threshold;
-}
-
-static void
-grps_score_dynamic(struct strgrp *const ctx, const char *const str) {
-    int i;
-// Keep ccanlint happy in reduced feature mode
-#if HAVE_OPENMP
-    #pragma omp parallel for schedule(dynamic)
-#endif
-    for (i = 0; i < ctx->n_grps; i++) {
-        struct strgrp_grp *grp = darray_item(ctx->grps, i);
-        grp->score = -2.0;
-        if (grp->dirty) {
-            grp_update_threshold(ctx, grp);
-            grp->dirty = false;
+    i = 0;
+    j = 0;
+    darray_foreach(grp, ctx->grps) {
+        struct snapshot_grp *const rec = &grps[i++];
+        if (!snapshot_tell(f, start, &rec->key) ||
+                !snapshot_write(f, (*grp)->key, grp_col(*grp, key_len) + 1)) {
+            goto cleanup;
+        }
+        rec->n_items = grp_col(*grp, n_items);
+        rec->threshold = grp_col(*grp, threshold);
+        rec->low = (*grp)->low;
+        rec->n_low = (*grp)->n_low;
+        rec->dirty = grp_col(*grp, dirty);
+        if (darray_size((*grp)->variants) > n_keys) {
+            struct snapshot_item *const grown = realloc(keys,
+                    darray_size((*grp)->variants) * sizeof(*keys));
+            if (!grown) {
+                goto cleanup;
+            }
+            keys = grown;
+            n_keys = darray_size((*grp)->variants);
         }
-        if (should_grp_score_len(grp->threshold, grp, str)) {
-            const double score = grp_score(grp, str);
-            const double threshold = score >= grp->threshold ?
-                ctx->threshold : grp->threshold;
-            grp->score = score - threshold;
+        for (k = 0; k < darray_size((*grp)->variants); k++) {
+            struct strgrp_variant *const v = darray_item((*grp)->variants, k);
+            if (!snapshot_tell(f, start, &keys[k].key) ||
+                    !snapshot_write(f, v->key, v->key_len + 1)) {
+                goto cleanup;
+            }
+            keys[k].known = known_get(ctx, v->key, v->hash) == *grp;
+            v->slot = k;
+        }
+        darray_foreach(item, (*grp)->items) {
+            k = (*item)->variant->slot;
+            items[j].key = keys[k].key;
+            items[j++].known = keys[k].known;
         }
     }
-}
-
-struct strgrp *
-strgrp_new_dynamic(const double threshold, int size) {
-    struct strgrp *ctx = talz(NULL, struct strgrp);
-    ctx->threshold = threshold;
-    ctx->size = size;
-    ctx->score = size > 0 ? grps_score_dynamic : grps_score;
-    stringmap_init(ctx->known, NULL);
-    // n threads compare strings
-    darray_init(ctx->grps);
-    return ctx;
-}
-
-struct strgrp *
-strgrp_new(const double threshold) {
-    return strgrp_new_dynamic(threshold, 0);
-}
-
-static struct strgrp_grp *
-grp_for(struct strgrp *const ctx, const char *const str) {
-    int i;
-
-    if (!ctx->n_grps) {
-        return NULL;
+    if (!snapshot_align(f, start)) {
+        goto cleanup;
     }
-    {
-        struct strgrp_grp **const grp = stringmap_lookup(ctx->known, str);
-        if (grp) {
-            return *grp;
+
+    j = 0;
+    darray_foreach(grp, ctx->grps) {
+        darray_foreach(item, (*grp)->items) {
+            struct snapshot_item *const rec = &items[j++];
+            if (!snapshot_tell(f, start, &rec->value) ||
+                    (cb && !cb(arg, (*item)->value, f)) ||
+                    !snapshot_tell(f, start, &end)) {
+                goto cleanup;
+            }
+            rec->value_len = end - rec->value;
         }
     }
+    if (!snapshot_align(f, start)) {
+        goto cleanup;
+    }
 
-    ctx->score(ctx, str);
-
-    struct strgrp_grp *max = NULL;
-    for (i = 0; i < ctx->n_grps; i++) {
-        struct strgrp_grp *curr = darray_item(ctx->grps, i);
-
-        if (!max || curr->score > max->score) {
-            max = curr;
-        }
+    if (!snapshot_tell(f, start, &header.grps) ||
+            !snapshot_write(f, grps, ctx->n_grps * sizeof(*grps)) ||
+            !snapshot_tell(f, start, &header.items) ||
+            !snapshot_write(f, items, n_items * sizeof(*items)) ||
+            !snapshot_tell(f, start, &end)) {
+        goto cleanup;
     }
-    return (max && max->score >= 0) ? max : NULL;
-}
+    ok = !fseek(f, start, SEEK_SET) &&
+        snapshot_write(f, &header, sizeof(header)) &&
+        !fseek(f, start + end, SEEK_SET);
 
-struct strgrp_grp *
-strgrp_grp_for(struct strgrp *const ctx, const char *const str) {
-    return grp_for(ctx, str);
+cleanup:
+    free(grps);
+    free(items);
+    free(keys);
+    return ok;
 }
 
-struct strgrp_grp *
-strgrp_grp_exact(struct strgrp *const ctx, const char *const str) {
-    struct strgrp_grp **const grp = stringmap_lookup(ctx->known, str);
-    if (!grp) {
+/* Locate n records of size bytes at off, if they lie within the snapshot */
+static const void *
+snapshot_at(const void *const buf, const size_t len, const uint64_t off,
+        const size_t size, const uint64_t n) {
+    if (off > len || (n && (len - off) / size < n)) {
         return NULL;
     }
-    return *grp;
+    return (const char *)buf + off;
 }
 
-static bool score_gt(const struct strgrp_grp *a, const struct strgrp_grp *b) {
-    return a->score > b->score;
+/* Locate the nul-terminated string at off, if it lies within the snapshot */
+static const char *
+snapshot_str(const void *const buf, const size_t len, const uint64_t off) {
+    const char *const str = snapshot_at(buf, len, off, 1, 1);
+    return (str && memchr(str, '\0', len - off)) ? str : NULL;
 }
 
-static bool __score_gt(const void *a, const void *b) {
-    return score_gt(a, b);
+/* The group's key is borrowed from the snapshot */
+static struct strgrp_grp *
+load_grp(struct strgrp *const ctx, const char *const key,
+        const struct snapshot_grp *const rec) {
+    struct strgrp_grp *b = grp_alloc(ctx, key);
+    if (!b) {
+        return NULL;
+    }
+    grp_col(b, threshold) = rec->threshold;
+    grp_col(b, dirty) = rec->dirty;
+    b->low = rec->low;
+    b->n_low = rec->n_low;
+    return b;
 }
 
-struct heap *
-strgrp_grps_for(struct strgrp *const ctx, const char *const str) {
-    int i;
-    struct heap *heap;
+struct strgrp *
+strgrp_load(const void *const buf, const size_t len,
+        bool (*cb)(void *arg, const void *data, size_t len, void **value),
+        void (*free_cb)(void *value), void *const arg) {
+    struct snapshot_header header;
+    struct strgrp *ctx;
+    const char **prefixes = NULL;
+    uint64_t n_items = 0;
+    uint64_t off;
+    size_t i, j = 0;
 
-    /* Sort descending */
-    heap = heap_init(__score_gt);
-    if (!heap) {
-        perror("heap_init");
+    if (len < sizeof(header)) {
         return NULL;
     }
-
-    if (!ctx->n_grps) {
-        return heap;
+    memcpy(&header, buf, sizeof(header));
+    if (memcmp(header.magic, SNAPSHOT_MAGIC, sizeof(header.magic)) ||
+            header.version != SNAPSHOT_VERSION ||
+            header.byte_order != SNAPSHOT_BYTE_ORDER ||
+            !(header.threshold >= 0.0 && header.threshold <= 1.0) ||
+            header.size < 0 || header.samples < 0 || header.tokens < 0 ||
+            header.n_grps > INT_MAX || header.n_prefixes > len ||
+            !snapshot_at(buf, len, header.grps, sizeof(struct snapshot_grp),
+                header.n_grps) ||
+            !snapshot_at(buf, len, header.items, sizeof(struct snapshot_item),
+                header.n_items)) {
+        return NULL;
     }
 
-    ctx->score(ctx, str);
-
-    for (i = 0; i < ctx->n_grps; i++) {
-        struct strgrp_grp *curr = darray_item(ctx->grps, i);
+    ctx = strgrp_new_dynamic(header.threshold, header.size);
+    if (!ctx) {
+        return NULL;
+    }
+    ctx->samples = header.samples;
+    if (!strgrp_metric(ctx, header.metric, header.screen, header.margin)) {
+        goto fail;
+    }
+    for (i = 0; i < header.n_grps; i++) {
+        struct snapshot_grp rec;
+        struct strgrp_grp *grp;
+        const char *key;
+        uint64_t k;
+        memcpy(&rec, (const char *)buf + header.grps + i * sizeof(rec),
+                sizeof(rec));
+        key = snapshot_str(buf, len, rec.key);
+        /* Dissolved groups are recorded without items to keep positions */
+        if (!key || rec.n_items > header.n_items - n_items ||
+                rec.n_low > rec.n_items) {
+            goto fail;
+        }
+        n_items += rec.n_items;
+        grp = load_grp(ctx, key, &rec);
+        if (!grp) {
+            goto fail;
+        }
+        darray_push(ctx->grps, grp);
+        ctx->n_grps++;
+        for (k = 0; k < rec.n_items; k++, j++) {
+            struct snapshot_item irec;
+            struct strgrp_variant *v;
+            struct strgrp_item *item;
+            const void *data;
+            size_t key_len;
+            size_t h;
+            memcpy(&irec, (const char *)buf + header.items + j * sizeof(irec),
+                    sizeof(irec));
+            key = snapshot_str(buf, len, irec.key);
+            data = snapshot_at(buf, len, irec.value, 1, irec.value_len);
+            if (!key || !data) {
+                goto fail;
+            }
+            key_len = strlen(key);
+            h = known_hash(key, key_len);
+            v = grp_variant_enter(ctx, grp, key, key_len, h, true);
+            item = item_alloc(ctx);
+            if (!v || !item) {
+                goto fail;
+            }
+            item->variant = v;
+            item->value = NULL;
+            if (cb && !cb(arg, data, irec.value_len, &item->value)) {
+                goto fail;
+            }
+            v->count++;
+            darray_push(grp->items, item);
+            grp_col(grp, n_items)++;
+            if (irec.known) {
+                cache(ctx, grp, v->key, key_len, h);
+            }
+        }
+        if (grp->n_low > (ssize_t)darray_size(grp->variants)) {
+            goto fail;
+        }
+        if (!rec.n_items) {
+            ctx->n_dissolved++;
+        }
+    }
+    if (n_items != header.n_items) {
+        goto fail;
+    }
 
-        if (heap_push(heap, curr)) {
-            perror("heap_push");
-            heap_free(heap);
-            return NULL;
+    if (header.q && !strgrp_index_qgrams(ctx, header.q)) {
+        goto fail;
+    }
+    if (header.bands && !strgrp_index_minhash(ctx, header.bands, header.rows)) {
+        goto fail;
+    }
+    if (header.tokens) {
+        prefixes = tal_arr(ctx, const char *, header.n_prefixes);
+        if (!prefixes) {
+            goto fail;
+        }
+        off = header.prefixes;
+        for (i = 0; i < header.n_prefixes; i++) {
+            prefixes[i] = snapshot_str(buf, len, off);
+            if (!prefixes[i]) {
+                goto fail;
+            }
+            off += strlen(prefixes[i]) + 1;
         }
+        if (!strgrp_partition(ctx, prefixes, header.n_prefixes,
+                    header.tokens)) {
+            goto fail;
+        }
+        tal_free(prefixes);
     }
+    return ctx;
 
-    return heap;
+fail:
+    if (free_cb) {
+        strgrp_free_cb(ctx, free_cb);
+    } else {
+        strgrp_free(ctx);
+    }
+    return NULL;
 }
 
 bool
-strgrp_grp_is_acceptible(const struct strgrp *ctx,
-                         struct strgrp_grp *grp) {
-    if (ctx->size > 0 && grp->dirty) {
-        grp_update_threshold(ctx, grp);
-        grp->dirty = false;
+strgrp_cache_scores(struct strgrp *const ctx, const size_t size) {
+    struct score_cache *const cache = ctx->cache;
+    if (!size) {
+        ctx->cache = tal_free(cache);
+        return true;
     }
-
-    return grp->score >= 0;
+    if (!cache) {
+        ctx->cache = new_score_cache(ctx, size);
+        return ctx->cache != NULL;
+    }
+    cache->size = size;
+    while (cache->n > size) {
+        score_cache_remove(cache,
+                list_tail(&cache->lru, struct score_entry, lru));
+        cache->evictions++;
+    }
+    return true;
 }
 
-bool
-strgrp_grp_is_dynamic(const struct strgrp *ctx, const struct strgrp_grp *grp) {
-    return ctx->size > 0 && grp->n_items >= ctx->size;
+void
+strgrp_cache_stats(const struct strgrp *const ctx, size_t *const entries,
+        unsigned long *const hits, unsigned long *const misses,
+        unsigned long *const evictions) {
+    const struct score_cache *const cache = ctx->cache;
+    *entries = cache ? cache->n : 0;
+    *hits = cache ? cache->hits : 0;
+    *misses = cache ? cache->misses : 0;
+    *evictions = cache ? cache->evictions : 0;
 }
 
-ssize_t
-strgrp_grp_size(const struct strgrp_grp *grp) {
-    return grp->n_items;
-}
+/* The cache is persisted as its entries from least to most recently used,
+ * each a record followed by the nul-terminated group key and string. */
+#define SCORE_CACHE_MAGIC "strgrp\0c"
+#define SCORE_CACHE_VERSION 1
 
-struct strgrp_grp *
-strgrp_grp_new(struct strgrp *ctx, const char *str, void *data) {
-    struct strgrp_grp *pick = add_grp(ctx, str, data);
-    if (pick) {
-        cache(ctx, pick, str);
-    }
-    return pick;
-}
+struct score_cache_header {
+    char magic[8];
+    uint32_t version;
+    uint32_t byte_order;
+    uint64_t n;
+};
+
+struct score_cache_record {
+    int32_t lcs;
+    int32_t lmin;
+    uint32_t grp_len;
+    uint32_t str_len;
+};
 
 bool
-strgrp_grp_add(struct strgrp *ctx, struct strgrp_grp *grp, const char *str,
-               void *data)
-{
-    if (!add_item(ctx, grp, str, data))
+strgrp_cache_save(const struct strgrp *const ctx, FILE *const f) {
+    struct score_cache_header header = { SCORE_CACHE_MAGIC };
+    const struct score_entry *e;
+    if (!ctx->cache) {
         return false;
-
-    cache(ctx, grp, str);
-
+    }
+    header.version = SCORE_CACHE_VERSION;
+    header.byte_order = SNAPSHOT_BYTE_ORDER;
+    header.n = ctx->cache->n;
+    if (!snapshot_write(f, &header, sizeof(header))) {
+        return false;
+    }
+    list_for_each_rev(&ctx->cache->lru, e, lru) {
+        struct score_cache_record rec;
+        rec.lcs = e->lcs;
+        rec.lmin = e->lmin;
+        rec.grp_len = strlen(e->key.grp) + 1;
+        rec.str_len = strlen(e->key.str) + 1;
+        if (!snapshot_write(f, &rec, sizeof(rec)) ||
+                !snapshot_write(f, e->key.grp, rec.grp_len) ||
+                !snapshot_write(f, e->key.str, rec.str_len)) {
+            return false;
+        }
+    }
     return true;
 }
 
-static struct strgrp_grp *
-add(struct strgrp *const ctx, const char *const str, void *const data) {
-    bool inserted = false;
-    struct strgrp_grp *pick = grp_for(ctx, str);
-    if (pick) {
-        inserted = add_item(ctx, pick, str, data);
-    } else {
-        pick = add_grp(ctx, str, data);
-        inserted = (NULL != pick);
-    }
-    if (inserted) {
-        assert(NULL != pick);
-        cache(ctx, pick, str);
+/* Locate a nul-terminated string of len bytes, including the nul */
+static const char *
+cache_str(const char *const buf, const size_t len, const size_t off,
+        const uint32_t slen) {
+    const char *const str = buf + off;
+    if (!slen || slen > len - off) {
+        return NULL;
     }
-    return pick;
+    return memchr(str, '\0', slen) == str + slen - 1 ? str : NULL;
 }
 
-struct strgrp_grp *
-strgrp_add(struct strgrp *const ctx, const char *const str, void *const data) {
-    return add(ctx, str, data);
+bool
+strgrp_cache_load(struct strgrp *const ctx, const void *const buf,
+        const size_t len) {
+    struct score_cache *const cache = ctx->cache;
+    struct score_cache_header header;
+    unsigned long evictions;
+    size_t off = sizeof(header);
+    uint64_t i;
+
+    if (!cache || len < sizeof(header)) {
+        return false;
+    }
+    memcpy(&header, buf, sizeof(header));
+    if (memcmp(header.magic, SCORE_CACHE_MAGIC, sizeof(header.magic)) ||
+            header.version != SCORE_CACHE_VERSION ||
+            header.byte_order != SNAPSHOT_BYTE_ORDER) {
+        return false;
+    }
+    /* Entries beyond the size of the cache are not evictions in use */
+    evictions = cache->evictions;
+    for (i = 0; i < header.n; i++) {
+        struct score_cache_record rec;
+        struct score_key key;
+        if (len - off < sizeof(rec)) {
+            break;
+        }
+        memcpy(&rec, (const char *)buf + off, sizeof(rec));
+        off += sizeof(rec);
+        key.grp = cache_str(buf, len, off, rec.grp_len);
+        if (!key.grp) {
+            break;
+        }
+        off += rec.grp_len;
+        key.str = cache_str(buf, len, off, rec.str_len);
+        if (!key.str) {
+            break;
+        }
+        off += rec.str_len;
+        key.hash = score_key_combine(hash(key.grp, rec.grp_len - 1, 0),
+                hash(key.str, rec.str_len - 1, 0));
+        score_cache_put(cache, &key, rec.lcs, rec.lmin);
+    }
+    cache->evictions = evictions;
+    return i == header.n;
 }
 
 struct strgrp_iter *
@@ -439,17 +4409,25 @@ strgrp_iter_new(struct strgrp *const ctx) {
     }
     iter->ctx = ctx;
     iter->i = 0;
+    list_add_tail(&ctx->iters, &iter->list);
     return iter;
 }
 
 struct strgrp_grp *
 strgrp_iter_next(struct strgrp_iter *const iter) {
-    return (iter->ctx->n_grps == iter->i) ?
-        NULL : darray_item(iter->ctx->grps, iter->i++);
+    struct strgrp_grp *grp;
+    do {
+        if (iter->ctx->n_grps == iter->i) {
+            return NULL;
+        }
+        grp = darray_item(iter->ctx->grps, iter->i++);
+    } while (!grp_col(grp, n_items));
+    return grp;
 }
 
 void
 strgrp_iter_free(struct strgrp_iter *const iter) {
+    list_del(&iter->list);
     tal_free(iter);
 }
 
@@ -466,7 +4444,7 @@ strgrp_grp_iter_new(const struct strgrp_grp *const grp) {
 
 const struct strgrp_item *
 strgrp_grp_iter_next(struct strgrp_grp_iter *const iter) {
-    return (iter->grp->n_items == iter->i) ?
+    return (grp_col(iter->grp, n_items) == iter->i) ?
         NULL : darray_item(iter->grp->items, iter->i++);
 }
 
@@ -480,9 +4458,44 @@ strgrp_grp_key(const struct strgrp_grp *const grp) {
     return grp->key;
 }
 
+unsigned int
+strgrp_grp_index(const struct strgrp_grp *const grp) {
+    return grp->index;
+}
+
+struct strgrp_grp *
+strgrp_grp_at(const struct strgrp *const ctx, const unsigned int i) {
+    return i < ctx->n_grps ? darray_item(ctx->grps, i) : NULL;
+}
+
+const struct strgrp_item *
+strgrp_grp_item_at(const struct strgrp_grp *const grp, const size_t i) {
+    return i < (size_t)grp_col(grp, n_items) ?
+        darray_item(grp->items, i) : NULL;
+}
+
+size_t
+strgrp_grp_variants(const struct strgrp_grp *const grp) {
+    return darray_size(grp->variants);
+}
+
+const char *
+strgrp_grp_variant_at(const struct strgrp_grp *const grp, const size_t i,
+        size_t *const count) {
+    const struct strgrp_variant *v;
+    if (i >= darray_size(grp->variants)) {
+        return NULL;
+    }
+    v = darray_item(grp->variants, i);
+    if (count) {
+        *count = v->count;
+    }
+    return v->key;
+}
+
 const char *
 strgrp_item_key(const struct strgrp_item *const item) {
-    return item->key;
+    return item->variant->key;
 }
 
 void *
@@ -492,8 +4505,23 @@ strgrp_item_value(const struct strgrp_item *const item) {
 
 void
 strgrp_free(struct strgrp *const ctx) {
+    size_t i;
+
+    for (i = 0; i < tal_count(ctx->scratch); i++) {
+        free(ctx->scratch[i].masks.words);
+        free(ctx->scratch[i].column.words);
+        metric_scratch_free(&ctx->scratch[i].items[0]);
+        metric_scratch_free(&ctx->scratch[i].items[1]);
+        darray_free(ctx->scratch[i].pending);
+    }
+    free(ctx->pattern.words);
+    metric_scratch_free(&ctx->query);
+    block_pool_free(ctx->pool);
+    block_pool_free(ctx->keys);
     darray_free(ctx->grps);
-    stringmap_free(ctx->known);
+    grp_cols_free(&ctx->cols);
+    known_free(&ctx->known);
+    variant_table_clear(&ctx->variants);
     tal_free(ctx);
 }
 
@@ -511,7 +4539,7 @@ strgrp_free_cb(struct strgrp *const ctx, void (*cb)(void *data)) {
 
 static void
 print_item(const struct strgrp_item *item) {
-    printf("\t%s\n", item->key);
+    printf("\t%s\n", item->variant->key);
 }
 
 static void
@@ -528,6 +4556,8 @@ void
 strgrp_print(const struct strgrp *const ctx) {
     struct strgrp_grp **grp;
     darray_foreach(grp, ctx->grps) {
-        print_grp(*grp);
+        if (grp_col(*grp, n_items)) {
+            print_grp(*grp);
+        }
     }
 }
@@ -3,6 +3,7 @@
 #ifndef STRGRP_H
 #define STRGRP_H
 #include <stdbool.h>
+#include <stdio.h>
 #include "ccan/heap/heap.h"
 
 struct strgrp;
@@ -11,6 +12,40 @@ struct strgrp_grp;
 struct strgrp_grp_iter;
 struct strgrp_item;
 
+/**
+ * struct strgrp_stats - Counters of the work done by a strgrp instance
+ * @searches: Strings scored against the groups
+ * @exact: Strings matching an existing item, which are not scored
+ * @scanned: Groups considered across all searches
+ * @rejected_len: Groups rejected by comparing string lengths, or their numbers
+ *     of tokens or bigrams under the cheap metrics
+ * @rejected: Groups rejected by the q-gram or MinHash filters
+ * @lcs: Comparisons computing the longest common subsequence
+ * @cheap: Comparisons by the token Jaccard or bigram cosine metrics, see
+ *     strgrp_metric()
+ * @cells: Cells of the dynamic programming table covered by the comparisons
+ * @thresholds: Recomputations of the thresholds of self-thresholding groups
+ * @widened: Partitioned searches that scored all groups, see strgrp_partition()
+ * @prepare_time: Seconds spent preparing strings for scoring
+ * @score_time: Seconds spent scoring strings against the groups
+ * @insert_time: Seconds spent adding strings to groups
+ */
+struct strgrp_stats {
+    unsigned long searches;
+    unsigned long exact;
+    unsigned long scanned;
+    unsigned long rejected_len;
+    unsigned long rejected;
+    unsigned long lcs;
+    unsigned long cheap;
+    unsigned long long cells;
+    unsigned long thresholds;
+    unsigned long widened;
+    double prepare_time;
+    double score_time;
+    double insert_time;
+};
+
 /**
  * Constructs a new strgrp instance.
  * @threshold: A value in [0.0, 1.0] describing the desired similarity of
@@ -36,6 +71,303 @@ strgrp_new(double threshold);
 struct strgrp *
 strgrp_new_dynamic(double threshold, int size);
 
+/**
+ * Bound the cost of maintaining self-thresholding groups.
+ * @ctx: The strgrp instance to configure
+ * @samples: The maximum number of existing items a new item is compared
+ *     against when updating its group's threshold, or 0 to compare against
+ *     all of them.
+ *
+ * A group's threshold derives from the minimum similarity between its items,
+ * which is maintained incrementally as items are added. For very large groups
+ * sampling an evenly spaced subset of the existing items bounds the work per
+ * addition, at the cost of possibly overestimating the minimum. Thresholds of
+ * existing groups are recomputed under the new setting.
+ *
+ * @return True if the setting was applied, false if samples is negative.
+ */
+bool
+strgrp_sample_threshold(struct strgrp *ctx, int samples);
+
+/**
+ * enum strgrp_metric - Measures of the similarity of two strings, in [0, 1]
+ * @STRGRP_METRIC_LCS: The length of the longest common subsequence,
+ *     normalised by the lengths of the strings
+ * @STRGRP_METRIC_JACCARD: The proportion of distinct tokens, runs of
+ *     alphanumeric characters, that the strings share
+ * @STRGRP_METRIC_COSINE: The cosine similarity of the strings' bigram counts
+ */
+enum strgrp_metric {
+    STRGRP_METRIC_LCS,
+    STRGRP_METRIC_JACCARD,
+    STRGRP_METRIC_COSINE,
+};
+
+/**
+ * Select the measure of similarity between strings and group keys.
+ * @ctx: The strgrp instance to configure
+ * @metric: The metric scoring strings against groups and the items of
+ *     self-thresholding groups against each other. STRGRP_METRIC_LCS is the
+ *     default.
+ * @screen: A cheaper metric deciding which pairs @metric scores, or @metric
+ *     to score every pair with it. Only STRGRP_METRIC_LCS can be screened.
+ * @margin: The distance from the threshold beyond which the screen's score
+ *     decides a pair. Pairs it scores within the margin are scored by @metric.
+ *
+ * Token Jaccard and bigram cosine similarity compare precomputed profiles of
+ * the strings, at a fraction of the cost of LCS. They separate most merchant
+ * descriptions as well, but weigh differences in digits or word order
+ * differently, so the threshold may need adjusting. As a screen, a cheap
+ * metric accepts and rejects the clear cases and leaves the ambiguous pairs to
+ * LCS. The candidate filters of strgrp_index_qgrams() only apply to LCS.
+ *
+ * @return True if the metric was applied, false if the arguments are invalid
+ * or memory allocation failed, in which case the previous metric is retained.
+ */
+bool
+strgrp_metric(struct strgrp *ctx, enum strgrp_metric metric,
+              enum strgrp_metric screen, double margin);
+
+/**
+ * Query the measure of similarity selected by strgrp_metric().
+ * @ctx: The strgrp instance in question
+ * @metric: Receives the metric
+ * @screen: Receives the screen, or the metric if pairs are not screened
+ * @margin: Receives the margin of the screen
+ */
+void
+strgrp_get_metric(const struct strgrp *ctx, enum strgrp_metric *metric,
+                  enum strgrp_metric *screen, double *margin);
+
+/**
+ * enum strgrp_kernel - Implementations of the LCS comparison
+ * @STRGRP_KERNEL_SCALAR: Compares a string with one group key at a time
+ * @STRGRP_KERNEL_SSE41: Compares a string with 2 group keys at a time
+ * @STRGRP_KERNEL_AVX2: Compares a string with 4 group keys at a time
+ * @STRGRP_KERNEL_AVX512: Compares a string with 8 group keys at a time
+ */
+enum strgrp_kernel {
+    STRGRP_KERNEL_SCALAR,
+    STRGRP_KERNEL_SSE41,
+    STRGRP_KERNEL_AVX2,
+    STRGRP_KERNEL_AVX512,
+};
+
+/**
+ * Select the implementation of the LCS comparison of strings with groups.
+ * @ctx: The strgrp instance to configure
+ * @kernel: The kernel, which the CPU must support. New instances use the
+ *     scalar kernel.
+ *
+ * The SIMD kernels compare a string of up to 64 characters with several group
+ * keys at once, one key to each 64-bit lane of a vector register. Longer
+ * strings, and the comparisons of the items of self-thresholding groups, use
+ * the scalar kernel. The scores do not depend on the kernel. Batching the
+ * keys for the lanes costs about what the lanes save, so the SIMD kernels are
+ * rarely faster; measure before selecting one.
+ *
+ * @return True if the kernel was selected, false if the CPU does not support
+ * it, in which case the previous kernel is retained.
+ */
+bool
+strgrp_kernel(struct strgrp *ctx, enum strgrp_kernel kernel);
+
+/**
+ * Query the implementation of the LCS comparison selected by strgrp_kernel().
+ * @ctx: The strgrp instance in question
+ * @lanes: Receives the number of group keys compared at a time, or NULL
+ *
+ * @return The kernel
+ */
+enum strgrp_kernel
+strgrp_get_kernel(const struct strgrp *ctx, int *lanes);
+
+/**
+ * Index group keys by their q-grams to filter candidate groups before scoring.
+ * @ctx: The strgrp instance to index
+ * @q: The q-gram length, in [1, 8]. Small values such as 2 filter best for
+ *     short strings.
+ *
+ * Groups that share too few q-grams with a string to reach the threshold are
+ * skipped without computing their score. The filter is exact: it does not
+ * change which groups are found. Existing groups are indexed immediately and
+ * subsequent groups as they are created.
+ *
+ * @return True if the index was constructed, false if q is out of range or
+ * memory allocation failed, in which case any previous index is retained.
+ */
+bool
+strgrp_index_qgrams(struct strgrp *ctx, int q);
+
+/**
+ * Approximate the search for candidate groups by MinHash signatures of their
+ * keys.
+ * @ctx: The strgrp instance to index
+ * @bands: The number of signature bands. Increasing bands improves the
+ *     likelihood of finding the best group.
+ * @rows: The number of hash values in each band, in [1, 1024 / bands].
+ *     Increasing rows prunes more candidate groups.
+ *
+ * Only groups whose key collides with the string in at least one band are
+ * scored. Unlike strgrp_index_qgrams() the filter is approximate: it trades
+ * the quality of the groupings for speed when there are very many groups.
+ * Existing groups are indexed immediately and subsequent groups as they are
+ * created.
+ *
+ * @return True if the index was constructed, false if bands or rows are out of
+ * range or memory allocation failed, in which case any previous index is
+ * retained.
+ */
+bool
+strgrp_index_minhash(struct strgrp *ctx, int bands, int rows);
+
+/**
+ * Partition the groups by the merchant leading their key.
+ * @ctx: The strgrp instance to partition
+ * @prefixes: Strings stripped from the start of keys and queries before the
+ *     merchant, such as "VISA DEBIT PURCHASE CARD". The first that matches a
+ *     whole number of tokens is stripped. The strings are copied.
+ * @n_prefixes: The number of prefixes
+ * @tokens: The number of leading tokens identifying the merchant, or 0 to
+ *     remove the partitioning. Tokens without letters, such as card numbers,
+ *     are skipped.
+ *
+ * A search scores the groups whose key shares the query's merchant, and only
+ * scores all groups if none of those are acceptable. This bounds the work per
+ * search to a handful of groups for typical bank descriptions. Like
+ * strgrp_index_minhash() it is approximate: a better group for another
+ * merchant is missed if the query's merchant has an acceptable group, and
+ * strgrp_grps_for() then provides only the merchant's groups. Existing groups
+ * are partitioned immediately and subsequent groups as they are created.
+ *
+ * @return True if the partitioning was applied, false if tokens is negative or
+ * memory allocation failed, in which case any previous partitioning is
+ * retained.
+ */
+bool
+strgrp_partition(struct strgrp *ctx, const char *const *prefixes,
+                 size_t n_prefixes, int tokens);
+
+/**
+ * Count the candidate groups skipped by the MinHash index.
+ * @ctx: The strgrp instance in question
+ *
+ * @return The number of groups left unscored across all searches, or 0 if
+ * strgrp_index_minhash() has not been called.
+ */
+unsigned long
+strgrp_minhash_pruned(const struct strgrp *ctx);
+
+/**
+ * Query the work done by a strgrp instance.
+ * @ctx: The strgrp instance in question
+ * @stats: Receives the counters accumulated since construction or the last
+ *     call to strgrp_stats_reset()
+ *
+ * Comparisons answered from the score cache are not counted in @lcs or
+ * @cells, see strgrp_cache_stats().
+ */
+void
+strgrp_stats(const struct strgrp *ctx, struct strgrp_stats *stats);
+
+/**
+ * Zero the counters reported by strgrp_stats().
+ * @ctx: The strgrp instance to reset
+ */
+void
+strgrp_stats_reset(struct strgrp *ctx);
+
+/**
+ * Control the parallel scoring of groups.
+ * @ctx: The strgrp instance to configure
+ * @threads: The number of threads to score with, or 0 for the OpenMP default
+ * @chunk: The number of groups a thread scores at a time, at least 1
+ * @serial: The number of groups below which scoring is serial, as entering a
+ *     parallel region costs more than scoring a small number of groups
+ * @autotune: Adjust serial from the measured cost of scoring each way
+ *
+ * When tuning, occasional searches are scored the other way to the threshold
+ * to compare their costs. The scores do not depend on the schedule.
+ *
+ * @return True if the schedule was applied, false if threads is negative or
+ * chunk is less than 1.
+ */
+bool
+strgrp_schedule(struct strgrp *ctx, int threads, int chunk,
+                unsigned int serial, bool autotune);
+
+/**
+ * Query the parallel scoring of groups.
+ * @ctx: The strgrp instance in question
+ * @threads: Receives the number of threads, as for strgrp_schedule()
+ * @chunk: Receives the number of groups a thread scores at a time
+ * @serial: Receives the number of groups below which scoring is serial. If
+ *     tuning, this is the current estimate.
+ * @autotune: Receives whether serial is tuned
+ */
+void
+strgrp_get_schedule(const struct strgrp *ctx, int *threads, int *chunk,
+                    unsigned int *serial, bool *autotune);
+
+/**
+ * Cache the scores of strings against group keys.
+ * @ctx: The strgrp instance to configure
+ * @size: The maximum number of (group key, string) pairs to cache, or 0 to
+ *     disable the cache
+ *
+ * Strings searched repeatedly, for instance across runs over the same data,
+ * are then not compared against the groups again. The least recently used
+ * pairs are evicted once the cache is full. Scores at or above the threshold
+ * are unaffected. Scores below it are upper bounds either way, and may be
+ * tighter for cached pairs.
+ *
+ * @return True if the cache was configured, false if memory allocation failed.
+ */
+bool
+strgrp_cache_scores(struct strgrp *ctx, size_t size);
+
+/**
+ * Query the use of the score cache.
+ * @ctx: The strgrp instance in question
+ * @entries: Receives the number of cached pairs
+ * @hits: Receives the number of comparisons answered from the cache
+ * @misses: Receives the number of comparisons not answered from the cache
+ * @evictions: Receives the number of pairs evicted from the cache
+ *
+ * All counts are 0 if the cache is disabled.
+ */
+void
+strgrp_cache_stats(const struct strgrp *ctx, size_t *entries,
+                   unsigned long *hits, unsigned long *misses,
+                   unsigned long *evictions);
+
+/**
+ * Write the score cache to a file.
+ * @ctx: The strgrp instance whose cache to save
+ * @f: The stream to write the cache to
+ *
+ * @return True if the cache was written, false if the cache is disabled or a
+ * write failed.
+ */
+bool
+strgrp_cache_save(const struct strgrp *ctx, FILE *f);
+
+/**
+ * Add the pairs written by strgrp_cache_save() to the score cache.
+ * @ctx: The strgrp instance whose cache to populate
+ * @buf: The contents of the file written by strgrp_cache_save()
+ * @len: The length of buf in bytes
+ *
+ * The pairs are copied, so buf may be freed on return. If there are more pairs
+ * than the size of the cache the most recently used are retained.
+ *
+ * @return True if the pairs were added, false if the cache is disabled or buf
+ * is not a valid cache file, in which case any pairs preceding the invalid
+ * content are added.
+ */
+bool
+strgrp_cache_load(struct strgrp *ctx, const void *buf, size_t len);
+
 /**
  * Find a group which best matches the provided string key.
  * @ctx: The strgrp instance to search
@@ -59,14 +391,39 @@ strgrp_grp_exact(struct strgrp *ctx, const char *str);
 struct heap *
 strgrp_grps_for(struct strgrp *ctx, const char *str);
 
+/**
+ * Score all groups, and provide a heap of the best scoring.
+ * @ctx: The strgrp instance to search
+ * @str: The string key to score the groups against
+ * @k: The maximum number of groups in the heap, or 0 for no limit
+ * @min_score: The minimum score of groups in the heap. Scores are relative to
+ *     the threshold, so groups acceptible for str score at least 0.
+ *
+ * @return A heap popping groups in order of descending score, or NULL if a
+ * failure occurred. The caller must free the heap with heap_free.
+ */
+struct heap *
+strgrp_grps_top(struct strgrp *ctx, const char *str, size_t k,
+                double min_score);
+
 bool
-strgrp_grp_is_acceptible(const struct strgrp *ctx,
-			 struct strgrp_grp *grp);
+strgrp_grp_is_acceptible(struct strgrp *ctx, struct strgrp_grp *grp);
 
 bool
 strgrp_grp_is_dynamic(const struct strgrp *ctx,
 	              const struct strgrp_grp *grp);
 
+/**
+ * Extract the score of a group from the most recent search.
+ * @grp: A strgrp_grp pointer
+ *
+ * Scores are relative to the group's threshold, so a group acceptible for the
+ * searched string scores at least 0. Groups that were not scored, for instance
+ * because they were filtered, have a negative score.
+ */
+double
+strgrp_grp_score(const struct strgrp_grp *grp);
+
 ssize_t
 strgrp_grp_size(const struct strgrp_grp *grp);
 
@@ -77,6 +434,95 @@ strgrp_grp_add(struct strgrp *ctx, struct strgrp_grp *grp, const char *str,
 struct strgrp_grp *
 strgrp_grp_new(struct strgrp *ctx, const char *str, void *data);
 
+/**
+ * Remove an item from a group.
+ * @ctx: The strgrp instance owning the group
+ * @grp: The group to remove the item from
+ * @i: The position of the item in the group, as for strgrp_grp_item_at()
+ * @data: Receives the data of the removed item, if not NULL
+ *
+ * Later items move down a position, and pointers to the removed item become
+ * invalid. Exact matches no longer find the group for the item's string
+ * unless another of its items has the same string. If the item's string was
+ * the group key the group is re-keyed with its first remaining item, and a
+ * group left without items is dissolved as for strgrp_grp_dissolve().
+ *
+ * @return True if the item was removed, false if i is out of range or
+ * re-keying the group failed, in which case the group is unchanged.
+ */
+bool
+strgrp_grp_remove(struct strgrp *ctx, struct strgrp_grp *grp, size_t i,
+                  void **data);
+
+/**
+ * Move an item from one group to another.
+ * @ctx: The strgrp instance owning the groups
+ * @from: The group holding the item
+ * @i: The position of the item in from
+ * @to: The group to append the item to, which must not be dissolved
+ *
+ * The item is removed from from as for strgrp_grp_remove(), and exact matches
+ * for its string then find to.
+ *
+ * @return True if the item was moved, false if i is out of range, to is
+ * dissolved or re-keying from failed.
+ */
+bool
+strgrp_grp_move(struct strgrp *ctx, struct strgrp_grp *from, size_t i,
+                struct strgrp_grp *to);
+
+/**
+ * Make the string of an item the key of its group.
+ * @ctx: The strgrp instance owning the group
+ * @grp: The group to re-key
+ * @i: The position of the item whose string becomes the key
+ *
+ * Subsequent searches score the group against its new key.
+ *
+ * @return True if the group was re-keyed, false if i is out of range or
+ * memory allocation failed.
+ */
+bool
+strgrp_grp_rekey(struct strgrp *ctx, struct strgrp_grp *grp, size_t i);
+
+/**
+ * Remove all items from a group.
+ * @ctx: The strgrp instance owning the group
+ * @grp: The group to dissolve
+ * @cb: Called with the data of each item, for instance to free it, if not
+ *     NULL
+ *
+ * The group keeps its key, but it has no items and is no longer found by
+ * searches or iteration. Items cannot be added to a dissolved group. The
+ * instance frees dissolved groups as they accumulate, moving the later groups
+ * down to fill their positions, so pointers to the group become invalid unless
+ * it is held with strgrp_grp_hold().
+ */
+void
+strgrp_grp_dissolve(struct strgrp *ctx, struct strgrp_grp *grp,
+                    void (*cb)(void *data));
+
+/**
+ * Keep a group from being freed once it is dissolved.
+ * @grp: The group to hold
+ *
+ * A held group that is dissolved keeps its position, so pointers to it remain
+ * valid, until every hold is released with strgrp_grp_release(). Holds are
+ * counted.
+ */
+void
+strgrp_grp_hold(struct strgrp_grp *grp);
+
+/**
+ * Release a hold taken with strgrp_grp_hold().
+ * @grp: The held group
+ *
+ * A dissolved group is freed once it has no holds, and pointers to it then
+ * become invalid.
+ */
+void
+strgrp_grp_release(struct strgrp_grp *grp);
+
 /**
  * Add a string key and arbitrary data value (together, an item) to the
  * appropriate group.
@@ -95,6 +541,93 @@ strgrp_grp_new(struct strgrp *ctx, const char *str, void *data);
 struct strgrp_grp *
 strgrp_add(struct strgrp *ctx, const char *str, void *data);
 
+/**
+ * Add a sequence of items to the appropriate groups.
+ * @ctx: The strgrp instance to add the strings and data
+ * @strs: The string keys, as for strgrp_add()
+ * @data: The data for each key, as for strgrp_add()
+ * @n: The number of items
+ * @grps: Receives the group to which each item was added
+ *
+ * Equivalent to calling strgrp_add() for each item in turn, but the groups
+ * are scored in a single parallel region for the whole sequence.
+ *
+ * Returns the number of items added. If this is less than n, memory
+ * allocation failed for the next item and it and the remaining items were not
+ * added.
+ */
+size_t
+strgrp_add_many(struct strgrp *ctx, const char *const *strs,
+                void *const *data, size_t n, struct strgrp_grp **grps);
+
+/**
+ * Score all groups for each of a sequence of strings.
+ * @ctx: The strgrp instance to search
+ * @strs: The string keys to score the groups against
+ * @n: The number of strings
+ * @k: As for strgrp_grps_top()
+ * @min_score: As for strgrp_grps_top()
+ * @cb: Called with arg, the index of each string and the heap of groups for
+ *     it. The heap orders the groups by their current scores, which the next
+ *     search overwrites, so cb must consume the heap before returning. The
+ *     heap is freed on return. cb returns false to stop the search.
+ * @arg: Passed to cb
+ *
+ * Equivalent to calling strgrp_grps_top() for each string in turn, but the
+ * groups are scored in a single parallel region for the whole sequence. cb is
+ * called from one of the threads of the region.
+ *
+ * Returns the number of strings for which cb returned true. If this is less
+ * than n, cb returned false or a failure occurred for the next string, and no
+ * further strings were searched.
+ */
+size_t
+strgrp_grps_top_many(struct strgrp *ctx, const char *const *strs, size_t n,
+                     size_t k, double min_score,
+                     bool (*cb)(void *arg, size_t i, struct heap *heap),
+                     void *arg);
+
+/**
+ * Write a snapshot of the groups to a file.
+ * @ctx: The strgrp instance to save
+ * @f: The seekable stream to write the snapshot to, from its current position
+ * @cb: Called with arg, each item's value and f to write the value to the
+ *     stream, returning false on failure. May be NULL if values are not saved.
+ * @arg: Passed to cb
+ *
+ * The snapshot records the configuration, the groups and their items, the
+ * dynamic thresholds and the exact-match cache, so the instance can be
+ * restored with strgrp_load() without scoring any strings.
+ *
+ * @return True if the snapshot was written, false if a write or memory
+ * allocation failed. On success the stream is positioned after the snapshot.
+ */
+bool
+strgrp_save(struct strgrp *ctx, FILE *f,
+            bool (*cb)(void *arg, void *value, FILE *f), void *arg);
+
+/**
+ * Restore a strgrp instance from a snapshot.
+ * @buf: The snapshot written by strgrp_save(), for instance mapped from its
+ *     file. The keys of the restored instance point into buf, so it must remain
+ *     valid and unchanged until the instance is freed.
+ * @len: The length of buf in bytes
+ * @cb: Called with arg and the bytes written for each item's value by
+ *     strgrp_save(), to provide the value, returning false on failure. May be
+ *     NULL, in which case values are NULL.
+ * @free_cb: Called with the values already provided by cb if the load fails.
+ *     May be NULL.
+ * @arg: Passed to cb
+ *
+ * @return A strgrp instance, or NULL if buf is not a valid snapshot or a
+ * failure occurred. Ownership of the pointer resides with the caller, which
+ * must be freed with strgrp_free.
+ */
+struct strgrp *
+strgrp_load(const void *buf, size_t len,
+            bool (*cb)(void *arg, const void *data, size_t len, void **value),
+            void (*free_cb)(void *value), void *arg);
+
 /**
  * Create an iterator over the current groups.
  * @ctx: The strgrp instance to iterate over
@@ -140,6 +673,62 @@ strgrp_iter_free(struct strgrp_iter *iter);
 const char *
 strgrp_grp_key(const struct strgrp_grp *grp);
 
+/**
+ * Extract the position of a group.
+ * @grp: A strgrp_grp pointer
+ *
+ * Groups are numbered from 0 in order of creation, which is the order of
+ * iteration. Positions move down as dissolved groups are freed, see
+ * strgrp_grp_dissolve(), and are otherwise preserved by strgrp_save() and
+ * strgrp_load().
+ */
+unsigned int
+strgrp_grp_index(const struct strgrp_grp *grp);
+
+/**
+ * Find a group by its position.
+ * @ctx: The strgrp instance in question
+ * @i: The position of the group, as provided by strgrp_grp_index()
+ *
+ * @return The group, or NULL if i is out of range. Ownership of the returned
+ * pointer resides with the strgrp instance.
+ */
+struct strgrp_grp *
+strgrp_grp_at(const struct strgrp *ctx, unsigned int i);
+
+/**
+ * Find an item of a group by its position.
+ * @grp: The group in question
+ * @i: The position of the item, in order of iteration
+ *
+ * @return The item, or NULL if i is out of range. Ownership of the returned
+ * pointer resides with the strgrp instance.
+ */
+const struct strgrp_item *
+strgrp_grp_item_at(const struct strgrp_grp *grp, size_t i);
+
+/**
+ * Extract the number of distinct strings in a group.
+ * @grp: The group in question
+ *
+ * Items bearing the same string share a variant, so this is at most the size
+ * of the group.
+ */
+size_t
+strgrp_grp_variants(const struct strgrp_grp *grp);
+
+/**
+ * Find a distinct string of a group by its position.
+ * @grp: The group in question
+ * @i: The position of the variant, in order of first appearance
+ * @count: Receives the number of items bearing the string, if not NULL
+ *
+ * @return The string, or NULL if i is out of range. Ownership of the returned
+ * pointer resides with the strgrp instance.
+ */
+const char *
+strgrp_grp_variant_at(const struct strgrp_grp *grp, size_t i, size_t *count);
+
 /**
  * Create an iterator over items in the provided group
  * @grp: The group whose items to iterate over
@@ -1,33 +1,132 @@
 #include <Python.h>
+#include <pythread.h>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
 #include "ccan/strgrp/strgrp.h"
 
+/*
+ * Concurrency: The strgrp instance is not thread-safe, and scoring updates
+ * state in the groups and indexes. Each Strgrp object therefore serialises
+ * access to its instance with a lock, which is only ever waited on with the
+ * GIL released to avoid deadlocking against a holder that needs the GIL.
+ * Scoring is performed with the GIL released, so threads searching distinct
+ * Strgrp objects run in parallel. Grp, Grps and Item objects hold a reference
+ * to their Strgrp to keep the instance alive.
+ *
+ * The instance frees dissolved groups unless they are held, so Grp, Grps and
+ * Item objects hold their groups with strgrp_grp_hold(), taken under the lock
+ * that found the group. Items can be removed, so Item objects hold their own
+ * references to the key and value rather than pointing at the strgrp_item.
+ */
+
+typedef struct {
+    PyObject_HEAD;
+    double thresh;
+    struct strgrp *grp;
+    struct strgrp_iter *iter;
+    PyThread_type_lock lock;
+    /* The snapshot mapping backing the instance's keys, if loaded */
+    void *map;
+    size_t map_len;
+    /* The buffer backing the instance's keys, if loaded from memory */
+    Py_buffer view;
+    /* The thread pickling the item values, if any, to catch values that
+     * refer to the instance itself */
+    unsigned long pickler;
+} StrgrpObject;
+
+static PyTypeObject StrgrpType;
+
+static void
+Strgrp_lock(StrgrpObject *self) {
+    if (!PyThread_acquire_lock(self->lock, NOWAIT_LOCK)) {
+        Py_BEGIN_ALLOW_THREADS
+        PyThread_acquire_lock(self->lock, WAIT_LOCK);
+        Py_END_ALLOW_THREADS
+    }
+}
+
+static void
+Strgrp_unlock(StrgrpObject *self) {
+    PyThread_release_lock(self->lock);
+}
+
 //
 // strgrp_item
 //
 
 typedef struct {
     PyObject_HEAD;
-    const struct strgrp_item *item;
+    PyObject *key;
+    PyObject *value;
+    StrgrpObject *owner;
+    /* The item's group and position in it, for pickling */
+    struct strgrp_grp *grp;
+    Py_ssize_t index;
 } ItemObject;
 
 static void
 Item_dealloc(PyObject *obj) {
+    ItemObject *self = (ItemObject *)obj;
+    if (self->grp) {
+        Strgrp_lock(self->owner);
+        strgrp_grp_release(self->grp);
+        Strgrp_unlock(self->owner);
+    }
+    Py_XDECREF(self->key);
+    Py_XDECREF(self->value);
+    Py_XDECREF(self->owner);
     Py_TYPE(obj)->tp_free(obj);
 }
 
+/* Capture the key and value of an item. Called with the owner's lock held. */
+static bool
+Item_fill(ItemObject *self, const struct strgrp_item *item) {
+    self->key = PyUnicode_FromString(strgrp_item_key(item));
+    if (!self->key) {
+        return false;
+    }
+    self->value = strgrp_item_value(item);
+    Py_INCREF(self->value);
+    return true;
+}
+
 static PyObject *
 Item_key(ItemObject *self) {
-    const char *key = strgrp_item_key(self->item);
-    PyObject *py_key = Py_BuildValue("s", key);
-    Py_XINCREF(py_key);
-    return py_key;
+    Py_INCREF(self->key);
+    return self->key;
 }
 
 static PyObject *
 Item_value(ItemObject *self) {
-    PyObject *value = strgrp_item_value(self->item);
-    Py_XINCREF(value);
-    return value;
+    Py_INCREF(self->value);
+    return self->value;
+}
+
+/* Pickle objects by reference to their owner, see pystrgrp_grp() */
+static PyObject *
+pickle_ref(const char *name, PyObject *args) {
+    PyObject *function;
+    PyObject *module = PyImport_ImportModule("pystrgrp");
+    if (!module) {
+        Py_DECREF(args);
+        return NULL;
+    }
+    function = PyObject_GetAttrString(module, name);
+    Py_DECREF(module);
+    if (!function) {
+        Py_DECREF(args);
+        return NULL;
+    }
+    return Py_BuildValue("(NN)", function, args);
+}
+
+static PyObject *
+Item_reduce(ItemObject *self) {
+    return pickle_ref("_item", Py_BuildValue("(OIn)", self->owner,
+                strgrp_grp_index(self->grp), self->index));
 }
 
 static PyMethodDef Item_methods[] = {
@@ -35,12 +134,14 @@ static PyMethodDef Item_methods[] = {
         "Fetch the description stored in the item" },
     { "value", (PyCFunction)Item_value, METH_NOARGS,
         "Fetch the data stored in the item" },
+    { "__reduce__", (PyCFunction)Item_reduce, METH_NOARGS,
+        "Pickle the item by its position in its Strgrp" },
     {NULL}
 };
 
 static PyTypeObject ItemType = {
     PyVarObject_HEAD_INIT(NULL, 0)
-    "strgrp.Item",           /* tp_name */
+    "pystrgrp.Item",           /* tp_name */
     sizeof(ItemObject),      /* tp_basicsize */
     0,                         /* tp_itemsize */
     &Item_dealloc,            /* tp_dealloc */
@@ -86,17 +187,45 @@ typedef struct {
     PyObject_HEAD;
     struct strgrp_grp *grp;
     struct strgrp_grp_iter *iter;
+    /* The position of the next item of the iterator */
+    Py_ssize_t next;
+    StrgrpObject *owner;
+    /* The score from the search that produced the object, if any */
+    double score;
+    bool scored;
 } GrpObject;
 
+static PyTypeObject GrpType;
+
 static void
 Grp_dealloc(PyObject *obj) {
     GrpObject *self = (GrpObject *)obj;
+    Strgrp_lock(self->owner);
     if (self->iter) {
         strgrp_grp_iter_free(self->iter);
     }
+    strgrp_grp_release(self->grp);
+    Strgrp_unlock(self->owner);
+    Py_XDECREF(self->owner);
     Py_TYPE(self)->tp_free((PyObject *)self);
 }
 
+/* Wrap grp, taking over a hold the caller took under the lock */
+static PyObject *
+Grp_wrap(StrgrpObject *owner, struct strgrp_grp *grp) {
+    GrpObject *const grpobj = (GrpObject *)PyType_GenericNew(&GrpType, NULL, NULL);
+    if (!grpobj) {
+        Strgrp_lock(owner);
+        strgrp_grp_release(grp);
+        Strgrp_unlock(owner);
+        return NULL;
+    }
+    Py_INCREF(owner);
+    grpobj->owner = owner;
+    grpobj->grp = grp;
+    return (PyObject *)grpobj;
+}
+
 static PyObject *
 Grp_iter(PyObject *self) {
     Py_INCREF(self);
@@ -105,20 +234,40 @@ Grp_iter(PyObject *self) {
 
 static PyObject *
 Grp_iternext(GrpObject *self) {
+    const struct strgrp_item *next;
+    bool filled = false;
+    ItemObject *item = (ItemObject *)PyType_GenericNew(&ItemType, NULL, NULL);
+    if (!item) {
+        return PyErr_NoMemory();
+    }
+    Py_INCREF(self->owner);
+    item->owner = self->owner;
+    Strgrp_lock(self->owner);
+    strgrp_grp_hold(self->grp);
+    item->grp = self->grp;
     if (!self->iter) {
         self->iter = strgrp_grp_iter_new(self->grp);
         if (!self->iter) {
+            Strgrp_unlock(self->owner);
+            Item_dealloc((PyObject *)item);
             return PyErr_NoMemory();
         }
+        self->next = 0;
     }
-    ItemObject *item = (ItemObject *)PyType_GenericNew(&ItemType, NULL, NULL);
-    if (!item) {
-        return PyErr_NoMemory();
+    item->index = self->next++;
+    next = strgrp_grp_iter_next(self->iter);
+    if (next) {
+        filled = Item_fill(item, next);
+    } else {
+        strgrp_grp_iter_free(self->iter);
+        self->iter = NULL;
     }
-    item->item = strgrp_grp_iter_next(self->iter);
-    if (!item->item) {
+    Strgrp_unlock(self->owner);
+    if (!filled) {
         Item_dealloc((PyObject *)item);
-        self->iter = NULL;
+        if (next) {
+            return NULL;
+        }
         /* Raising of standard StopIteration exception with empty value. */
         PyErr_SetNone(PyExc_StopIteration);
         return NULL;
@@ -128,20 +277,49 @@ Grp_iternext(GrpObject *self) {
 
 static PyObject *
 Grp_key(GrpObject *self) {
-    const char *key = strgrp_grp_key(self->grp);
-    PyObject *py_key = Py_BuildValue("s", key);
+    /* Keys are freed and the group's key pointer replaced as items are
+     * removed under the lock, which other threads hold without the GIL */
+    Strgrp_lock(self->owner);
+    PyObject *py_key = Py_BuildValue("s", strgrp_grp_key(self->grp));
+    Strgrp_unlock(self->owner);
     Py_XINCREF(py_key);
     return py_key;
 }
 
 static PyObject *
 Grp_size(GrpObject *self) {
+    Strgrp_lock(self->owner);
     const ssize_t size = strgrp_grp_size(self->grp);
+    Strgrp_unlock(self->owner);
     PyObject *py_size = PyLong_FromSsize_t(size);
     Py_XINCREF(py_size);
     return py_size;
 }
 
+/* The distinct strings of the group with the number of items bearing each */
+static PyObject *
+Grp_variants(GrpObject *self) {
+    PyObject *list;
+    PyObject *pair;
+    const char *key;
+    size_t i, n, count;
+
+    Strgrp_lock(self->owner);
+    n = strgrp_grp_variants(self->grp);
+    list = PyList_New(n);
+    for (i = 0; list && i < n; i++) {
+        key = strgrp_grp_variant_at(self->grp, i, &count);
+        pair = Py_BuildValue("(sn)", key, (Py_ssize_t)count);
+        if (!pair) {
+            Py_CLEAR(list);
+            break;
+        }
+        PyList_SET_ITEM(list, i, pair);
+    }
+    Strgrp_unlock(self->owner);
+    return list;
+}
+
 static PyObject *
 Grp_is_acceptible(GrpObject *self, PyObject *args);
 
@@ -151,23 +329,71 @@ Grp_is_dynamic(GrpObject *self, PyObject *args);
 static PyObject *
 Grp_add(GrpObject *self, PyObject *args, PyObject *kwds);
 
+static PyObject *
+Grp_remove(GrpObject *self, PyObject *args, PyObject *kwds);
+
+static PyObject *
+Grp_move(GrpObject *self, PyObject *args, PyObject *kwds);
+
+static PyObject *
+Grp_rekey(GrpObject *self, PyObject *args, PyObject *kwds);
+
+static PyObject *
+Grp_dissolve(GrpObject *self, PyObject *args);
+
+/* Objects for the same group compare equal */
+static PyObject *
+Grp_richcompare(PyObject *a, PyObject *b, int op) {
+    if (!PyObject_TypeCheck(b, &GrpType) || (op != Py_EQ && op != Py_NE)) {
+        Py_RETURN_NOTIMPLEMENTED;
+    }
+    return PyBool_FromLong((((GrpObject *)a)->grp == ((GrpObject *)b)->grp) ==
+            (op == Py_EQ));
+}
+
+static Py_hash_t
+Grp_hash(GrpObject *self) {
+    return _Py_HashPointer(self->grp);
+}
+
+static PyObject *
+Grp_reduce(GrpObject *self) {
+    return pickle_ref("_grp", Py_BuildValue("(OI)", self->owner,
+                strgrp_grp_index(self->grp)));
+}
+
 static PyMethodDef Grp_methods[] = {
     { "key", (PyCFunction)Grp_key, METH_NOARGS,
         "Fetch the description stored in the item" },
     { "size", (PyCFunction)Grp_size, METH_NOARGS,
         "Query the size of the group" },
+    { "variants", (PyCFunction)Grp_variants, METH_NOARGS,
+        "List the distinct strings of the group with their item counts" },
     { "is_acceptible", (PyCFunction)Grp_is_acceptible, METH_VARARGS,
         "Test whether the group passes the threshold for the query string" },
     { "is_dynamic", (PyCFunction)Grp_is_dynamic, METH_VARARGS,
         "Test whether the group uses a dynamic threshold for scoring" },
     { "add", (PyCFunction)Grp_add, (METH_VARARGS | METH_KEYWORDS),
         "Add a string and its associated data to a group" },
+    { "remove", (PyCFunction)Grp_remove, (METH_VARARGS | METH_KEYWORDS),
+        "Remove the item at a position in the group, providing its data.\n"
+        "The group is re-keyed if the item's string was the key, and\n"
+        "dissolved if it was the last item" },
+    { "move", (PyCFunction)Grp_move, (METH_VARARGS | METH_KEYWORDS),
+        "Move the item at a position in the group to another group" },
+    { "rekey", (PyCFunction)Grp_rekey, (METH_VARARGS | METH_KEYWORDS),
+        "Make the string of the item at a position the group's key" },
+    { "dissolve", (PyCFunction)Grp_dissolve, METH_VARARGS,
+        "Remove all items from the group, providing a list of their data.\n"
+        "The group is then no longer found by searches or iteration" },
+    { "__reduce__", (PyCFunction)Grp_reduce, METH_NOARGS,
+        "Pickle the group by its position in its Strgrp" },
     {NULL}
 };
 
 static PyTypeObject GrpType = {
     PyVarObject_HEAD_INIT(NULL, 0)
-    "strgrp.Grp",           /* tp_name */
+    "pystrgrp.Grp",           /* tp_name */
     sizeof(GrpObject),      /* tp_basicsize */
     0,                         /* tp_itemsize */
     &Grp_dealloc,            /* tp_dealloc */
@@ -179,7 +405,7 @@ static PyTypeObject GrpType = {
     0,                         /* tp_as_number */
     0,                         /* tp_as_sequence */
     0,                         /* tp_as_mapping */
-    0,                         /* tp_hash  */
+    (hashfunc) &Grp_hash,      /* tp_hash  */
     0,                         /* tp_call */
     0,                         /* tp_str */
     0,                         /* tp_getattro */
@@ -189,7 +415,7 @@ static PyTypeObject GrpType = {
     "Grp object",           /* tp_doc */
     0,                         /* tp_traverse */
     0,                         /* tp_clear */
-    0,                         /* tp_richcompare */
+    (richcmpfunc) &Grp_richcompare, /* tp_richcompare */
     0,                         /* tp_weaklistoffset */
     (getiterfunc) &Grp_iter,                         /* tp_iter */
     (iternextfunc) &Grp_iternext,                         /* tp_iternext */
@@ -206,29 +432,224 @@ static PyTypeObject GrpType = {
 };
 
 //
-// Strgrp
+// Ordered groups, as returned by Strgrp.grps_for()
 //
 
+struct scored_grp {
+    struct strgrp_grp *grp;
+    double score;
+};
+
 typedef struct {
     PyObject_HEAD;
-    double thresh;
-    struct strgrp *grp;
-    struct strgrp_iter *iter;
-} StrgrpObject;
+    /* The Strgrp object for the root sequence, or the root for a slice */
+    PyObject *owner;
+    /* Owned by the root sequence, NULL for slices */
+    struct scored_grp *grps;
+    struct scored_grp *base;
+    Py_ssize_t len;
+    Py_ssize_t step;
+} GrpsObject;
+
+static PyTypeObject GrpsType;
+
+static void scored_grps_free(StrgrpObject *owner, struct scored_grp *grps,
+        Py_ssize_t len);
+
+static void
+Grps_dealloc(PyObject *obj) {
+    GrpsObject *self = (GrpsObject *)obj;
+    if (self->grps) {
+        scored_grps_free((StrgrpObject *)self->owner, self->grps, self->len);
+    }
+    Py_XDECREF(self->owner);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static Py_ssize_t
+Grps_length(GrpsObject *self) {
+    return self->len;
+}
+
+static PyObject *
+Grps_item(GrpsObject *self, Py_ssize_t i) {
+    if (i < 0 || i >= self->len) {
+        PyErr_SetString(PyExc_IndexError, "Grps index out of range");
+        return NULL;
+    }
+    const struct scored_grp *const entry = &self->base[i * self->step];
+    StrgrpObject *const owner = (StrgrpObject *)(self->grps ?
+            self->owner : ((GrpsObject *)self->owner)->owner);
+    Strgrp_lock(owner);
+    strgrp_grp_hold(entry->grp);
+    Strgrp_unlock(owner);
+    GrpObject *const grpobj = (GrpObject *)Grp_wrap(owner, entry->grp);
+    if (!grpobj) {
+        return NULL;
+    }
+    grpobj->score = entry->score;
+    grpobj->scored = true;
+    return (PyObject *)grpobj;
+}
+
+static PyObject *
+Grps_subscript(GrpsObject *self, PyObject *key) {
+    Py_ssize_t start, stop, step, len;
+    if (PyIndex_Check(key)) {
+        Py_ssize_t i = PyNumber_AsSsize_t(key, PyExc_IndexError);
+        if (i == -1 && PyErr_Occurred()) {
+            return NULL;
+        }
+        return Grps_item(self, i < 0 ? i + self->len : i);
+    }
+    if (!PySlice_Check(key)) {
+        PyErr_Format(PyExc_TypeError, "Grps indices must be integers or slices, not %.200s",
+                Py_TYPE(key)->tp_name);
+        return NULL;
+    }
+    if (PySlice_Unpack(key, &start, &stop, &step) < 0) {
+        return NULL;
+    }
+    len = PySlice_AdjustIndices(self->len, &start, &stop, step);
+
+    /* Slices share the root's groups rather than copying them */
+    GrpsObject *const view = (GrpsObject *)PyType_GenericNew(&GrpsType, NULL, NULL);
+    if (!view) {
+        return NULL;
+    }
+    view->owner = self->grps ? (PyObject *)self : self->owner;
+    Py_INCREF(view->owner);
+    view->grps = NULL;
+    view->base = len ? self->base + start * self->step : self->base;
+    view->len = len;
+    view->step = self->step * step;
+    return (PyObject *)view;
+}
+
+static PySequenceMethods Grps_as_sequence = {
+    (lenfunc) &Grps_length,    /* sq_length */
+    0,                         /* sq_concat */
+    0,                         /* sq_repeat */
+    (ssizeargfunc) &Grps_item, /* sq_item */
+};
+
+static PyMappingMethods Grps_as_mapping = {
+    (lenfunc) &Grps_length,    /* mp_length */
+    (binaryfunc) &Grps_subscript, /* mp_subscript */
+    0,                         /* mp_ass_subscript */
+};
+
+static PyTypeObject GrpsType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "pystrgrp.Grps",           /* tp_name */
+    sizeof(GrpsObject),      /* tp_basicsize */
+    0,                         /* tp_itemsize */
+    &Grps_dealloc,            /* tp_dealloc */
+    0,                         /* tp_print */
+    0,                         /* tp_getattr */
+    0,                         /* tp_setattr */
+    0,                         /* tp_reserved */
+    0,                         /* tp_repr */
+    0,                         /* tp_as_number */
+    &Grps_as_sequence,         /* tp_as_sequence */
+    &Grps_as_mapping,          /* tp_as_mapping */
+    0,                         /* tp_hash  */
+    0,                         /* tp_call */
+    0,                         /* tp_str */
+    0,                         /* tp_getattro */
+    0,                         /* tp_setattro */
+    0,                         /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,        /* tp_flags */
+    "Groups ordered by descending score, created as they are accessed", /* tp_doc */
+    0,                         /* tp_traverse */
+    0,                         /* tp_clear */
+    0,                         /* tp_richcompare */
+    0,                         /* tp_weaklistoffset */
+    0,                         /* tp_iter */
+    0,                         /* tp_iternext */
+    0,                         /* tp_methods */
+    0,                         /* tp_members */
+    0,                         /* tp_getset */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    0,                         /* tp_init */
+    0,                         /* tp_alloc */
+};
+
+/* Take the groups from the heap in order with their current scores, holding
+ * each. Called with the lock held, without the GIL. */
+static struct scored_grp *
+scored_grps_take(struct heap *heap, Py_ssize_t *len) {
+    struct scored_grp *const grps =
+        malloc((heap->len ? heap->len : 1) * sizeof(struct scored_grp));
+    struct strgrp_grp *grp;
+    if (!grps) {
+        return NULL;
+    }
+    for (*len = 0; heap->len && (grp = heap_pop(heap)); (*len)++) {
+        strgrp_grp_hold(grp);
+        grps[*len].grp = grp;
+        grps[*len].score = strgrp_grp_score(grp);
+    }
+    return grps;
+}
+
+/* Release the groups taken by scored_grps_take() and free grps */
+static void
+scored_grps_free(StrgrpObject *owner, struct scored_grp *grps,
+        Py_ssize_t len) {
+    Py_ssize_t i;
+    Strgrp_lock(owner);
+    for (i = 0; i < len; i++) {
+        strgrp_grp_release(grps[i].grp);
+    }
+    Strgrp_unlock(owner);
+    free(grps);
+}
+
+/* Wrap the groups taken from a heap, taking ownership of grps */
+static PyObject *
+Grps_wrap(StrgrpObject *owner, struct scored_grp *grps, Py_ssize_t len) {
+    GrpsObject *const grpsobj = (GrpsObject *)PyType_GenericNew(&GrpsType, NULL, NULL);
+    if (!grpsobj) {
+        scored_grps_free(owner, grps, len);
+        return NULL;
+    }
+    Py_INCREF(owner);
+    grpsobj->owner = (PyObject *)owner;
+    grpsobj->grps = grps;
+    grpsobj->base = grps;
+    grpsobj->len = len;
+    grpsobj->step = 1;
+    return (PyObject *)grpsobj;
+}
+
+//
+// Strgrp
+//
 
 static PyObject *
 Grp_is_acceptible(GrpObject *self, PyObject *args) {
-    PyObject *py_ctx = NULL;
-    struct strgrp *ctx;
+    StrgrpObject *py_ctx = NULL;
     long acceptible;
 
-    if (!PyArg_ParseTuple(args, "O", &py_ctx)) {
+    if (!PyArg_ParseTuple(args, "O!", &StrgrpType, &py_ctx)) {
         return NULL;
     }
 
-    /* YOLO !? */
-    ctx = ((StrgrpObject *)(py_ctx))->grp;
-    acceptible = strgrp_grp_is_acceptible(ctx, self->grp);
+    /* Dirty thresholds may need an update, but scores may have changed since
+     * the search that produced this group */
+    Py_BEGIN_ALLOW_THREADS
+    PyThread_acquire_lock(py_ctx->lock, WAIT_LOCK);
+    acceptible = strgrp_grp_is_acceptible(py_ctx->grp, self->grp);
+    PyThread_release_lock(py_ctx->lock);
+    Py_END_ALLOW_THREADS
+    if (self->scored) {
+        acceptible = self->score >= 0;
+    }
     PyObject *py_acceptible = PyBool_FromLong(acceptible);
     Py_XINCREF(py_acceptible);
 
@@ -237,17 +658,16 @@ Grp_is_acceptible(GrpObject *self, PyObject *args) {
 
 static PyObject *
 Grp_is_dynamic(GrpObject *self, PyObject *args) {
-    PyObject *py_ctx = NULL;
-    struct strgrp *ctx;
+    StrgrpObject *py_ctx = NULL;
     long dynamic;
 
-    if (!PyArg_ParseTuple(args, "O", &py_ctx)) {
+    if (!PyArg_ParseTuple(args, "O!", &StrgrpType, &py_ctx)) {
         return NULL;
     }
 
-    /* YOLO !? */
-    ctx = ((StrgrpObject *)(py_ctx))->grp;
-    dynamic = strgrp_grp_is_dynamic(ctx, self->grp);
+    Strgrp_lock(py_ctx);
+    dynamic = strgrp_grp_is_dynamic(py_ctx->grp, self->grp);
+    Strgrp_unlock(py_ctx);
     PyObject *py_dynamic = PyBool_FromLong(dynamic);
     Py_XINCREF(py_dynamic);
 
@@ -256,13 +676,14 @@ Grp_is_dynamic(GrpObject *self, PyObject *args) {
 
 static PyObject *
 Grp_add(GrpObject *self, PyObject *args, PyObject *kwds) {
-    PyObject *py_ctx = NULL;
+    StrgrpObject *py_ctx = NULL;
     PyObject *data = NULL;
-    struct strgrp *ctx;
     char *key;
+    bool added;
 
     static char *kwlist[] = { "ctx", "key", "data", NULL };
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OsO", kwlist, &py_ctx, &key, &data)) {
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!sO", kwlist, &StrgrpType,
+                &py_ctx, &key, &data)) {
         return NULL;
     }
 
@@ -270,120 +691,460 @@ Grp_add(GrpObject *self, PyObject *args, PyObject *kwds) {
         return NULL;
     }
 
-    ctx = ((StrgrpObject *)py_ctx)->grp;
-
-    const bool added = strgrp_grp_add(ctx, self->grp, key, data);
+    Py_INCREF(data);
+    Py_BEGIN_ALLOW_THREADS
+    PyThread_acquire_lock(py_ctx->lock, WAIT_LOCK);
+    added = strgrp_grp_add(py_ctx->grp, self->grp, key, data);
+    PyThread_release_lock(py_ctx->lock);
+    Py_END_ALLOW_THREADS
     if (added) {
-        Py_INCREF(data);
         Py_RETURN_TRUE;
     }
 
+    Py_DECREF(data);
     Py_RETURN_FALSE;
 }
 
-static PyObject *
-Strgrp_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
-{
-    StrgrpObject *self = (StrgrpObject *)type->tp_alloc(type, 0);
-    if (self != NULL) {
-        self->thresh = 0.85;
-        self->grp = NULL;
-    }
-    return (PyObject *)self;
-}
-
-static int
-Strgrp_init(StrgrpObject *self, PyObject *args, PyObject *kwds) {
-    int size = 0;
-    double threshold = self->thresh;
-    static char *kwlist[] = {"threshold", "size", NULL};
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|di", kwlist, &threshold, &size)) {
-        return -1;
+/* Check an item position under the lock, raising IndexError if it is out of
+ * range */
+static bool
+Grp_in_range(GrpObject *self, Py_ssize_t index) {
+    if (index >= 0 && index < strgrp_grp_size(self->grp)) {
+        return true;
     }
-    self->grp = strgrp_new_dynamic(threshold, size);
-    if (!self->grp) {
-        return -1;
-    }
-    return 0;
-}
-
-static void
-xdecref(void *data) {
-    Py_XDECREF((PyObject *)data);
-}
-
-static void
-Strgrp_dealloc(PyObject *obj) {
-    StrgrpObject *self = (StrgrpObject *)obj;
-    strgrp_free_cb(self->grp, &xdecref);
-    Py_TYPE(self)->tp_free((PyObject *)self);
+    PyErr_SetString(PyExc_IndexError, "item index out of range");
+    return false;
 }
 
 static PyObject *
-Strgrp_grp_for(StrgrpObject *self, PyObject *args, PyObject *kwds) {
-    char *key;
-    static char *kwlist[] = { "key", NULL };
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "s", kwlist, &key)) {
+Grp_remove(GrpObject *self, PyObject *args, PyObject *kwds) {
+    StrgrpObject *py_ctx = NULL;
+    Py_ssize_t index;
+    void *data = NULL;
+    bool removed = false;
+    bool valid;
+
+    static char *kwlist[] = { "ctx", "index", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!n", kwlist, &StrgrpType,
+                &py_ctx, &index)) {
         return NULL;
     }
-    struct strgrp_grp * grp = strgrp_grp_for(self->grp, key);
-    if (!grp) {
-        Py_RETURN_NONE;
+
+    Strgrp_lock(py_ctx);
+    valid = Grp_in_range(self, index);
+    if (valid) {
+        removed = strgrp_grp_remove(py_ctx->grp, self->grp, index, &data);
     }
-    GrpObject * const grpobj = (GrpObject *)PyType_GenericNew(&GrpType, NULL, NULL);
-    if (!grpobj) {
+    Strgrp_unlock(py_ctx);
+    if (!valid) {
+        return NULL;
+    }
+    if (!removed) {
         return PyErr_NoMemory();
     }
-    grpobj->grp = grp;
-    return (PyObject *)grpobj;
+
+    /* The instance's reference passes to the caller */
+    return data;
 }
 
 static PyObject *
-Strgrp_grp_new(StrgrpObject *self, PyObject *args, PyObject *kwds) {
-    char *key;
-    PyObject *data = NULL;
-    static char *kwlist[] = { "key", "data", NULL };
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "sO", kwlist, &key, &data)) {
+Grp_move(GrpObject *self, PyObject *args, PyObject *kwds) {
+    StrgrpObject *py_ctx = NULL;
+    GrpObject *to = NULL;
+    Py_ssize_t index;
+    bool moved = false;
+    bool valid;
+    bool dissolved;
+
+    static char *kwlist[] = { "ctx", "index", "to", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!nO!", kwlist, &StrgrpType,
+                &py_ctx, &index, &GrpType, &to)) {
         return NULL;
     }
-    if (!data) {
+
+    Strgrp_lock(py_ctx);
+    valid = Grp_in_range(self, index);
+    dissolved = !strgrp_grp_size(to->grp);
+    if (valid && !dissolved) {
+        moved = strgrp_grp_move(py_ctx->grp, self->grp, index, to->grp);
+    }
+    Strgrp_unlock(py_ctx);
+    if (!valid) {
         return NULL;
     }
-    Py_INCREF(data);
-    struct strgrp_grp *grp = strgrp_grp_new(self->grp, key, data);
-    if (!grp) {
-        return PyErr_NoMemory();
+    if (dissolved) {
+        PyErr_SetString(PyExc_ValueError, "cannot move to a dissolved group");
+        return NULL;
     }
-    GrpObject * const grpobj = (GrpObject *)PyType_GenericNew(&GrpType, NULL, NULL);
-    if (!grpobj) {
+    if (!moved) {
         return PyErr_NoMemory();
     }
-    grpobj->grp = grp;
-    return (PyObject *)grpobj;
+
+    Py_RETURN_NONE;
 }
 
 static PyObject *
-Strgrp_add(StrgrpObject *self, PyObject *args, PyObject *kwds) {
-    char *key;
-    PyObject *data = NULL;
-    static char *kwlist[] = { "key", "data", NULL };
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "sO", kwlist, &key, &data)) {
+Grp_rekey(GrpObject *self, PyObject *args, PyObject *kwds) {
+    StrgrpObject *py_ctx = NULL;
+    Py_ssize_t index;
+    bool rekeyed = false;
+    bool valid;
+
+    static char *kwlist[] = { "ctx", "index", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!n", kwlist, &StrgrpType,
+                &py_ctx, &index)) {
         return NULL;
     }
-    if (!data) {
-        return NULL;
+
+    Strgrp_lock(py_ctx);
+    valid = Grp_in_range(self, index);
+    if (valid) {
+        rekeyed = strgrp_grp_rekey(py_ctx->grp, self->grp, index);
     }
-    Py_INCREF(data);
-    struct strgrp_grp * grp = strgrp_add(self->grp, key, data);
-    if (!grp) {
-        return PyErr_NoMemory();
+    Strgrp_unlock(py_ctx);
+    if (!valid) {
+        return NULL;
     }
-    GrpObject * const grpobj = (GrpObject *)PyType_GenericNew(&GrpType, NULL, NULL);
-    if (!grpobj) {
+    if (!rekeyed) {
         return PyErr_NoMemory();
     }
-    grpobj->grp = grp;
-    return (PyObject *)grpobj;
+
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+Grp_dissolve(GrpObject *self, PyObject *args) {
+    StrgrpObject *py_ctx = NULL;
+    PyObject **values;
+    PyObject *list;
+    Py_ssize_t i, n;
+
+    if (!PyArg_ParseTuple(args, "O!", &StrgrpType, &py_ctx)) {
+        return NULL;
+    }
+
+    /* Take the instance's references to the values, which pass to the list */
+    Strgrp_lock(py_ctx);
+    n = strgrp_grp_size(self->grp);
+    values = malloc((n ? n : 1) * sizeof(*values));
+    if (values) {
+        for (i = 0; i < n; i++) {
+            values[i] = strgrp_item_value(strgrp_grp_item_at(self->grp, i));
+        }
+        strgrp_grp_dissolve(py_ctx->grp, self->grp, NULL);
+    }
+    Strgrp_unlock(py_ctx);
+    if (!values) {
+        return PyErr_NoMemory();
+    }
+
+    list = PyList_New(n);
+    for (i = 0; i < n; i++) {
+        if (list) {
+            PyList_SET_ITEM(list, i, values[i]);
+        } else {
+            Py_DECREF(values[i]);
+        }
+    }
+    free(values);
+    return list;
+}
+
+/* Indexed by enum strgrp_metric */
+static const char *const metrics[] = { "lcs", "jaccard", "cosine" };
+
+static bool
+parse_metric(const char *const name, enum strgrp_metric *const metric) {
+    size_t i;
+    for (i = 0; i < sizeof(metrics) / sizeof(metrics[0]); i++) {
+        if (!strcmp(name, metrics[i])) {
+            *metric = i;
+            return true;
+        }
+    }
+    PyErr_Format(PyExc_ValueError,
+            "metric must be one of 'lcs', 'jaccard' or 'cosine', not '%s'",
+            name);
+    return false;
+}
+
+/* Indexed by enum strgrp_kernel */
+static const char *const kernels[] = { "scalar", "sse4.1", "avx2", "avx512" };
+
+/* Select the named kernel, or keep the scalar kernel if name is NULL */
+static bool
+Strgrp_kernel(struct strgrp *const grp, const char *const name) {
+    size_t i;
+    if (!name) {
+        return true;
+    }
+    for (i = 0; i < sizeof(kernels) / sizeof(kernels[0]); i++) {
+        if (!strcmp(name, kernels[i])) {
+            if (!strgrp_kernel(grp, i)) {
+                PyErr_Format(PyExc_ValueError,
+                        "kernel '%s' is not supported by this CPU", name);
+                return false;
+            }
+            return true;
+        }
+    }
+    PyErr_Format(PyExc_ValueError,
+            "kernel must be one of 'scalar', 'sse4.1', 'avx2' or 'avx512', not '%s'",
+            name);
+    return false;
+}
+
+/* Partition the groups of grp by their leading tokens, after stripping the
+ * first matching string of the sequence prefixes, which may be NULL */
+static bool
+Strgrp_partition(struct strgrp *const grp, const int tokens,
+        PyObject *const prefixes) {
+    PyObject *seq = NULL;
+    const char **strs = NULL;
+    Py_ssize_t i, n = 0;
+    bool ok = false;
+    if (prefixes && prefixes != Py_None) {
+        seq = PySequence_Fast(prefixes, "prefixes must be a sequence");
+        if (!seq) {
+            return false;
+        }
+        n = PySequence_Fast_GET_SIZE(seq);
+    }
+    strs = PyMem_New(const char *, n + 1);
+    if (!strs) {
+        PyErr_NoMemory();
+        goto cleanup;
+    }
+    for (i = 0; i < n; i++) {
+        strs[i] = PyUnicode_AsUTF8(PySequence_Fast_GET_ITEM(seq, i));
+        if (!strs[i]) {
+            goto cleanup;
+        }
+    }
+    ok = strgrp_partition(grp, strs, n, tokens);
+    if (!ok) {
+        PyErr_NoMemory();
+    }
+
+cleanup:
+    PyMem_Free(strs);
+    Py_XDECREF(seq);
+    return ok;
+}
+
+static PyObject *
+Strgrp_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    StrgrpObject *self = (StrgrpObject *)type->tp_alloc(type, 0);
+    if (self != NULL) {
+        self->thresh = 0.85;
+        self->grp = NULL;
+        self->lock = PyThread_allocate_lock();
+        if (!self->lock) {
+            Py_DECREF(self);
+            return PyErr_NoMemory();
+        }
+    }
+    return (PyObject *)self;
+}
+
+static int
+Strgrp_init(StrgrpObject *self, PyObject *args, PyObject *kwds) {
+    int size = 0;
+    int qgram = 0;
+    int bands = 0;
+    int rows = 2;
+    int samples = 0;
+    int threads = 0;
+    int chunk = 1;
+    unsigned int serial = 0;
+    int autotune = 0;
+    Py_ssize_t cache = 0;
+    const char *metric_name = "lcs";
+    const char *screen_name = NULL;
+    enum strgrp_metric metric, screen;
+    double margin = 0.1;
+    int partition = 0;
+    PyObject *prefixes = NULL;
+    const char *kernel = NULL;
+    double threshold = self->thresh;
+    static char *kwlist[] = {"threshold", "size", "qgram", "bands", "rows",
+        "samples", "threads", "chunk", "serial", "autotune", "cache", "metric",
+        "screen", "margin", "partition", "prefixes", "kernel", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|diiiiiiiIpnszdiOz", kwlist,
+                &threshold, &size, &qgram, &bands, &rows, &samples, &threads,
+                &chunk, &serial, &autotune, &cache, &metric_name, &screen_name,
+                &margin, &partition, &prefixes, &kernel)) {
+        return -1;
+    }
+    if (!parse_metric(metric_name, &metric)) {
+        return -1;
+    }
+    screen = metric;
+    if (screen_name && !parse_metric(screen_name, &screen)) {
+        return -1;
+    }
+    if (screen != metric && metric != STRGRP_METRIC_LCS) {
+        PyErr_SetString(PyExc_ValueError, "only the lcs metric can be screened");
+        return -1;
+    }
+    if (!(margin >= 0)) {
+        PyErr_SetString(PyExc_ValueError, "margin must be non-negative");
+        return -1;
+    }
+    if (qgram < 0 || qgram > 8) {
+        PyErr_SetString(PyExc_ValueError, "qgram must be in [0, 8]");
+        return -1;
+    }
+    if (bands < 0 || rows < 1 || (long)bands * rows > 1024) {
+        PyErr_SetString(PyExc_ValueError,
+                "bands must be non-negative, rows positive, and bands * rows at most 1024");
+        return -1;
+    }
+    if (samples < 0) {
+        PyErr_SetString(PyExc_ValueError, "samples must be non-negative");
+        return -1;
+    }
+    if (threads < 0 || chunk < 1) {
+        PyErr_SetString(PyExc_ValueError,
+                "threads must be non-negative and chunk positive");
+        return -1;
+    }
+    if (cache < 0) {
+        PyErr_SetString(PyExc_ValueError, "cache must be non-negative");
+        return -1;
+    }
+    if (partition < 0) {
+        PyErr_SetString(PyExc_ValueError, "partition must be non-negative");
+        return -1;
+    }
+    self->grp = strgrp_new_dynamic(threshold, size);
+    if (!self->grp) {
+        return -1;
+    }
+    strgrp_sample_threshold(self->grp, samples);
+    strgrp_schedule(self->grp, threads, chunk, serial, autotune);
+    strgrp_metric(self->grp, metric, screen, margin);
+    if (cache && !strgrp_cache_scores(self->grp, cache)) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    if (qgram && !strgrp_index_qgrams(self->grp, qgram)) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    if (bands && !strgrp_index_minhash(self->grp, bands, rows)) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    if (partition && !Strgrp_partition(self->grp, partition, prefixes)) {
+        return -1;
+    }
+    if (!Strgrp_kernel(self->grp, kernel)) {
+        return -1;
+    }
+    return 0;
+}
+
+static void
+xdecref(void *data) {
+    Py_XDECREF((PyObject *)data);
+}
+
+static void
+Strgrp_dealloc(PyObject *obj) {
+    StrgrpObject *self = (StrgrpObject *)obj;
+    if (self->grp) {
+        strgrp_free_cb(self->grp, &xdecref);
+    }
+    if (self->map) {
+        munmap(self->map, self->map_len);
+    }
+    if (self->view.obj) {
+        PyBuffer_Release(&self->view);
+    }
+    if (self->lock) {
+        PyThread_free_lock(self->lock);
+    }
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static PyObject *
+Strgrp_grp_for(StrgrpObject *self, PyObject *args, PyObject *kwds) {
+    char *key;
+    struct strgrp_grp *grp;
+    static char *kwlist[] = { "key", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "s", kwlist, &key)) {
+        return NULL;
+    }
+    Py_BEGIN_ALLOW_THREADS
+    PyThread_acquire_lock(self->lock, WAIT_LOCK);
+    grp = strgrp_grp_for(self->grp, key);
+    if (grp) {
+        strgrp_grp_hold(grp);
+    }
+    PyThread_release_lock(self->lock);
+    Py_END_ALLOW_THREADS
+    if (!grp) {
+        Py_RETURN_NONE;
+    }
+    return Grp_wrap(self, grp);
+}
+
+static PyObject *
+Strgrp_grp_new(StrgrpObject *self, PyObject *args, PyObject *kwds) {
+    char *key;
+    PyObject *data = NULL;
+    struct strgrp_grp *grp;
+    static char *kwlist[] = { "key", "data", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "sO", kwlist, &key, &data)) {
+        return NULL;
+    }
+    if (!data) {
+        return NULL;
+    }
+    Py_INCREF(data);
+    Py_BEGIN_ALLOW_THREADS
+    PyThread_acquire_lock(self->lock, WAIT_LOCK);
+    grp = strgrp_grp_new(self->grp, key, data);
+    if (grp) {
+        strgrp_grp_hold(grp);
+    }
+    PyThread_release_lock(self->lock);
+    Py_END_ALLOW_THREADS
+    if (!grp) {
+        Py_DECREF(data);
+        return PyErr_NoMemory();
+    }
+    return Grp_wrap(self, grp);
+}
+
+static PyObject *
+Strgrp_add(StrgrpObject *self, PyObject *args, PyObject *kwds) {
+    char *key;
+    PyObject *data = NULL;
+    struct strgrp_grp *grp;
+    static char *kwlist[] = { "key", "data", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "sO", kwlist, &key, &data)) {
+        return NULL;
+    }
+    if (!data) {
+        return NULL;
+    }
+    Py_INCREF(data);
+    Py_BEGIN_ALLOW_THREADS
+    PyThread_acquire_lock(self->lock, WAIT_LOCK);
+    grp = strgrp_add(self->grp, key, data);
+    if (grp) {
+        strgrp_grp_hold(grp);
+    }
+    PyThread_release_lock(self->lock);
+    Py_END_ALLOW_THREADS
+    if (!grp) {
+        Py_DECREF(data);
+        return PyErr_NoMemory();
+    }
+    return Grp_wrap(self, grp);
 }
 
 static PyObject *
@@ -394,93 +1155,798 @@ Strgrp_iter(PyObject *self) {
 
 static PyObject *
 Strgrp_iternext(StrgrpObject *self) {
+    struct strgrp_grp *grp;
+    Strgrp_lock(self);
     if (!self->iter) {
         self->iter = strgrp_iter_new(self->grp);
         if (!self->iter) {
+            Strgrp_unlock(self);
             return PyErr_NoMemory();
         }
     }
-    GrpObject *grp = (GrpObject *)PyType_GenericNew(&GrpType, NULL, NULL);
-    if (!grp) {
-        return PyErr_NoMemory();
-    }
-    grp->grp = strgrp_iter_next(self->iter);
-    if (!grp->grp) {
-        Grp_dealloc((PyObject *)grp);
+    grp = strgrp_iter_next(self->iter);
+    if (grp) {
+        strgrp_grp_hold(grp);
+    } else {
+        strgrp_iter_free(self->iter);
         self->iter = NULL;
+    }
+    Strgrp_unlock(self);
+    if (!grp) {
         /* Raising of standard StopIteration exception with empty value. */
         PyErr_SetNone(PyExc_StopIteration);
         return NULL;
     }
-    return (PyObject *)grp;
+    return Grp_wrap(self, grp);
 }
 
 static PyObject *
 Strgrp_grp_exact(StrgrpObject *self, PyObject *args, PyObject *kwds) {
     char *key;
+    struct strgrp_grp *grp;
     static char *kwlist[] = { "key", NULL };
     if (!PyArg_ParseTupleAndKeywords(args, kwds, "s", kwlist, &key)) {
         return NULL;
     }
-    struct strgrp_grp * grp = strgrp_grp_exact(self->grp, key);
+    Strgrp_lock(self);
+    grp = strgrp_grp_exact(self->grp, key);
+    if (grp) {
+        strgrp_grp_hold(grp);
+    }
+    Strgrp_unlock(self);
     if (!grp) {
         Py_RETURN_NONE;
     }
-    GrpObject * const grpobj = (GrpObject *)PyType_GenericNew(&GrpType, NULL, NULL);
-    if (!grpobj) {
-        return PyErr_NoMemory();
-    }
-    grpobj->grp = grp;
-    return (PyObject *)grpobj;
+    return Grp_wrap(self, grp);
 }
 
 static PyObject *
 Strgrp_grps_for(StrgrpObject *self, PyObject *args, PyObject *kwds) {
     char *key;
-    static char *kwlist[] = { "key", NULL };
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "s", kwlist, &key)) {
+    Py_ssize_t k = 0;
+    double min_score = -Py_HUGE_VAL;
+    struct scored_grp *grps = NULL;
+    struct heap *heap;
+    Py_ssize_t len = 0;
+    static char *kwlist[] = { "key", "k", "min_score", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "s|nd", kwlist, &key, &k,
+                &min_score)) {
+        return NULL;
+    }
+    if (k < 0) {
+        PyErr_SetString(PyExc_ValueError, "k must be non-negative");
         return NULL;
     }
 
-    struct heap *heap = strgrp_grps_for(self->grp, key);
+    /* Capture the order and scores before releasing the lock, as a concurrent
+     * search will overwrite the scores */
+    Py_BEGIN_ALLOW_THREADS
+    PyThread_acquire_lock(self->lock, WAIT_LOCK);
+    heap = strgrp_grps_top(self->grp, key, k, min_score);
+    if (heap) {
+        grps = scored_grps_take(heap, &len);
+        heap_free(heap);
+    }
+    PyThread_release_lock(self->lock);
+    Py_END_ALLOW_THREADS
+
     if (!heap) {
         Py_RETURN_NONE;
     }
+    if (!grps) {
+        return PyErr_NoMemory();
+    }
 
-    PyObject *tupleobj = PyTuple_New(heap->len);
-    if (!tupleobj) {
+    return Grps_wrap(self, grps, len);
+}
+
+static PyObject *
+Strgrp_add_many(StrgrpObject *self, PyObject *args, PyObject *kwds) {
+    PyObject *items;
+    PyObject *seq;
+    PyObject *result = NULL;
+    const char **strs = NULL;
+    void **data = NULL;
+    struct strgrp_grp **grps = NULL;
+    Py_ssize_t i, n;
+    size_t done = 0;
+    static char *kwlist[] = { "items", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O", kwlist, &items)) {
+        return NULL;
+    }
+    seq = PySequence_Fast(items, "items must be iterable");
+    if (!seq) {
+        return NULL;
+    }
+    n = PySequence_Fast_GET_SIZE(seq);
+    strs = PyMem_Malloc((n ? n : 1) * sizeof(*strs));
+    data = PyMem_Malloc((n ? n : 1) * sizeof(*data));
+    grps = PyMem_Malloc((n ? n : 1) * sizeof(*grps));
+    if (!strs || !data || !grps) {
         PyErr_NoMemory();
-        goto cleanup_heap;
+        goto cleanup;
+    }
+    /* The keys remain owned by the items, which are kept alive by seq */
+    for (i = 0; i < n; i++) {
+        PyObject *item = PySequence_Fast_GET_ITEM(seq, i);
+        PyObject *key;
+        if (!PyTuple_Check(item) || PyTuple_GET_SIZE(item) != 2) {
+            PyErr_SetString(PyExc_TypeError, "items must be (key, data) pairs");
+            goto cleanup;
+        }
+        key = PyTuple_GET_ITEM(item, 0);
+        strs[i] = PyUnicode_Check(key) ? PyUnicode_AsUTF8(key) : NULL;
+        if (!strs[i]) {
+            if (!PyErr_Occurred()) {
+                PyErr_SetString(PyExc_TypeError, "keys must be strings");
+            }
+            goto cleanup;
+        }
+        data[i] = PyTuple_GET_ITEM(item, 1);
     }
 
-    struct strgrp_grp *grp;
-    Py_ssize_t i;
-    for (i = 0; heap->len && (grp = heap_pop(heap)); i++) {
-        GrpObject *const grpobj = (GrpObject *)PyType_GenericNew(&GrpType, NULL, NULL);
+    for (i = 0; i < n; i++) {
+        Py_INCREF((PyObject *)data[i]);
+    }
+    Py_BEGIN_ALLOW_THREADS
+    PyThread_acquire_lock(self->lock, WAIT_LOCK);
+    done = strgrp_add_many(self->grp, strs, data, n, grps);
+    for (i = 0; i < (Py_ssize_t)done; i++) {
+        strgrp_grp_hold(grps[i]);
+    }
+    PyThread_release_lock(self->lock);
+    Py_END_ALLOW_THREADS
+    for (i = done; i < n; i++) {
+        Py_DECREF((PyObject *)data[i]);
+    }
+    if (done < (size_t)n) {
+        PyErr_NoMemory();
+        goto release;
+    }
+
+    result = PyList_New(n);
+    if (!result) {
+        goto release;
+    }
+    /* Each Grp object takes over the hold of its group */
+    for (i = 0; i < n; i++) {
+        PyObject *grpobj = Grp_wrap(self, grps[i]);
         if (!grpobj) {
-            goto cleanup_tuple;
+            Py_CLEAR(result);
+            i++;
+            goto release;
+        }
+        PyList_SET_ITEM(result, i, grpobj);
+    }
+    goto cleanup;
+
+release:
+    Strgrp_lock(self);
+    for (; i < (Py_ssize_t)done; i++) {
+        strgrp_grp_release(grps[i]);
+    }
+    Strgrp_unlock(self);
+
+cleanup:
+    PyMem_Free(strs);
+    PyMem_Free(data);
+    PyMem_Free(grps);
+    Py_DECREF(seq);
+
+    return result;
+}
+
+struct scored_grps {
+    struct scored_grp **grps;
+    Py_ssize_t *lens;
+};
+
+static bool
+scored_grps_take_many(void *arg, size_t i, struct heap *heap) {
+    struct scored_grps *const taken = arg;
+    taken->grps[i] = scored_grps_take(heap, &taken->lens[i]);
+    return taken->grps[i] != NULL;
+}
+
+static PyObject *
+Strgrp_grps_for_many(StrgrpObject *self, PyObject *args, PyObject *kwds) {
+    PyObject *keys;
+    PyObject *seq;
+    PyObject *result = NULL;
+    const char **strs = NULL;
+    struct scored_grps taken = { NULL, NULL };
+    Py_ssize_t k = 0;
+    double min_score = -Py_HUGE_VAL;
+    Py_ssize_t i, n;
+    size_t done = 0;
+    static char *kwlist[] = { "keys", "k", "min_score", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|nd", kwlist, &keys, &k,
+                &min_score)) {
+        return NULL;
+    }
+    if (k < 0) {
+        PyErr_SetString(PyExc_ValueError, "k must be non-negative");
+        return NULL;
+    }
+    seq = PySequence_Fast(keys, "keys must be iterable");
+    if (!seq) {
+        return NULL;
+    }
+    n = PySequence_Fast_GET_SIZE(seq);
+    strs = PyMem_Malloc((n ? n : 1) * sizeof(*strs));
+    taken.grps = PyMem_Malloc((n ? n : 1) * sizeof(*taken.grps));
+    taken.lens = PyMem_Malloc((n ? n : 1) * sizeof(*taken.lens));
+    if (!strs || !taken.grps || !taken.lens) {
+        PyErr_NoMemory();
+        goto cleanup;
+    }
+    for (i = 0; i < n; i++) {
+        PyObject *key = PySequence_Fast_GET_ITEM(seq, i);
+        strs[i] = PyUnicode_Check(key) ? PyUnicode_AsUTF8(key) : NULL;
+        if (!strs[i]) {
+            if (!PyErr_Occurred()) {
+                PyErr_SetString(PyExc_TypeError, "keys must be strings");
+            }
+            goto cleanup;
+        }
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    PyThread_acquire_lock(self->lock, WAIT_LOCK);
+    done = strgrp_grps_top_many(self->grp, strs, n, k, min_score,
+            scored_grps_take_many, &taken);
+    PyThread_release_lock(self->lock);
+    Py_END_ALLOW_THREADS
+    if (done < (size_t)n) {
+        PyErr_NoMemory();
+        goto cleanup;
+    }
+
+    result = PyList_New(n);
+    if (!result) {
+        goto cleanup;
+    }
+    /* Ownership of each set of groups passes to its Grps object */
+    for (i = 0; i < n; i++) {
+        PyObject *grpsobj = Grps_wrap(self, taken.grps[i], taken.lens[i]);
+        taken.grps[i] = NULL;
+        if (!grpsobj) {
+            Py_CLEAR(result);
+            goto cleanup;
+        }
+        PyList_SET_ITEM(result, i, grpsobj);
+    }
+
+cleanup:
+    for (i = 0; i < (Py_ssize_t)done; i++) {
+        if (taken.grps[i]) {
+            scored_grps_free(self, taken.grps[i], taken.lens[i]);
         }
-        grpobj->grp = grp;
-        if (PyTuple_SetItem(tupleobj, i, (PyObject *)grpobj)) {
-            Py_XDECREF((PyObject *)grpobj);
-            goto cleanup_tuple;
-        };
     }
+    PyMem_Free(strs);
+    PyMem_Free(taken.grps);
+    PyMem_Free(taken.lens);
+    Py_DECREF(seq);
 
-    heap_free(heap);
+    return result;
+}
 
-    return (PyObject *)tupleobj;
+static PyObject *
+Strgrp_pruned(StrgrpObject *self) {
+    unsigned long pruned;
+    Strgrp_lock(self);
+    pruned = strgrp_minhash_pruned(self->grp);
+    Strgrp_unlock(self);
+    return PyLong_FromUnsignedLong(pruned);
+}
 
-cleanup_tuple:
-    while (--i >= 0) {
-        Py_XDECREF((PyObject *)PyTuple_GetItem(tupleobj, i));
+static PyObject *
+pickle_function(const char *name) {
+    PyObject *function;
+    PyObject *pickle = PyImport_ImportModule("pickle");
+    if (!pickle) {
+        return NULL;
     }
-    Py_XDECREF((PyObject *)tupleobj);
+    function = PyObject_GetAttrString(pickle, name);
+    Py_DECREF(pickle);
+    return function;
+}
+
+/* Snapshots are retried if items are added while their values are pickled */
+#define SNAPSHOT_TRIES 4
 
-cleanup_heap:
-    heap_free(heap);
+struct pickled_values {
+    /* The pickled values keyed by their addresses */
+    PyObject *dict;
+    /* Set if an item was added after the values were pickled */
+    bool changed;
+};
 
-    return NULL;
+static bool
+Strgrp_save_value(void *arg, void *value, FILE *f) {
+    struct pickled_values *const pickled = arg;
+    PyObject *key = PyLong_FromVoidPtr(value);
+    PyObject *bytes;
+    bool ok;
+    if (!key) {
+        return false;
+    }
+    bytes = PyDict_GetItemWithError(pickled->dict, key);
+    Py_DECREF(key);
+    if (!bytes) {
+        pickled->changed = !PyErr_Occurred();
+        return false;
+    }
+    ok = fwrite(PyBytes_AS_STRING(bytes), 1, PyBytes_GET_SIZE(bytes), f)
+        == (size_t)PyBytes_GET_SIZE(bytes);
+    if (!ok) {
+        PyErr_SetFromErrno(PyExc_OSError);
+    }
+    return ok;
+}
+
+/* Collect new references to the item values into a list. Called with the
+ * lock held. */
+static PyObject *
+Strgrp_values(StrgrpObject *self) {
+    PyObject *values = PyList_New(0);
+    struct strgrp_iter *iter;
+    struct strgrp_grp_iter *grp_iter;
+    const struct strgrp_grp *grp;
+    const struct strgrp_item *item;
+    PyObject *value;
+    if (!values) {
+        return NULL;
+    }
+    iter = strgrp_iter_new(self->grp);
+    if (!iter) {
+        Py_DECREF(values);
+        return PyErr_NoMemory();
+    }
+    while ((grp = strgrp_iter_next(iter))) {
+        grp_iter = strgrp_grp_iter_new(grp);
+        if (!grp_iter) {
+            PyErr_NoMemory();
+            break;
+        }
+        while ((item = strgrp_grp_iter_next(grp_iter))) {
+            value = strgrp_item_value(item);
+            if (value && PyList_Append(values, value)) {
+                break;
+            }
+        }
+        strgrp_grp_iter_free(grp_iter);
+        if (PyErr_Occurred()) {
+            break;
+        }
+    }
+    strgrp_iter_free(iter);
+    if (PyErr_Occurred()) {
+        Py_CLEAR(values);
+    }
+    return values;
+}
+
+/* Pickle the values into a dict keyed by their addresses, which the values
+ * list keeps valid */
+static PyObject *
+Strgrp_pickle_values(PyObject *values) {
+    PyObject *dumps = pickle_function("dumps");
+    PyObject *pickled;
+    PyObject *key;
+    PyObject *bytes;
+    Py_ssize_t i;
+    int found;
+    if (!dumps) {
+        return NULL;
+    }
+    pickled = PyDict_New();
+    for (i = 0; pickled && i < PyList_GET_SIZE(values); i++) {
+        key = PyLong_FromVoidPtr(PyList_GET_ITEM(values, i));
+        found = key ? PyDict_Contains(pickled, key) : -1;
+        bytes = found ? NULL : PyObject_CallFunctionObjArgs(dumps,
+                PyList_GET_ITEM(values, i), NULL);
+        if (bytes && !PyBytes_Check(bytes)) {
+            PyErr_SetString(PyExc_TypeError,
+                    "pickle.dumps() did not return bytes");
+            Py_CLEAR(bytes);
+        }
+        if (found < 0 || (!found && (!bytes ||
+                        PyDict_SetItem(pickled, key, bytes)))) {
+            Py_CLEAR(pickled);
+        }
+        Py_XDECREF(bytes);
+        Py_XDECREF(key);
+    }
+    Py_DECREF(dumps);
+    return pickled;
+}
+
+/* Write a snapshot to f, pickling the item data. Pickling a value may call
+ * back into the instance, whose lock is not re-entrant, so the values are
+ * pickled before the lock is taken to save. Sets an exception on failure,
+ * unless the instance gained items in the meantime and retry is set, in which
+ * case the snapshot should be retried with one fewer of the tries left. */
+static bool
+Strgrp_snapshot(StrgrpObject *self, FILE *f, int tries, bool *retry) {
+    struct pickled_values pickled = { NULL, false };
+    PyObject *values;
+    bool ok;
+    *retry = false;
+    if (self->pickler == PyThread_get_thread_ident()) {
+        PyErr_SetString(PyExc_ValueError,
+                "Strgrp values cannot refer to their own Strgrp");
+        return false;
+    }
+    Strgrp_lock(self);
+    values = Strgrp_values(self);
+    Strgrp_unlock(self);
+    if (!values) {
+        return false;
+    }
+    if (!self->pickler) {
+        self->pickler = PyThread_get_thread_ident();
+        pickled.dict = Strgrp_pickle_values(values);
+        self->pickler = 0;
+    } else {
+        pickled.dict = Strgrp_pickle_values(values);
+    }
+    if (!pickled.dict) {
+        Py_DECREF(values);
+        return false;
+    }
+    Strgrp_lock(self);
+    ok = strgrp_save(self->grp, f, &Strgrp_save_value, &pickled);
+    Strgrp_unlock(self);
+    Py_DECREF(pickled.dict);
+    Py_DECREF(values);
+    *retry = pickled.changed && tries > 1;
+    if (pickled.changed && !*retry) {
+        PyErr_SetString(PyExc_RuntimeError,
+                "Strgrp changed while pickling its values");
+    } else if (!ok && !*retry && !PyErr_Occurred()) {
+        PyErr_SetFromErrno(PyExc_OSError);
+    }
+    return ok;
+}
+
+static PyObject *
+Strgrp_save(StrgrpObject *self, PyObject *args, PyObject *kwds) {
+    PyObject *path;
+    PyObject *tmp;
+    FILE *f;
+    int tries = SNAPSHOT_TRIES;
+    bool retry;
+    bool ok;
+    static char *kwlist[] = { "path", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O&", kwlist,
+                PyUnicode_FSConverter, &path)) {
+        return NULL;
+    }
+    /* Write aside and rename, as the file may back a loaded instance */
+    tmp = PyBytes_FromFormat("%s.tmp", PyBytes_AS_STRING(path));
+    if (!tmp) {
+        Py_DECREF(path);
+        return NULL;
+    }
+    do {
+        f = fopen(PyBytes_AS_STRING(tmp), "wb");
+        if (!f) {
+            PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, tmp);
+            Py_DECREF(tmp);
+            Py_DECREF(path);
+            return NULL;
+        }
+        ok = Strgrp_snapshot(self, f, tries--, &retry);
+        if (fclose(f) && ok) {
+            PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, tmp);
+            ok = false;
+        }
+    } while (retry);
+    if (ok && rename(PyBytes_AS_STRING(tmp), PyBytes_AS_STRING(path))) {
+        PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, path);
+        ok = false;
+    }
+    if (!ok) {
+        unlink(PyBytes_AS_STRING(tmp));
+    }
+    Py_DECREF(tmp);
+    Py_DECREF(path);
+    if (!ok) {
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+Strgrp_dumps(StrgrpObject *self) {
+    PyObject *result = NULL;
+    char *buf;
+    size_t len;
+    FILE *f;
+    int tries = SNAPSHOT_TRIES;
+    bool retry;
+    bool ok;
+    do {
+        buf = NULL;
+        len = 0;
+        f = open_memstream(&buf, &len);
+        if (!f) {
+            return PyErr_SetFromErrno(PyExc_OSError);
+        }
+        ok = Strgrp_snapshot(self, f, tries--, &retry);
+        if (fclose(f) && ok) {
+            PyErr_SetFromErrno(PyExc_OSError);
+            ok = false;
+        }
+        if (ok) {
+            result = PyBytes_FromStringAndSize(buf, len);
+        }
+        free(buf);
+    } while (retry);
+    return result;
+}
+
+static PyObject *
+Strgrp_reduce(StrgrpObject *self) {
+    PyObject *loads;
+    PyObject *snapshot;
+    loads = PyObject_GetAttrString((PyObject *)Py_TYPE(self), "loads");
+    if (!loads) {
+        return NULL;
+    }
+    snapshot = Strgrp_dumps(self);
+    if (!snapshot) {
+        Py_DECREF(loads);
+        return NULL;
+    }
+    return Py_BuildValue("(N(N))", loads, snapshot);
+}
+
+static bool
+Strgrp_load_value(void *arg, const void *data, size_t len, void **value) {
+    PyObject *view = PyMemoryView_FromMemory((char *)data, len, PyBUF_READ);
+    if (!view) {
+        return false;
+    }
+    *value = PyObject_CallFunctionObjArgs((PyObject *)arg, view, NULL);
+    Py_DECREF(view);
+    return *value != NULL;
+}
+
+/* Restore the instance of a new Strgrp from the snapshot in buf, which must
+ * outlive it. Sets an exception on failure */
+static bool
+Strgrp_restore(StrgrpObject *self, const void *buf, size_t len) {
+    PyObject *loads = pickle_function("loads");
+    if (!loads) {
+        return false;
+    }
+    self->grp = strgrp_load(buf, len, &Strgrp_load_value, &xdecref, loads);
+    Py_DECREF(loads);
+    if (!self->grp) {
+        if (!PyErr_Occurred()) {
+            PyErr_SetString(PyExc_ValueError, "Invalid strgrp snapshot");
+        }
+        return false;
+    }
+    return true;
+}
+
+/* Map the file at the path converted by PyUnicode_FSConverter(), consuming
+ * the reference. Sets an exception on failure, a ValueError if it is empty */
+static void *
+map_file(PyObject *path, const char *what, size_t *len) {
+    struct stat st;
+    void *map;
+    int fd = open(PyBytes_AS_STRING(path), O_RDONLY);
+    if (fd < 0 || fstat(fd, &st)) {
+        PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, path);
+        if (fd >= 0) {
+            close(fd);
+        }
+        Py_DECREF(path);
+        return NULL;
+    }
+    if (!st.st_size) {
+        close(fd);
+        Py_DECREF(path);
+        PyErr_Format(PyExc_ValueError, "Invalid %s", what);
+        return NULL;
+    }
+    map = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+    close(fd);
+    if (map == MAP_FAILED) {
+        PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, path);
+        Py_DECREF(path);
+        return NULL;
+    }
+    Py_DECREF(path);
+    *len = st.st_size;
+    return map;
+}
+
+static PyObject *
+Strgrp_load(PyTypeObject *type, PyObject *args, PyObject *kwds) {
+    PyObject *path;
+    StrgrpObject *self;
+    size_t len;
+    void *map;
+    static char *kwlist[] = { "path", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O&", kwlist,
+                PyUnicode_FSConverter, &path)) {
+        return NULL;
+    }
+    map = map_file(path, "strgrp snapshot", &len);
+    if (!map) {
+        return NULL;
+    }
+    self = (StrgrpObject *)Strgrp_new(type, NULL, NULL);
+    if (!self) {
+        munmap(map, len);
+        return NULL;
+    }
+    self->map = map;
+    self->map_len = len;
+    if (!Strgrp_restore(self, map, len)) {
+        Py_DECREF(self);
+        return NULL;
+    }
+    return (PyObject *)self;
+}
+
+static PyObject *
+Strgrp_loads(PyTypeObject *type, PyObject *args, PyObject *kwds) {
+    StrgrpObject *self;
+    Py_buffer view;
+    static char *kwlist[] = { "buffer", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "y*", kwlist, &view)) {
+        return NULL;
+    }
+    self = (StrgrpObject *)Strgrp_new(type, NULL, NULL);
+    if (!self) {
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+    self->view = view;
+    if (!Strgrp_restore(self, view.buf, view.len)) {
+        Py_DECREF(self);
+        return NULL;
+    }
+    return (PyObject *)self;
+}
+
+static PyObject *
+Strgrp_get_schedule(StrgrpObject *self) {
+    int threads;
+    int chunk;
+    unsigned int serial;
+    bool autotune;
+    Strgrp_lock(self);
+    strgrp_get_schedule(self->grp, &threads, &chunk, &serial, &autotune);
+    Strgrp_unlock(self);
+    return Py_BuildValue("{s:i,s:i,s:I,s:O}", "threads", threads, "chunk",
+            chunk, "serial", serial, "autotune",
+            autotune ? Py_True : Py_False);
+}
+
+static PyObject *
+Strgrp_get_metric(StrgrpObject *self) {
+    enum strgrp_metric metric;
+    enum strgrp_metric screen;
+    double margin;
+    Strgrp_lock(self);
+    strgrp_get_metric(self->grp, &metric, &screen, &margin);
+    Strgrp_unlock(self);
+    return Py_BuildValue("{s:s,s:s,s:d}", "metric", metrics[metric],
+            "screen", metrics[screen], "margin", margin);
+}
+
+static PyObject *
+Strgrp_get_kernel(StrgrpObject *self) {
+    enum strgrp_kernel kernel;
+    int lanes;
+    Strgrp_lock(self);
+    kernel = strgrp_get_kernel(self->grp, &lanes);
+    Strgrp_unlock(self);
+    return Py_BuildValue("{s:s,s:i}", "kernel", kernels[kernel], "lanes",
+            lanes);
+}
+
+static PyObject *
+Strgrp_cache_stats(StrgrpObject *self) {
+    size_t entries;
+    unsigned long hits;
+    unsigned long misses;
+    unsigned long evictions;
+    Strgrp_lock(self);
+    strgrp_cache_stats(self->grp, &entries, &hits, &misses, &evictions);
+    Strgrp_unlock(self);
+    return Py_BuildValue("{s:n,s:k,s:k,s:k}", "entries", (Py_ssize_t)entries,
+            "hits", hits, "misses", misses, "evictions", evictions);
+}
+
+static PyObject *
+Strgrp_stats(StrgrpObject *self) {
+    struct strgrp_stats stats;
+    Strgrp_lock(self);
+    strgrp_stats(self->grp, &stats);
+    Strgrp_unlock(self);
+    return Py_BuildValue("{s:k,s:k,s:k,s:k,s:k,s:k,s:k,s:K,s:k,s:k,s:d,s:d,s:d}",
+            "searches", stats.searches, "exact", stats.exact,
+            "scanned", stats.scanned, "rejected_len", stats.rejected_len,
+            "rejected", stats.rejected, "lcs", stats.lcs,
+            "cheap", stats.cheap, "cells", stats.cells, "thresholds", stats.thresholds,
+            "widened", stats.widened,
+            "prepare_time", stats.prepare_time,
+            "score_time", stats.score_time,
+            "insert_time", stats.insert_time);
+}
+
+static PyObject *
+Strgrp_reset_stats(StrgrpObject *self) {
+    Strgrp_lock(self);
+    strgrp_stats_reset(self->grp);
+    Strgrp_unlock(self);
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+Strgrp_save_cache(StrgrpObject *self, PyObject *args, PyObject *kwds) {
+    PyObject *path;
+    FILE *f;
+    bool ok;
+    static char *kwlist[] = { "path", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O&", kwlist,
+                PyUnicode_FSConverter, &path)) {
+        return NULL;
+    }
+    f = fopen(PyBytes_AS_STRING(path), "wb");
+    if (!f) {
+        PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, path);
+        Py_DECREF(path);
+        return NULL;
+    }
+    Strgrp_lock(self);
+    ok = strgrp_cache_save(self->grp, f);
+    Strgrp_unlock(self);
+    if (fclose(f)) {
+        ok = false;
+    }
+    if (!ok) {
+        PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, path);
+    }
+    Py_DECREF(path);
+    if (!ok) {
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+Strgrp_load_cache(StrgrpObject *self, PyObject *args, PyObject *kwds) {
+    PyObject *path;
+    size_t len;
+    void *map;
+    bool ok;
+    static char *kwlist[] = { "path", NULL };
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O&", kwlist,
+                PyUnicode_FSConverter, &path)) {
+        return NULL;
+    }
+    map = map_file(path, "score cache", &len);
+    if (!map) {
+        return NULL;
+    }
+    Strgrp_lock(self);
+    ok = strgrp_cache_load(self->grp, map, len);
+    Strgrp_unlock(self);
+    munmap(map, len);
+    if (!ok) {
+        PyErr_SetString(PyExc_ValueError, "Invalid score cache");
+        return NULL;
+    }
+    Py_RETURN_NONE;
 }
 
 static PyMethodDef Strgrp_methods[] = {
@@ -493,13 +1959,60 @@ static PyMethodDef Strgrp_methods[] = {
     { "grp_exact", (PyCFunction)Strgrp_grp_exact,
         (METH_VARARGS | METH_KEYWORDS), "Find group by exact match" },
     { "grps_for", (PyCFunction)Strgrp_grps_for, (METH_VARARGS | METH_KEYWORDS),
-        "Provide a tuple of groups ordered by match score descending" },
+        "Provide a sequence of groups ordered by match score descending,\n"
+        "optionally limited to the best k scoring at least min_score" },
+    { "add_many", (PyCFunction)Strgrp_add_many,
+        (METH_VARARGS | METH_KEYWORDS),
+        "Cluster a sequence of (string, data) pairs, providing their groups" },
+    { "grps_for_many", (PyCFunction)Strgrp_grps_for_many,
+        (METH_VARARGS | METH_KEYWORDS),
+        "Provide the ordered groups for each of a sequence of strings, as\n"
+        "for grps_for()" },
+    { "pruned", (PyCFunction)Strgrp_pruned, METH_NOARGS,
+        "Count the candidate groups skipped by approximate search" },
+    { "schedule", (PyCFunction)Strgrp_get_schedule, METH_NOARGS,
+        "Describe the parallel scoring of groups. The serial threshold is\n"
+        "the current estimate if autotune is set" },
+    { "metric", (PyCFunction)Strgrp_get_metric, METH_NOARGS,
+        "Describe the measure of similarity. The screen is the metric\n"
+        "itself if pairs are not screened" },
+    { "kernel", (PyCFunction)Strgrp_get_kernel, METH_NOARGS,
+        "Describe the implementation of the LCS comparison, and the number\n"
+        "of group keys it compares at a time" },
+    { "cache_stats", (PyCFunction)Strgrp_cache_stats, METH_NOARGS,
+        "Describe the use of the score cache" },
+    { "stats", (PyCFunction)Strgrp_stats, METH_NOARGS,
+        "Count the work done by the instance since construction or the last\n"
+        "call to reset_stats(). Times are in seconds" },
+    { "reset_stats", (PyCFunction)Strgrp_reset_stats, METH_NOARGS,
+        "Zero the counts provided by stats()" },
+    { "save_cache", (PyCFunction)Strgrp_save_cache,
+        (METH_VARARGS | METH_KEYWORDS),
+        "Write the score cache to a file, which must be enabled" },
+    { "load_cache", (PyCFunction)Strgrp_load_cache,
+        (METH_VARARGS | METH_KEYWORDS),
+        "Add the scores written by save_cache() to the score cache" },
+    { "save", (PyCFunction)Strgrp_save, (METH_VARARGS | METH_KEYWORDS),
+        "Write a snapshot of the groups to a file, pickling the item data" },
+    { "load", (PyCFunction)Strgrp_load,
+        (METH_VARARGS | METH_KEYWORDS | METH_CLASS),
+        "Construct a Strgrp from a snapshot file written by save(). The file\n"
+        "is mapped and its groups used without scoring" },
+    { "dumps", (PyCFunction)Strgrp_dumps, METH_NOARGS,
+        "Provide a snapshot of the groups as bytes, as written by save()" },
+    { "loads", (PyCFunction)Strgrp_loads,
+        (METH_VARARGS | METH_KEYWORDS | METH_CLASS),
+        "Construct a Strgrp from a snapshot in a bytes-like object, such as\n"
+        "one provided by dumps(). The buffer is used in place and must not be\n"
+        "modified while the Strgrp exists" },
+    { "__reduce__", (PyCFunction)Strgrp_reduce, METH_NOARGS,
+        "Pickle the Strgrp as its snapshot" },
     {NULL}
 };
 
 static PyTypeObject StrgrpType = {
     PyVarObject_HEAD_INIT(NULL, 0)
-    "strgrp.Strgrp",           /* tp_name */
+    "pystrgrp.Strgrp",           /* tp_name */
     sizeof(StrgrpObject),      /* tp_basicsize */
     0,                         /* tp_itemsize */
     &Strgrp_dealloc,            /* tp_dealloc */
@@ -518,7 +2031,12 @@ static PyTypeObject StrgrpType = {
     0,                         /* tp_setattro */
     0,                         /* tp_as_buffer */
     Py_TPFLAGS_DEFAULT,        /* tp_flags */
-    "Strgrp object",           /* tp_doc */
+    "Cluster strings based on longest common subsequence\n\n"
+    "Methods may be called concurrently from multiple threads. Calls on one\n"
+    "Strgrp are serialised, with the GIL released while strings are scored,\n"
+    "so distinct Strgrp objects are searched in parallel. Groups provided by\n"
+    "grps_for() report acceptibility as of that search. Iteration is not\n"
+    "thread-safe, as Strgrp and Grp objects are their own iterators.", /* tp_doc */
     0,                         /* tp_traverse */
     0,                         /* tp_clear */
     0,                         /* tp_richcompare */
@@ -538,12 +2056,82 @@ static PyTypeObject StrgrpType = {
     Strgrp_new,                /* tp_new */
 };
 
+/* Unpickle a group, which is pickled with its owning Strgrp */
+static PyObject *
+pystrgrp_grp(PyObject *module, PyObject *args) {
+    StrgrpObject *owner;
+    unsigned int i;
+    struct strgrp_grp *grp;
+    if (!PyArg_ParseTuple(args, "O!I", &StrgrpType, &owner, &i)) {
+        return NULL;
+    }
+    Strgrp_lock(owner);
+    grp = strgrp_grp_at(owner->grp, i);
+    if (grp) {
+        strgrp_grp_hold(grp);
+    }
+    Strgrp_unlock(owner);
+    if (!grp) {
+        PyErr_SetString(PyExc_IndexError, "group index out of range");
+        return NULL;
+    }
+    return Grp_wrap(owner, grp);
+}
+
+static PyObject *
+pystrgrp_item(PyObject *module, PyObject *args) {
+    StrgrpObject *owner;
+    unsigned int i;
+    Py_ssize_t j;
+    ItemObject *item;
+    const struct strgrp_item *found = NULL;
+    bool filled;
+    struct strgrp_grp *grp;
+    if (!PyArg_ParseTuple(args, "O!In", &StrgrpType, &owner, &i, &j)) {
+        return NULL;
+    }
+    item = (ItemObject *)PyType_GenericNew(&ItemType, NULL, NULL);
+    if (!item) {
+        return NULL;
+    }
+    Py_INCREF(owner);
+    item->owner = owner;
+    Strgrp_lock(owner);
+    grp = strgrp_grp_at(owner->grp, i);
+    if (grp && j >= 0) {
+        found = strgrp_grp_item_at(grp, j);
+    }
+    filled = found && Item_fill(item, found);
+    if (filled) {
+        strgrp_grp_hold(grp);
+        item->grp = grp;
+    }
+    Strgrp_unlock(owner);
+    if (!filled) {
+        Item_dealloc((PyObject *)item);
+        if (!found) {
+            PyErr_SetString(PyExc_IndexError, "item index out of range");
+        }
+        return NULL;
+    }
+    item->index = j;
+    return (PyObject *)item;
+}
+
+static PyMethodDef StrgrpModule_methods[] = {
+    { "_grp", (PyCFunction)pystrgrp_grp, METH_VARARGS,
+        "Find a group by its position, for unpickling" },
+    { "_item", (PyCFunction)pystrgrp_item, METH_VARARGS,
+        "Find an item by its position, for unpickling" },
+    {NULL}
+};
+
 static PyModuleDef StrgrpModule = {
     PyModuleDef_HEAD_INIT,
-    "strgrp",
+    "pystrgrp",
     "Cluster strings based on longest common subsequence",
     -1,
-    NULL, NULL, NULL, NULL, NULL
+    StrgrpModule_methods, NULL, NULL, NULL, NULL
 };
 
 PyMODINIT_FUNC
@@ -561,6 +2149,10 @@ PyInit_pystrgrp(void)
         return NULL;
     }
 
+    if (PyType_Ready(&GrpsType) < 0) {
+        return NULL;
+    }
+
     if (PyType_Ready(&StrgrpType) < 0) {
         return NULL;
     }
@@ -2,23 +2,89 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <time.h>
+#include "ccan/darray/darray.h"
+#include "ccan/stringmap/stringmap.h"
 #include "ccan/strgrp/strgrp.h"
 
-int main(void) {
+#define BUF_SIZE 512
+#define BENCH_ROUNDS 100
+
+typedef darray(char *) darray_str;
+typedef stringmap(struct strgrp_grp *) stringmap_grp;
+
+static double now(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+/* Time exact matches of the grouped strings in the strgrp index against a
+ * critbit stringmap holding the same strings */
+static void bench(struct strgrp *ctx, const darray_str *strs) {
+    stringmap_grp known;
+    char *const *str;
+    unsigned long found = 0;
+    double start;
+    int i;
+
+    stringmap_init(known, NULL);
+    darray_foreach(str, *strs) {
+        *(stringmap_enter(known, *str)) = strgrp_grp_exact(ctx, *str);
+    }
+
+    start = now();
+    for (i = 0; i < BENCH_ROUNDS; i++) {
+        darray_foreach(str, *strs) {
+            found += NULL != strgrp_grp_exact(ctx, *str);
+        }
+    }
+    printf("htable:    %.3fs for %lu lookups\n", now() - start,
+            (unsigned long)(BENCH_ROUNDS * darray_size(*strs)));
+
+    start = now();
+    for (i = 0; i < BENCH_ROUNDS; i++) {
+        darray_foreach(str, *strs) {
+            struct strgrp_grp **const grp = stringmap_lookup(known, *str);
+            found -= grp && *grp;
+        }
+    }
+    printf("stringmap: %.3fs for %lu lookups\n", now() - start,
+            (unsigned long)(BENCH_ROUNDS * darray_size(*strs)));
+
+    if (found) {
+        printf("The indexes disagree on %lu lookups\n", found);
+    }
+    stringmap_free(known);
+}
+
+int main(int argc, char **argv) {
     FILE *f;
     char *buf;
     struct strgrp *ctx;
+    darray_str strs = darray_new();
+    char **str;
+    const int benchmark = argc > 1 && !strcmp(argv[1], "--bench");
     f = fdopen(0, "r");
-#define BUF_SIZE 512
     buf = malloc(BUF_SIZE);
     ctx = strgrp_new(0.85);
     while(fgets(buf, BUF_SIZE, f)) {
         buf[strcspn(buf, "\r\n")] = '\0';
         if (!strgrp_add(ctx, buf, NULL)) {
             printf("Failed to classify %s\n", buf);
+        } else if (benchmark) {
+            darray_push(strs, strdup(buf));
         }
     }
-    strgrp_print(ctx);
+    if (benchmark) {
+        bench(ctx, &strs);
+    } else {
+        strgrp_print(ctx);
+    }
+    darray_foreach(str, strs) {
+        free(*str);
+    }
+    darray_free(strs);
     strgrp_free(ctx);
     free(buf);
     fclose(f);
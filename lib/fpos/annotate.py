@@ -20,6 +20,7 @@ import argparse
 import csv
 import collections
 import math
+import sys
 from .core import categories
 from .core import money
 from .groups import DynamicGroups
@@ -152,14 +153,16 @@ def parse_args(subparser=None):
             help="The IR document to which to write annotated transactions")
     parser.add_argument('--confirm', default=False, action="store_true",
             help="Prompt for confirmation after each entry has been annotated with a category")
+    parser.add_argument('--stats', default=False, action="store_true",
+            help="Print a summary of the work done grouping descriptions")
     return [ parser ] if subparser else parser.parse_args()
 
 import re
 
-def annotate(src, confirm=False, tagger=None):
+def annotate(src, confirm=False, tagger=None, persist_cache=False):
     annotated = []
     if tagger is None:
-        tagger = _Tagger()
+        tagger = _Tagger(DynamicGroups(persist_cache=persist_cache))
     with tagger:
         try:
             for row in src:
@@ -194,13 +197,30 @@ def annotate(src, confirm=False, tagger=None):
             pass
     return annotated
 
+def summarise(stats, out=sys.stderr):
+    print("Searched {searches} descriptions, {exact} matched exactly".format(**stats),
+            file=out)
+    print("Scanned {scanned} groups, rejected {rejected_len} by length and {rejected} by filters".format(**stats),
+            file=out)
+    print("Computed {lcs} LCS over {cells} cells, {cheap} cheap comparisons, {thresholds} threshold updates".format(**stats),
+            file=out)
+    print("Score cache: {cache_entries} entries, {cache_hits} hits, {cache_misses} misses, {cache_evictions} evictions".format(**stats),
+            file=out)
+    print("Canonical forms: {canonical_entries} entries, {canonical_hits} hits, {canonical_misses} misses".format(**stats),
+            file=out)
+    print("Time: {prepare_time:.3f}s preparing, {score_time:.3f}s scoring, {insert_time:.3f}s inserting".format(**stats),
+            file=out)
+
 def main(args=None):
     if args is None:
         args = parse_args()
     try:
         r = csv.reader(args.infile, dialect='excel')
         w = csv.writer(args.outfile, dialect='excel')
-        w.writerows(annotate(r, args.confirm))
+        tagger = _Tagger()
+        w.writerows(annotate(r, args.confirm, tagger))
+        if args.stats:
+            summarise(tagger.grouper.stats())
     finally:
         args.infile.close()
         args.outfile.close()
@@ -100,7 +100,8 @@ def db_update(args, config_dir=None, tagger=None):
                 print()
                 print("Failed to transform CSV in {}, cannot complete update".format(doc.name))
                 raise e
-        csv.writer(tf).writerows(annotate(combine(chain(irdocs, [csv.reader(db)])), tagger=tagger))
+        csv.writer(tf).writerows(annotate(combine(chain(irdocs, [csv.reader(db)])),
+            tagger=tagger, persist_cache=True))
         tf.close()
     shutil.move(tf.name, db_path)
 
@@ -1,18 +1,152 @@
-from pystrgrp import Strgrp
+try:
+    from pystrgrp import Strgrp
+except ImportError:
+    # The extension failed to build, so group with the slower fallback
+    from .strgrp import Strgrp
+from concurrent.futures import ProcessPoolExecutor
+import functools
 import hashlib
+import multiprocessing
 import os
+import re
 import sqlite3
+import tempfile
 import traceback
 import xdg
+import zlib
 
 salt = "382a55c995b1e53f3ad0a3ed1c5ae735b9c7adc0".encode("UTF-8")
 
+# Prefixes added by banks ahead of the merchant, as in generate.visa_provider
+card_prefixes = ("VISA DEBIT PURCHASE CARD", )
+
+# Rewrites removing the parts of descriptions that vary between transactions
+# with a merchant, applied in order as (pattern, replacement) pairs
+canonical_rules = (
+    # A card prefix and the card number following it
+    (r"^\s*(?:{})(?:\s+\d+\b)?".format("|".join(map(re.escape, card_prefixes))),
+        ""),
+    # Transaction ids, as from generate.gen_tid()
+    (r"\[\d+\]", ""),
+    # Dates, such as 05/01/2014 or 05/01/14
+    (r"\b\d{1,2}[/.-]\d{1,2}[/.-](?:\d{4}|\d{2})\b", ""),
+    # Terminal and receipt numbers, which are longer than store numbers
+    (r"\b\d{6,}\b", ""),
+    # Collapse the gaps left behind
+    (r"\s+", " "),
+)
+
+class Canonicaliser(object):
+    """Rewrite descriptions with a sequence of (pattern, replacement) rules,
+    remembering the results for the most recent size descriptions.
+    Descriptions rewritten to nothing are left as they are"""
+    def __init__(self, rules=canonical_rules, size=65536):
+        self.rules = [ (re.compile(p), r) for p, r in rules ]
+        self._canonical = functools.lru_cache(maxsize=size)(self._rewrite)
+
+    def _rewrite(self, description):
+        canonical = description
+        for pattern, replacement in self.rules:
+            canonical = pattern.sub(replacement, canonical)
+        canonical = canonical.strip()
+        return canonical if canonical else description
+
+    def __call__(self, description):
+        return self._canonical(description)
+
+    def stats(self):
+        info = self._canonical.cache_info()
+        return { "hits" : info.hits, "misses" : info.misses,
+                "entries" : info.currsize }
+
 def gen_id(description, salt):
     s = hashlib.sha1()
     s.update(str(description).encode("UTF-8"))
     s.update(salt)
     return s.hexdigest()
 
+def share_groups(strgrp):
+    """Copy a snapshot of strgrp into a new shared memory block, so a process
+    pool can use the groups without rebuilding them. The caller must close()
+    and unlink() the block once the workers are done with it. The pool should
+    use the spawn or forkserver start method, as OpenMP's threads do not
+    survive fork(). Requires Python 3.8 or later for shared memory."""
+    # Imported here so the module loads on Pythons without shared_memory
+    from multiprocessing import shared_memory
+    snapshot = strgrp.dumps()
+    shm = shared_memory.SharedMemory(create=True, size=len(snapshot))
+    shm.buf[:len(snapshot)] = snapshot
+    return shm
+
+# Blocks attached by this process, which must outlive the Strgrp views
+_attached = dict()
+
+def attach_groups(name):
+    """Provide a Strgrp over the snapshot shared by share_groups() in the block
+    name. The group keys are used in place in the block, which is not
+    modified. Each call provides an independent Strgrp."""
+    from multiprocessing import shared_memory
+    if name not in _attached:
+        _attached[name] = shared_memory.SharedMemory(name=name)
+    return Strgrp.loads(_attached[name].buf.toreadonly())
+
+def _cluster_shard(keys, options):
+    """Cluster the descriptions of a shard, providing each group as the
+    positions of its descriptions in keys"""
+    strgrp = Strgrp(**options)
+    strgrp.add_many((key, i) for i, key in enumerate(keys))
+    return [ [ i.value() for i in g ] for g in strgrp ]
+
+def build_groups(items, shards=16, workers=None, canonical=None, **options):
+    """Cluster a sequence of (description, value) pairs without interaction,
+    as for a full rebuild of the groups, providing a Strgrp.
+
+    The canonical descriptions are sharded by a stable hash of their first
+    word, so the descriptions of a merchant tend to meet, and the shards are
+    clustered independently by a pool of worker processes (by default one
+    per CPU). The groups of each shard are then merged, in shard order, into
+    the best acceptable groups found for their keys among those of the
+    shards before, or become groups of their own. The groups depend on the
+    number of shards but not on the number of workers. The options are
+    those of Strgrp."""
+    if shards < 1:
+        raise ValueError("shards must be positive")
+    if canonical is None:
+        canonical = Canonicaliser()
+    items = [ (canonical(d), v) for d, v in items ]
+    keys = [ [] for _ in range(shards) ]
+    positions = [ [] for _ in range(shards) ]
+    for i, (key, _) in enumerate(items):
+        shard = zlib.crc32(key.split(" ", 1)[0].encode("UTF-8")) % shards
+        keys[shard].append(key)
+        positions[shard].append(i)
+    # Each worker clusters whole shards with one thread, so the shards
+    # rather than the threads share the CPUs
+    local = dict(options, threads=1)
+    if workers == 1:
+        found = [ _cluster_shard(k, local) for k in keys ]
+    else:
+        # OpenMP's threads do not survive fork()
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as ex:
+            found = list(ex.map(_cluster_shard, keys, [ local ] * shards))
+    # A shard's groups were kept apart by its clustering, so each shard is
+    # merged in one batch against the groups of the shards before it
+    merged = Strgrp(**options)
+    for shard, groups in zip(positions, found):
+        groups = [ [ items[shard[j]] for j in members ] for members in groups ]
+        best = merged.grps_for_many([ g[0][0] for g in groups ], k=1,
+                min_score=0)
+        for members, heap in zip(groups, best):
+            if heap:
+                grp = heap[0]
+            else:
+                grp = merged.grp_new(*members[0])
+                members = members[1:]
+            for key, value in members:
+                grp.add(merged, key, value)
+    return merged
+
 class GroupProtocol(object):
     def __enter__(self):
         raise NotImplementedError
@@ -71,6 +205,9 @@ class SqlGroupCollection(object):
     def get_db_path(self):
         return os.path.join(self.data_dir, "descriptions.db")
 
+    def get_cache_path(self):
+        return os.path.join(self.data_dir, "scores.cache")
+
     def init_db(self, db):
         c = db.cursor()
         c.execute('''
@@ -90,6 +227,17 @@ class SqlGroupCollection(object):
     def __exit__(self, exc_type, exc_value, traceback):
         self.db.commit()
         self.db.close()
+        self.db = None
+
+    def count(self):
+        db = self.db if self.db else sqlite3.connect(self.get_db_path())
+        try:
+            c = db.cursor()
+            c.execute('SELECT COUNT(*) FROM assoc')
+            return int(c.fetchone()[0])
+        finally:
+            if db is not self.db:
+                db.close()
 
     def have_association(self, did):
         c = self.db.cursor()
@@ -105,14 +253,43 @@ class SqlGroupCollection(object):
         c = self.db.cursor()
         c.execute('INSERT INTO assoc (ddid, sdid) VALUES (?, ?)', (adid, cdid))
 
+    def disassociate(self, did):
+        c = self.db.cursor()
+        c.execute('DELETE FROM assoc WHERE ddid=?', (did, ))
+
+    def reassociate(self, cdid, ndid):
+        c = self.db.cursor()
+        c.execute('UPDATE assoc SET sdid=? WHERE sdid=?', (ndid, cdid))
+
 class DynamicGroups(GroupProtocol):
-    def __init__(self, threshold=0.85, size=4, backend=None):
+    def __init__(self, threshold=0.85, size=4, backend=None, qgram=2,
+            approximate=None, approximate_size=20000, bands=16, rows=2,
+            samples=0, threads=0, serial=0, autotune=True, cache=65536,
+            metric="lcs", screen=None, margin=0.1, partition=0,
+            prefixes=card_prefixes, canonical=None, persist_cache=False):
         if backend is None:
             backend = SqlGroupCollection()
         self.backend = backend
-        self._strgrp = Strgrp(threshold=threshold, size=size)
+        # Descriptions are grouped, and known to the backend, in their
+        # canonical form. Canonicaliser(()) leaves them as they are.
+        if canonical is None:
+            canonical = Canonicaliser()
+        self.canonical = canonical
+        # Approximate grouping once the backend knows approximate_size
+        # descriptions, unless told otherwise
+        if approximate is None:
+            approximate = backend.count() >= approximate_size
+        self.approximate = approximate
+        self._strgrp = Strgrp(threshold=threshold, size=size, qgram=qgram,
+                bands=(bands if approximate else 0), rows=rows,
+                samples=samples, threads=threads, serial=serial,
+                autotune=autotune, cache=cache, metric=metric, screen=screen,
+                margin=margin, partition=partition, prefixes=prefixes)
         self.size = size
         self.threshold = threshold
+        self.cache = cache
+        # Keep the score cache between runs, as for updates of the database
+        self.persist_cache = persist_cache
         self.map = dict()
 
     def __iter__(self):
@@ -120,10 +297,44 @@ class DynamicGroups(GroupProtocol):
 
     def __enter__(self):
         self.backend.__enter__()
+        # Scores persist between runs, but are only an optimisation
+        if self.cache and self.persist_cache:
+            try:
+                self._strgrp.load_cache(self.backend.get_cache_path())
+            except (OSError, ValueError):
+                pass
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.backend.__exit__(exc_type, exc_value, traceback)
+        if self.cache and self.persist_cache:
+            self._save_cache(self.backend.get_cache_path())
+
+    def _save_cache(self, path):
+        """Replace the score cache at path, so an interrupted save leaves the
+        previous cache in place"""
+        tf = tempfile.NamedTemporaryFile(dir=os.path.dirname(path),
+                prefix=os.path.basename(path), delete=False)
+        tf.close()
+        try:
+            self._strgrp.save_cache(tf.name)
+            os.replace(tf.name, path)
+        except:
+            os.remove(tf.name)
+            raise
+
+    def stats(self):
+        """Count the work done grouping descriptions, including the use of
+        the score cache"""
+        stats = self._strgrp.stats()
+        stats.update(("cache_" + k, v)
+                for k, v in self._strgrp.cache_stats().items())
+        stats.update(("canonical_" + k, v)
+                for k, v in self.canonical.stats().items())
+        return stats
+
+    def reset_stats(self):
+        self._strgrp.reset_stats()
 
     def _split_heap(self, heap):
         i = None
@@ -138,23 +349,39 @@ class DynamicGroups(GroupProtocol):
 
         return r
 
+    def _gen_id(self, raw, description):
+        """Provide the id of description, the canonical form of raw.
+        Databases written before descriptions were canonicalised associate
+        the id of raw instead, so its association is carried over to the id of
+        description when description has none"""
+        did = gen_id(description, salt)
+        if raw != description and not self.backend.have_association(did):
+            rid = gen_id(raw, salt)
+            if self.backend.have_association(rid):
+                self.backend.associate(self.backend.get_canonical(rid), did)
+        return did
+
     def find_group(self, description):
+        raw = description
+        description = self.canonical(description)
         grpbin = self._strgrp.grp_exact(description)
         if grpbin is not None:
             return grpbin
 
-        did = gen_id(description, salt)
+        did = self._gen_id(raw, description)
         if self.backend.have_association(did):
             cid = self.backend.get_canonical(did)
             if cid in self.map:
                 return self._strgrp.grp_exact(self.map[cid])
             return None
 
-        heap = self._strgrp.grps_for(description)
-
         if self.size == 0:
+            heap = self._strgrp.grps_for(description, k=1)
             return heap[0] if len(heap) else None
 
+        # Only acceptible groups are candidates
+        heap = self._strgrp.grps_for(description, min_score=0)
+
         needles, haystack = self._split_heap(heap)
         if len(needles) == 0:
             return None
@@ -167,7 +394,9 @@ class DynamicGroups(GroupProtocol):
         return self._request_match(description, needles)
 
     def insert(self, description, value, group=None):
-        did = gen_id(description, salt)
+        raw = description
+        description = self.canonical(description)
+        did = self._gen_id(raw, description)
         if group:
             group.add(self._strgrp, description, value)
             gid = gen_id(group.key(), salt)
@@ -187,3 +416,77 @@ class DynamicGroups(GroupProtocol):
 
     def add(self, description, value):
         return self.insert(description, value, self.find_group(description))
+
+    def _find_item(self, description):
+        group = self._strgrp.grp_exact(description)
+        if group is None:
+            raise KeyError(description)
+        index = [ i.key() for i in group ].index(description)
+        return group, index
+
+    @staticmethod
+    def _holds(group, description):
+        return any(k == description for k, _ in group.variants())
+
+    def _forget(self, description, group):
+        """Drop the association of description, which has left group, so it
+        is grouped afresh. Nothing changes while other items of group bear
+        description."""
+        did = gen_id(description, salt)
+        if self._holds(group, description) or \
+                not self.backend.have_association(did):
+            return
+        cid = self.backend.get_canonical(did)
+        self.backend.disassociate(did)
+        if group.size() == 0:
+            if self.map.get(cid) == description:
+                del self.map[cid]
+            return
+        # The group's remaining descriptions share its canonical id, which
+        # passes to the group's key if it was the departing description
+        key = group.key()
+        if cid == did:
+            self.map.pop(cid, None)
+            cid = gen_id(key, salt)
+            self.backend.reassociate(did, cid)
+            self.map[cid] = key
+        elif self.map.get(cid) == description:
+            self.map[cid] = key
+
+    def remove(self, description):
+        """Remove description from its group, providing its value. The group
+        is dissolved if it has no other descriptions"""
+        description = self.canonical(description)
+        group, index = self._find_item(description)
+        value = group.remove(self._strgrp, index)
+        self._forget(description, group)
+        return value
+
+    def move(self, description, group):
+        """Move description from its group to group, for instance to correct
+        a mis-grouping"""
+        description = self.canonical(description)
+        source, index = self._find_item(description)
+        if source == group:
+            return group
+        source.move(self._strgrp, index, group)
+        # The association stays with source while it bears description
+        if not self._holds(source, description):
+            self._forget(description, source)
+            cid = self.backend.get_canonical(gen_id(group.key(), salt))
+            self.backend.associate(cid, gen_id(description, salt))
+        return group
+
+    def rekey(self, group, description):
+        """Make description the key of its group"""
+        description = self.canonical(description)
+        index = [ i.key() for i in group ].index(description)
+        group.rekey(self._strgrp, index)
+
+    def dissolve(self, group):
+        """Remove all descriptions from group, providing their values"""
+        descriptions = [ i.key() for i in group ]
+        values = group.dissolve(self._strgrp)
+        for description in descriptions:
+            self._forget(description, group)
+        return values
@@ -17,7 +17,10 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
-import pystrgrp
+try:
+    import pystrgrp
+except ImportError:
+    from . import strgrp as pystrgrp
 import csv
 import numpy as np
 from collections import namedtuple
@@ -368,9 +371,11 @@ def main(args=None):
     grouper = pystrgrp.Strgrp()
     reader = csv.reader(args.infile, dialect='excel')
     dates = [ None, None ]
+    items = []
     for r in reader:
         if len(r) >= 4 and not "Internal" == r[3]:
-            grouper.add(r[2].upper(), r)
+            items.append((r[2].upper(), r))
             dates[0] = pd(r[0]) if not dates[0] else min(pd(r[0]), dates[0])
             dates[1] = pd(r[0]) if not dates[1] else max(pd(r[0]), dates[1])
-    graph_bar_cashflow([ list(i.data() for i in g) for g in grouper ], dates, 32)
+    grouper.add_many(items)
+    graph_bar_cashflow([ list(i.value() for i in g) for g in grouper ], dates, 32)
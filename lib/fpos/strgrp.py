@@ -0,0 +1,536 @@
+"""Group strings as the pystrgrp extension does, in Python with NumPy, for
+deployments where the extension cannot be built.
+
+Strings are compared by the extension's normalised longest common subsequence
+of their UTF-8 bytes, so the groups found match those of its exact search. The
+subsequences of a string and every group key are computed together by a
+bit-parallel algorithm vectorised across the keys. Approximate candidate
+selection (bands, partition), the score cache and the parallel schedule are
+accepted for compatibility but have no effect, and only the lcs metric is
+provided. Groups that cannot reach the threshold may be given different
+(negative) scores to the extension's, which abandons their comparisons early.
+"""
+
+import pickle
+import time
+import numpy as np
+
+# Pads the keys of shorter groups, and matches no byte
+_PAD = 256
+_WORD = 64
+_ONES = np.iinfo(np.uint64).max
+_popcount = np.array([ bin(i).count("1") for i in range(256) ], dtype=np.uint8)
+
+def _pack(keys, width=None):
+    """Lay out the encoded keys as the rows of a padded array"""
+    if width is None:
+        width = max((len(k) for k in keys), default=0)
+    codes = np.full((len(keys), width), _PAD, dtype=np.uint16)
+    for i, k in enumerate(keys):
+        codes[i, :len(k)] = np.frombuffer(k, dtype=np.uint8)
+    return codes
+
+def _add(a, b):
+    s = a + b
+    carry = s < a
+    for w in range(1, s.shape[1]):
+        t = s[:, w] + carry[:, w - 1]
+        carry[:, w] |= t < s[:, w]
+        s[:, w] = t
+    return s
+
+def _sub(a, b):
+    d = a - b
+    borrow = a < b
+    for w in range(1, d.shape[1]):
+        t = d[:, w] - borrow[:, w - 1]
+        borrow[:, w] |= t > d[:, w]
+        d[:, w] = t
+    return d
+
+def lcs(a, codes):
+    """Provide the lengths of the longest common subsequences of the bytes a
+    and each row of codes, as laid out by _pack().
+
+    The rows are scanned a column at a time by the bit-parallel algorithm of
+    Allison and Dix, in which the zero bits of each row's state mark the
+    positions of a that end a common subsequence"""
+    n = codes.shape[0]
+    m = len(a)
+    if not m or not n:
+        return np.zeros(n, dtype=np.int64)
+    words = (m + _WORD - 1) // _WORD
+    masks = np.zeros((_PAD + 1, words), dtype=np.uint64)
+    for i, c in enumerate(a):
+        masks[c, i // _WORD] |= np.uint64(1 << (i % _WORD))
+    state = np.full((n, words), _ONES, dtype=np.uint64)
+    for column in codes.T:
+        matched = state & masks[column]
+        if words == 1:
+            state = (state + matched) | (state - matched)
+        else:
+            state = _add(state, matched) | _sub(state, matched)
+    # Count the zeros of the state, after filling the bits beyond a
+    if m % _WORD:
+        state[:, -1] |= np.uint64(_ONES ^ ((1 << (m % _WORD)) - 1))
+    return words * _WORD - _popcount[state.view(np.uint8)].sum(axis=1,
+            dtype=np.int64)
+
+def _nlcs(l, la, lb):
+    """Normalise LCS lengths as the extension does"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.sqrt((2 * l * l) / (la * la + lb * lb))
+
+class Item(object):
+    """A string and its data in a group"""
+    def __init__(self, owner, grp, index, key, value):
+        self._owner = owner
+        self._grp = grp
+        self._index = index
+        self._key = key
+        self._value = value
+
+    def key(self):
+        return self._key
+
+    def value(self):
+        return self._value
+
+    def __reduce__(self):
+        return (_item, (self._owner, self._grp.index, self._index))
+
+class _Group(object):
+    def __init__(self, index, key):
+        self.index = index
+        self.key = key
+        self.items = []
+        # The distinct strings of the items and their counts, in order of
+        # first appearance
+        self.variants = {}
+        # The minimum similarity of the first n_low variants
+        self.low = 1.0
+        self.n_low = 0
+
+class Grp(object):
+    """A group of similar strings. Groups provided by grps_for() report
+    acceptibility as of that search"""
+    def __init__(self, owner, grp, score=None):
+        self._owner = owner
+        self._grp = grp
+        self._score = score
+
+    def __eq__(self, other):
+        return isinstance(other, Grp) and self._grp is other._grp
+
+    def __hash__(self):
+        return id(self._grp)
+
+    def __iter__(self):
+        items = list(self._grp.items)
+        return (Item(self._owner, self._grp, i, k, v)
+                for i, (k, v) in enumerate(items))
+
+    def __reduce__(self):
+        return (_grp, (self._owner, self._grp.index))
+
+    def key(self):
+        return self._grp.key
+
+    def size(self):
+        return len(self._grp.items)
+
+    def variants(self):
+        return list(self._grp.variants.items())
+
+    def is_acceptible(self, ctx):
+        acceptible = ctx._is_acceptible(self._grp)
+        return acceptible if self._score is None else self._score >= 0
+
+    def is_dynamic(self, ctx):
+        return ctx._is_dynamic(self._grp)
+
+    def add(self, ctx, key, data):
+        return ctx._grp_add(self._grp, key, data)
+
+    def remove(self, ctx, index):
+        ctx._check_index(self._grp, index)
+        return ctx._take_item(self._grp, index)
+
+    def move(self, ctx, index, to):
+        ctx._check_index(self._grp, index)
+        if not to._grp.items:
+            raise ValueError("cannot move to a dissolved group")
+        ctx._move(self._grp, index, to._grp)
+
+    def rekey(self, ctx, index):
+        ctx._check_index(self._grp, index)
+        key = self._grp.items[index][0]
+        if key != self._grp.key:
+            ctx._set_key(self._grp, key)
+
+    def dissolve(self, ctx):
+        values = [ v for _, v in self._grp.items ]
+        if values:
+            ctx._dissolve(self._grp)
+        return values
+
+def _grp(owner, i):
+    if not 0 <= i < len(owner._grps):
+        raise IndexError("group index out of range")
+    return Grp(owner, owner._grps[i])
+
+def _item(owner, i, j):
+    grp = _grp(owner, i)._grp
+    if not 0 <= j < len(grp.items):
+        raise IndexError("item index out of range")
+    return Item(owner, grp, j, *grp.items[j])
+
+class Strgrp(object):
+    """Cluster strings based on longest common subsequence"""
+    def __init__(self, threshold=0.85, size=0, qgram=0, bands=0, rows=2,
+            samples=0, threads=0, chunk=1, serial=0, autotune=False, cache=0,
+            metric="lcs", screen=None, margin=0.1, partition=0,
+            prefixes=None, kernel=None):
+        if metric != "lcs" or screen not in (None, "lcs"):
+            raise ValueError("only the lcs metric is available without pystrgrp")
+        if kernel is not None:
+            raise ValueError("kernels cannot be selected without pystrgrp")
+        if not margin >= 0:
+            raise ValueError("margin must be non-negative")
+        if qgram < 0 or qgram > 8:
+            raise ValueError("qgram must be in [0, 8]")
+        if bands < 0 or rows < 1 or bands * rows > 1024:
+            raise ValueError("bands must be non-negative, rows positive, and bands * rows at most 1024")
+        if samples < 0:
+            raise ValueError("samples must be non-negative")
+        if threads < 0 or chunk < 1:
+            raise ValueError("threads must be non-negative and chunk positive")
+        if cache < 0:
+            raise ValueError("cache must be non-negative")
+        if partition < 0:
+            raise ValueError("partition must be non-negative")
+        self._threshold = threshold
+        self._size = size
+        self._samples = samples
+        self._schedule = { "threads" : threads, "chunk" : chunk,
+                "serial" : serial, "autotune" : bool(autotune) }
+        self._margin = margin
+        self._grps = []
+        # Strings added to the groups, or None once they have left
+        self._known = dict()
+        # The keys of the groups and their state, by group position
+        self._codes = _pack([], 0)
+        self._lens = np.zeros(0, dtype=np.int64)
+        self._live = np.zeros(0, dtype=bool)
+        self._dirty = np.zeros(0, dtype=bool)
+        self._thresholds = np.zeros(0)
+        self._scores = np.zeros(0)
+        self.reset_stats()
+
+    def __iter__(self):
+        return (Grp(self, g) for g in list(self._grps) if g.items)
+
+    def _grow(self, width):
+        n = len(self._grps)
+        rows = self._codes.shape[0]
+        if n < rows and width <= self._codes.shape[1]:
+            return
+        rows = max(2 * rows, 16) if n == rows else rows
+        codes = np.full((rows, max(width, self._codes.shape[1])), _PAD,
+                dtype=np.uint16)
+        codes[:n, :self._codes.shape[1]] = self._codes[:n]
+        self._codes = codes
+        for name in ("_lens", "_live", "_dirty", "_thresholds", "_scores"):
+            old = getattr(self, name)
+            new = np.zeros(rows, dtype=old.dtype)
+            new[:n] = old[:n]
+            setattr(self, name, new)
+
+    def _set_key(self, grp, key):
+        encoded = key.encode("UTF-8")
+        self._grow(len(encoded))
+        self._codes[grp.index] = _PAD
+        self._codes[grp.index, :len(encoded)] = np.frombuffer(encoded,
+                dtype=np.uint8)
+        self._lens[grp.index] = len(encoded)
+        grp.key = key
+
+    def _new_grp(self, key, data):
+        grp = _Group(len(self._grps), key)
+        self._set_key(grp, key)
+        self._grps.append(grp)
+        self._live[grp.index] = True
+        self._thresholds[grp.index] = self._threshold
+        self._scores[grp.index] = 0.0
+        self._append(grp, key, data)
+        return grp
+
+    def _append(self, grp, key, data):
+        grp.items.append((key, data))
+        grp.variants[key] = grp.variants.get(key, 0) + 1
+        self._dirty[grp.index] = (len(grp.items) >= self._size and
+                grp.n_low < len(grp.variants))
+
+    def _uncache(self, grp, key):
+        if self._known.get(key) is grp:
+            self._known[key] = None
+
+    def _reset_threshold(self, grp):
+        self._thresholds[grp.index] = self._threshold
+        grp.low = 1.0
+        grp.n_low = 0
+        self._dirty[grp.index] = (self._size > 0 and
+                len(grp.items) >= self._size)
+
+    def _dissolve(self, grp):
+        for key in grp.variants:
+            self._uncache(grp, key)
+        del grp.items[:]
+        grp.variants.clear()
+        self._live[grp.index] = False
+        self._reset_threshold(grp)
+
+    def _check_index(self, grp, index):
+        if not 0 <= index < len(grp.items):
+            raise IndexError("item index out of range")
+
+    def _take_item(self, grp, i):
+        key, value = grp.items[i]
+        last = grp.variants[key] == 1
+        if last and len(grp.items) > 1 and key == grp.key:
+            self._set_key(grp, grp.items[0 if i else 1][0])
+        if last:
+            self._uncache(grp, key)
+        del grp.items[i]
+        grp.variants[key] -= 1
+        if not grp.items:
+            self._dissolve(grp)
+        elif last:
+            position = list(grp.variants).index(key)
+            del grp.variants[key]
+            if position < grp.n_low:
+                self._reset_threshold(grp)
+        return value
+
+    def _move(self, source, i, grp):
+        if source is grp:
+            return
+        key = source.items[i][0]
+        value = self._take_item(source, i)
+        self._append(grp, key, value)
+        self._known[key] = grp
+
+    def _grp_add(self, grp, key, data):
+        if not grp.items:
+            return False
+        self._append(grp, key, data)
+        self._known[key] = grp
+        return True
+
+    def _is_dynamic(self, grp):
+        return self._size > 0 and len(grp.items) >= self._size
+
+    def _is_acceptible(self, grp):
+        if self._size > 0 and self._dirty[grp.index]:
+            self._update_threshold(grp)
+        return self._scores[grp.index] >= 0
+
+    def _update_threshold(self, grp):
+        """Extend the minimum pairwise similarity of the group's distinct
+        strings to those added since the last update, as the extension does"""
+        keys = [ k.encode("UTF-8") for k in grp.variants ]
+        codes = _pack(keys)
+        lens = np.array([ len(k) for k in keys ], dtype=np.float64)
+        low = grp.low
+        self._stats["thresholds"] += 1
+        for i in range(grp.n_low, len(keys)):
+            n = self._samples if 0 < self._samples < i else i
+            if not n:
+                continue
+            others = np.arange(n) * i // n
+            lb = lens[others]
+            scores = _nlcs(lcs(keys[i], codes[others]).astype(np.float64),
+                    lens[i], lb)
+            self._stats["lcs"] += n
+            self._stats["cells"] += len(keys[i]) * int(lb.sum())
+            for score in scores:
+                low = low if low < score else score
+        grp.low = low
+        grp.n_low = len(keys)
+        self._dirty[grp.index] = False
+        # Adjust low to capture extra variation
+        low -= 0.03
+        self._thresholds[grp.index] = (low if low > self._threshold
+                else self._threshold)
+
+    def _score(self, key):
+        """Score the groups against key, leaving the scores relative to the
+        thresholds in self._scores"""
+        start = time.perf_counter()
+        a = key.encode("UTF-8")
+        n = len(self._grps)
+        live = self._live[:n]
+        self._stats["searches"] += 1
+        self._stats["prepare_time"] += time.perf_counter() - start
+        start = time.perf_counter()
+        dynamic = self._size > 0
+        if dynamic:
+            for i in np.flatnonzero(self._dirty[:n] & live):
+                self._update_threshold(self._grps[i])
+            thresholds = self._thresholds[:n]
+        else:
+            thresholds = self._threshold
+        la = float(len(a))
+        lb = self._lens[:n].astype(np.float64)
+        # Skip the groups whose lengths alone rule them out
+        lmin = np.minimum(la, lb)
+        bound = _nlcs(lmin, la, lb)
+        candidates = live & (thresholds <= bound)
+        rows = np.flatnonzero(candidates)
+        scores = np.full(n, -2.0 if dynamic else -1.0)
+        if len(rows):
+            width = int(self._lens[rows].max())
+            found = _nlcs(lcs(a, self._codes[rows, :width]).astype(np.float64),
+                    la, lb[rows])
+            if dynamic:
+                t = thresholds[rows]
+                scores[rows] = np.where(found >= t, found - self._threshold,
+                        found - t)
+            else:
+                scores[rows] = found - self._threshold
+        self._scores[:n] = scores
+        self._stats["scanned"] += int(live.sum())
+        self._stats["rejected_len"] += int(live.sum()) - len(rows)
+        self._stats["lcs"] += len(rows)
+        self._stats["cells"] += int(la) * int(self._lens[rows].sum())
+        self._stats["score_time"] += time.perf_counter() - start
+
+    def _grp_for(self, key):
+        if not self._grps:
+            return None
+        grp = self._known.get(key)
+        if grp is not None:
+            self._stats["exact"] += 1
+            return grp
+        self._score(key)
+        n = len(self._grps)
+        best = int(np.argmax(self._scores[:n]))
+        return self._grps[best] if self._scores[best] >= 0 else None
+
+    def _insert(self, grp, key, data):
+        start = time.perf_counter()
+        if grp is None:
+            grp = self._new_grp(key, data)
+        else:
+            self._append(grp, key, data)
+        self._known[key] = grp
+        self._stats["insert_time"] += time.perf_counter() - start
+        return grp
+
+    def add(self, key, data):
+        """Cluster a string"""
+        return Grp(self, self._insert(self._grp_for(key), key, data))
+
+    def grp_new(self, key, data):
+        """Cluster a string"""
+        return Grp(self, self._insert(None, key, data))
+
+    def grp_for(self, key):
+        """Find a cluster for a string, if one exists"""
+        grp = self._grp_for(key)
+        return None if grp is None else Grp(self, grp)
+
+    def grp_exact(self, key):
+        """Find group by exact match"""
+        grp = self._known.get(key)
+        return None if grp is None else Grp(self, grp)
+
+    def grps_for(self, key, k=0, min_score=-np.inf):
+        """Provide a sequence of groups ordered by match score descending,
+        optionally limited to the best k scoring at least min_score"""
+        if k < 0:
+            raise ValueError("k must be non-negative")
+        if self._grps:
+            self._score(key)
+        n = len(self._grps)
+        scores = self._scores[:n]
+        found = np.flatnonzero(self._live[:n] & ~(scores < min_score))
+        found = found[np.argsort(-scores[found], kind="stable")]
+        if k:
+            found = found[:k]
+        return [ Grp(self, self._grps[i], scores[i]) for i in found ]
+
+    def add_many(self, items):
+        """Cluster a sequence of (string, data) pairs, providing their groups"""
+        items = list(items)
+        for item in items:
+            if not isinstance(item, tuple) or len(item) != 2:
+                raise TypeError("items must be (key, data) pairs")
+            if not isinstance(item[0], str):
+                raise TypeError("keys must be strings")
+        return [ self.add(key, data) for key, data in items ]
+
+    def grps_for_many(self, keys, k=0, min_score=-np.inf):
+        """Provide the ordered groups for each of a sequence of strings, as
+        for grps_for()"""
+        return [ self.grps_for(key, k, min_score) for key in list(keys) ]
+
+    def pruned(self):
+        """Count the candidate groups skipped by approximate search"""
+        return 0
+
+    def schedule(self):
+        """Describe the parallel scoring of groups, which is not performed"""
+        return dict(self._schedule)
+
+    def metric(self):
+        """Describe the measure of similarity"""
+        return { "metric" : "lcs", "screen" : "lcs", "margin" : self._margin }
+
+    def kernel(self):
+        """Describe the implementation of the LCS comparison, which compares
+        all group keys at a time"""
+        return { "kernel" : "numpy", "lanes" : len(self._grps) }
+
+    def cache_stats(self):
+        """Describe the use of the score cache, which is not kept"""
+        return { "entries" : 0, "hits" : 0, "misses" : 0, "evictions" : 0 }
+
+    def stats(self):
+        """Count the work done by the instance since construction or the last
+        call to reset_stats(). Times are in seconds"""
+        return dict(self._stats)
+
+    def reset_stats(self):
+        """Zero the counts provided by stats()"""
+        self._stats = dict.fromkeys(("searches", "exact", "scanned",
+            "rejected_len", "rejected", "lcs", "cheap", "cells", "thresholds",
+            "widened"), 0)
+        self._stats.update(prepare_time=0.0, score_time=0.0, insert_time=0.0)
+
+    def save_cache(self, path):
+        """Ignored, as no score cache is kept"""
+
+    def load_cache(self, path):
+        """Ignored, as no score cache is kept"""
+
+    def save(self, path):
+        """Write a snapshot of the groups to a file. Snapshots are pickles, and
+        cannot be exchanged with pystrgrp's"""
+        with open(path, "wb") as f:
+            pickle.dump(self, f)
+
+    @classmethod
+    def load(cls, path):
+        """Construct a Strgrp from a snapshot file written by save()"""
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    def dumps(self):
+        """Provide a snapshot of the groups as bytes, as written by save()"""
+        return pickle.dumps(self)
+
+    @classmethod
+    def loads(cls, buffer):
+        """Construct a Strgrp from a snapshot in a bytes-like object"""
+        return pickle.loads(buffer)
@@ -33,7 +33,7 @@ from .core import money
 from .core import date_fmt, month_fmt
 from .predict import forecast, graph_bar_cashflow, print_periodic_expenses, print_commitment_targets
 from .predict import print_forecast_expenses
-from .groups import DynamicGroups
+from .groups import DynamicGroups, build_groups
 
 cmd_description = \
         """Displays a number of graphs from an annotated IR document. The graphs include:
@@ -152,6 +152,8 @@ def parse_args(subparser=None):
             help="Display a single graph rather than all")
     parser.add_argument("--current-date", default=False, action="store_true",
             help="Draw graphs based on the current date rather than the date of the last transaction")
+    parser.add_argument("--rebuild-groups", default=False, action="store_true",
+            help="Group the descriptions afresh across all CPUs, ignoring the matches confirmed while annotating")
     return [ parser ] if subparser else parser.parse_args()
 
 def should_graph(name, graph):
@@ -527,20 +529,27 @@ def graph_xy_progressive_mean(months, dailies, m_income, groups, dates):
     plt.xlim([min(xs) - 1, max(xs) + 1])
     plt.show()
 
-def basic_groups(transactions):
+def basic_groups(transactions, rebuild=False):
+    items = ((r[2], r) for r in transactions
+            if len(r) >= 4 and not r[3] == "Internal")
+    if rebuild:
+        # Group the whole table at once, across all CPUs
+        grouper = build_groups(items, threshold=0.85, size=4, qgram=2)
+        return [ [ x.value() for x in g ] for g in grouper ]
+    # Follow the matches confirmed while annotating
     with DynamicGroups() as grouper:
-        for r in transactions:
-            if len(r) >= 4 and not r[3] == "Internal":
-                grouper.add(r[2], r)
+        for description, r in items:
+            grouper.add(description, r)
         return [ [ x.value() for x in g ] for g in grouper ]
 
-def visualise(table, current_date=False, graph=None, save=0, span=0):
+def visualise(table, current_date=False, graph=None, save=0, span=0,
+        rebuild=False):
     # Core data, used across multiple plots
     period_grouper = PeriodGroup(extract_month, extract_week, extract_day)
     for row in table:
         period_grouper.add(row)
     m_grouped, w_grouped, d_grouped = period_grouper.groups()
-    description_groups = basic_groups(table)
+    description_groups = basic_groups(table, rebuild)
 
     # m_summed: Looks like:
     #
@@ -607,7 +616,8 @@ def main(args=None):
     if args is None:
         args = parse_args()
 
-    visualise(list(csv.reader(args.database)), args.current_date, args.graph, args.save)
+    visualise(list(csv.reader(args.database)), args.current_date, args.graph,
+            args.save, rebuild=args.rebuild_groups)
 
 
 if __name__ == "__main__":
@@ -20,11 +20,26 @@ import matplotlib
 matplotlib.use('Agg')
 from datetime import datetime as dt
 from datetime import timedelta as td
-from itertools import islice, cycle
+from itertools import islice, cycle, product
+from unittest import mock
+import concurrent.futures
+import csv
+import multiprocessing
+import pickle
+import random
 import unittest
-from fpos import annotate, combine, core, transform, visualise, window, predict, db, psave, groups, generate
+from fpos import annotate, combine, core, transform, visualise, window, predict, db, psave, groups, generate, strgrp
 import types
 
+# The extension is optional, and the fallback is tested without it
+try:
+    import pystrgrp
+except ImportError:
+    pystrgrp = None
+
+requires_pystrgrp = unittest.skipIf(pystrgrp is None,
+        "the pystrgrp extension is not built")
+
 money = visualise.money
 
 class TagInjector(object):
@@ -515,6 +530,23 @@ class VisualiseTest(unittest.TestCase):
     def test_money_one_and_a_bit(self):
         self.assertEqual("-1.00", visualise.money(-1.001))
 
+    def test_basic_groups(self):
+        rows = [ [ "01/01/2014", "-1.00", "BP HILTON 1234", "Fuel" ],
+                [ "02/01/2014", "-2.00", "COLES 0412 MILE END", "Food" ] ]
+        with tempfile.TemporaryDirectory() as test_dir:
+            gc = groups.SqlGroupCollection(test_dir)
+            # As confirmed while annotating
+            with gc:
+                bp = groups.gen_id("BP HILTON 1234", groups.salt)
+                gc.associate(bp, bp)
+                gc.associate(bp, groups.gen_id("COLES 0412 MILE END",
+                    groups.salt))
+            with mock.patch.object(visualise, "DynamicGroups",
+                    lambda: groups.DynamicGroups(backend=gc, cache=0)):
+                self.assertEqual([ rows ], visualise.basic_groups(rows))
+            self.assertCountEqual([ rows[:1], rows[1:] ],
+                    visualise.basic_groups(rows, rebuild=True))
+
 class CombineTest(unittest.TestCase):
     def test_combine_one_empty(self):
         self.assertEqual([], list(combine.combine([ [] ])))
@@ -1240,6 +1272,16 @@ class SqlGroupCollectionTest(unittest.TestCase):
             self.assertEqual(cdid, gc.get_canonical(adid))
         self.contain(test)
 
+    def test_count(self):
+        def test(tc, gc):
+            self.assertEqual(0, gc.count())
+            cdid = groups.gen_id("foo", groups.salt)
+            adid = groups.gen_id("bar", groups.salt)
+            gc.associate(cdid, cdid)
+            gc.associate(cdid, adid)
+            self.assertEqual(2, gc.count())
+        self.contain(test)
+
 class DynamicGroupsTest(unittest.TestCase):
     def contain(self, func, threshold=0.85, size=4):
         with tempfile.TemporaryDirectory() as test_dir:
@@ -1334,5 +1376,728 @@ class DynamicGroupsTest(unittest.TestCase):
             pass
         self.contain(test, size=1)
 
+    @requires_pystrgrp
+    def test_cache_persists(self):
+        with tempfile.TemporaryDirectory() as test_dir:
+            gc = groups.SqlGroupCollection(test_dir)
+            with groups.DynamicGroups(backend=gc, size=0,
+                    persist_cache=True) as dg:
+                dg.add("COLES 0412 MILE END", 0)
+                dg.add("COLES 0413 MILE END", 1)
+            # The cache is replaced in one step, leaving no temporary file
+            self.assertCountEqual([os.path.basename(gc.get_cache_path()),
+                    os.path.basename(gc.get_db_path())], os.listdir(test_dir))
+            with groups.DynamicGroups(backend=gc, size=0,
+                    persist_cache=True) as dg:
+                self.assertEqual(1, dg._strgrp.cache_stats()["entries"])
+            # The cache is only kept when asked
+            os.remove(gc.get_cache_path())
+            with groups.DynamicGroups(backend=gc, size=0) as dg:
+                dg.add("COLES 0414 MILE END", 2)
+            self.assertFalse(os.path.exists(gc.get_cache_path()))
+
+    def test_stats(self):
+        with tempfile.TemporaryDirectory() as test_dir:
+            gc = groups.SqlGroupCollection(test_dir)
+            with groups.DynamicGroups(backend=gc, size=0, cache=0) as dg:
+                dg.add("COLES 0412 MILE END", 0)
+                dg.add("COLES 0413 MILE END", 1)
+                stats = dg.stats()
+        self.assertEqual(1, stats["searches"])
+        self.assertEqual(0, stats["cache_entries"])
+
+    @requires_pystrgrp
+    def test_metric(self):
+        with tempfile.TemporaryDirectory() as test_dir:
+            gc = groups.SqlGroupCollection(test_dir)
+            with groups.DynamicGroups(backend=gc, size=0, cache=0,
+                    metric="jaccard") as dg:
+                bp = dg.add("BP HILTON 1234", 0)
+                self.assertEqual(bp, dg.add("HILTON BP 1234", 1))
+                self.assertGreater(dg.stats()["cheap"], 0)
+
+    def test_canonical(self):
+        canonical = groups.Canonicaliser()
+        self.assertEqual("BUNNINGS 44", canonical(
+            "VISA DEBIT PURCHASE CARD 1234 BUNNINGS  44 [72307398]"))
+        self.assertEqual("COLES 0412 MILE END",
+                canonical("COLES 0412 MILE END 05/01/2014 123456"))
+        self.assertEqual("[72307398]", canonical("[72307398]"))
+        canonical("COLES 0412 MILE END 05/01/2014 123456")
+        self.assertEqual({ "hits" : 1, "misses" : 3, "entries" : 3 },
+                canonical.stats())
+        with tempfile.TemporaryDirectory() as test_dir:
+            gc = groups.SqlGroupCollection(test_dir)
+            with groups.DynamicGroups(backend=gc, size=0, cache=0) as dg:
+                bunnings = dg.add("VISA DEBIT PURCHASE CARD 1234 BUNNINGS [72307398]", 0)
+                self.assertEqual("BUNNINGS", bunnings.key())
+                dg.reset_stats()
+                self.assertEqual(bunnings, dg.find_group("BUNNINGS [46423133]"))
+                self.assertEqual(0, dg.stats()["searches"])
+                self.assertEqual(0, dg.remove("BUNNINGS [46423133]"))
+            with groups.DynamicGroups(backend=gc, size=0, cache=0,
+                    canonical=groups.Canonicaliser(())) as dg:
+                self.assertEqual("BUNNINGS [46423133]",
+                        dg.add("BUNNINGS [46423133]", 0).key())
+
+    def test_canonical_upgrade(self):
+        # Associations recorded before descriptions were canonicalised
+        coles = "COLES 0412 MILE END 05/01/2014 123456"
+        other = "COLES 0419 MILE END 06/01/2014 654321"
+        cid = groups.gen_id(coles, groups.salt)
+        with tempfile.TemporaryDirectory() as test_dir:
+            gc = groups.SqlGroupCollection(test_dir)
+            with gc:
+                gc.associate(cid, cid)
+                gc.associate(cid, groups.gen_id(other, groups.salt))
+            with groups.DynamicGroups(threshold=0.99, backend=gc,
+                    cache=0) as dg:
+                grp = dg.add(coles, 0)
+                self.assertEqual(grp, dg.add(other, 1))
+                self.assertEqual(cid, gc.get_canonical(
+                    groups.gen_id("COLES 0419 MILE END", groups.salt)))
+
+    def test_corrections(self):
+        with tempfile.TemporaryDirectory() as test_dir:
+            gc = groups.SqlGroupCollection(test_dir)
+            with groups.DynamicGroups(backend=gc, size=0, cache=0) as dg:
+                coles = dg.insert("COLES 0412 MILE END", 0)
+                dg.insert("COLES 0419 MILE END", 1, coles)
+                dg.insert("BP HILTON 1234", 2, coles)
+                bp = dg.insert("BP HILTON 1299", 3)
+                self.assertEqual(bp, dg.move("BP HILTON 1234", bp))
+                self.assertEqual(bp, dg.find_group("BP HILTON 1234"))
+                self.assertEqual(0, dg.remove("COLES 0412 MILE END"))
+                self.assertEqual("COLES 0419 MILE END", coles.key())
+                self.assertEqual(coles, dg.find_group("COLES 0419 MILE END"))
+                with self.assertRaises(KeyError):
+                    dg.remove("COLES 0412 MILE END")
+                self.assertEqual([ 3, 2 ], dg.dissolve(bp))
+                self.assertEqual([ coles ], list(dg))
+                self.assertFalse(gc.have_association(
+                    groups.gen_id("BP HILTON 1234", groups.salt)))
+
+    def test_corrections_duplicates(self):
+        def did(description):
+            return groups.gen_id(description, groups.salt)
+        with tempfile.TemporaryDirectory() as test_dir:
+            gc = groups.SqlGroupCollection(test_dir)
+            with groups.DynamicGroups(backend=gc, size=0, cache=0) as dg:
+                coles = dg.add("COLES 0412 MILE END", 0)
+                self.assertEqual(coles, dg.add("COLES 0412 MILE END", 1))
+                dg.insert("COLES 0419 MILE END", 2, coles)
+                bp = dg.insert("BP HILTON 1234", 3)
+                self.assertEqual(0, dg.remove("COLES 0412 MILE END"))
+                # The remaining item keeps the description's association
+                self.assertEqual("COLES 0412 MILE END", coles.key())
+                self.assertEqual(did("COLES 0412 MILE END"),
+                        gc.get_canonical(did("COLES 0419 MILE END")))
+                self.assertTrue(gc.have_association(did("COLES 0412 MILE END")))
+                dg.insert("COLES 0419 MILE END", 4, coles)
+                self.assertEqual(bp, dg.move("COLES 0419 MILE END", bp))
+                self.assertEqual(did("COLES 0412 MILE END"),
+                        gc.get_canonical(did("COLES 0419 MILE END")))
+                self.assertEqual(1, dg.remove("COLES 0412 MILE END"))
+                self.assertFalse(gc.have_association(did("COLES 0412 MILE END")))
+                self.assertEqual("COLES 0419 MILE END", coles.key())
+                self.assertEqual(did("COLES 0419 MILE END"),
+                        gc.get_canonical(did("COLES 0419 MILE END")))
+                self.assertEqual([ 3, 2 ], dg.dissolve(bp))
+                self.assertEqual([ 4 ], [ i.value() for i in coles ])
+
+    def test_approximate_by_size(self):
+        with tempfile.TemporaryDirectory() as test_dir:
+            gc = groups.SqlGroupCollection(test_dir)
+            self.assertFalse(groups.DynamicGroups(backend=gc).approximate)
+            with gc:
+                gc.associate(groups.gen_id("foo", groups.salt),
+                        groups.gen_id("foo", groups.salt))
+            self.assertFalse(groups.DynamicGroups(backend=gc).approximate)
+            self.assertTrue(groups.DynamicGroups(backend=gc,
+                approximate_size=1).approximate)
+            self.assertFalse(groups.DynamicGroups(backend=gc,
+                approximate=False, approximate_size=1).approximate)
+
+    @requires_pystrgrp
+    def test_share_groups(self):
+        grouper = pystrgrp.Strgrp()
+        for i, d in enumerate([ "COLES 0412 MILE END", "BP HILTON 1234" ]):
+            grouper.add(d, i)
+        shm = groups.share_groups(grouper)
+        try:
+            # OpenMP's threads don't survive fork()
+            ctx = multiprocessing.get_context("spawn")
+            with concurrent.futures.ProcessPoolExecutor(2, mp_context=ctx) as ex:
+                found = list(ex.map(share_groups_worker, [ shm.name ] * 2))
+        finally:
+            shm.close()
+            shm.unlink()
+        self.assertEqual([ ("COLES 0412 MILE END", [ 0 ]) ] * 2, found)
+
+    def test_build_groups(self):
+        descriptions = StrgrpFallbackTest.examples() + StrgrpTest.descriptions
+        items = list((d, i) for i, d in enumerate(descriptions))
+        def built(**kwargs):
+            grouper = groups.build_groups(items, **kwargs)
+            return [ (g.key(), [ i.value() for i in g ]) for g in grouper ]
+        # The groups don't depend on the number of workers
+        sharded = built(shards=4, workers=1)
+        self.assertEqual(sharded, built(shards=4, workers=2))
+        self.assertEqual(list(range(len(items))),
+                sorted(v for _, vs in sharded for v in vs))
+        # One shard groups as adding each description does
+        canonical = groups.Canonicaliser()
+        grouper = groups.Strgrp()
+        for d, i in items:
+            grouper.add(canonical(d), i)
+        self.assertEqual([ (g.key(), [ i.value() for i in g ]) for g in grouper ],
+                built(shards=1, workers=1))
+        with self.assertRaises(ValueError):
+            groups.build_groups(items, shards=0)
+
+def share_groups_worker(name):
+    grp = groups.attach_groups(name).grp_for("COLES 0413 MILE END")
+    return grp.key(), [ i.value() for i in grp ]
+
+@requires_pystrgrp
+class StrgrpTest(unittest.TestCase):
+    descriptions = [ "WOOLWORTHS 5518 TORRENSVILLE", "WOOLWORTHS 5521 TORRENSVILLE",
+            "COLES 0412 MILE END", "COLES 0419 MILE END", "BP HILTON 1234",
+            "BP HILTON 1299", "VISA DEBIT PURCHASE CARD 1234 BUNNINGS",
+            "VISA DEBIT PURCHASE CARD 1234 BUNNINGS 44", "A", "" ]
+
+    @staticmethod
+    def cluster(descriptions, **kwargs):
+        grouper = pystrgrp.Strgrp(**kwargs)
+        for i, d in enumerate(descriptions):
+            grouper.add(d, i)
+        return [ (g.key(), [ x.value() for x in g ]) for g in grouper ]
+
+    def test_qgram_index_equivalent(self):
+        expected = self.cluster(self.descriptions)
+        for q in range(1, 5):
+            self.assertEqual(expected, self.cluster(self.descriptions, qgram=q))
+
+    def test_qgram_index_invalid(self):
+        with self.assertRaises(ValueError):
+            pystrgrp.Strgrp(qgram=9)
+
+    def test_minhash_index(self):
+        expected = self.cluster(self.descriptions)
+        self.assertEqual(expected, self.cluster(self.descriptions, bands=64))
+        grouper = pystrgrp.Strgrp(bands=4, rows=4)
+        for d in self.descriptions:
+            grouper.add(d, None)
+        self.assertGreater(grouper.pruned(), 0)
+        self.assertEqual(0, pystrgrp.Strgrp().pruned())
+
+    def test_sample_threshold(self):
+        expected = self.cluster(self.descriptions, size=2)
+        self.assertEqual(expected,
+                self.cluster(self.descriptions, size=2, samples=len(self.descriptions)))
+        with self.assertRaises(ValueError):
+            pystrgrp.Strgrp(samples=-1)
+
+    def test_grps_for(self):
+        grouper = pystrgrp.Strgrp()
+        for i, d in enumerate(self.descriptions):
+            grouper.add(d, i)
+        keys = [ g.key() for g in grouper.grps_for("COLES 0412 MILE END") ]
+        self.assertEqual(len(list(grouper)), len(keys))
+        self.assertEqual("COLES 0412 MILE END", keys[0])
+        top = grouper.grps_for("COLES 0412 MILE END", k=2)
+        self.assertEqual(2, len(top))
+        self.assertEqual(keys[0], top[0].key())
+        acceptible = grouper.grps_for("COLES 0412 MILE END", min_score=0)
+        self.assertEqual(1, len(acceptible))
+        self.assertTrue(acceptible[0].is_acceptible(grouper))
+        self.assertEqual(0, len(grouper.grps_for("", k=3, min_score=1.0)))
+        with self.assertRaises(ValueError):
+            grouper.grps_for("COLES", k=-1)
+
+    def test_grps_for_slice(self):
+        grouper = pystrgrp.Strgrp()
+        for i, d in enumerate(self.descriptions):
+            grouper.add(d, i)
+        heap = grouper.grps_for("BP HILTON 1234")
+        keys = [ g.key() for g in heap ]
+        for s in (slice(2, None), slice(None, 3), slice(None, None, -1),
+                slice(1, -1, 2), slice(5, 1)):
+            self.assertEqual(keys[s], [ g.key() for g in heap[s] ])
+        self.assertEqual(keys[1:][::-2], [ g.key() for g in heap[1:][::-2] ])
+        self.assertEqual(keys[-1], heap[-1].key())
+        with self.assertRaises(IndexError):
+            heap[len(keys)]
+        del grouper
+        self.assertEqual(keys[2:4], [ g.key() for g in heap[2:][:2] ])
+
+    def test_threads(self):
+        expected = self.cluster(self.descriptions, size=2)
+        with concurrent.futures.ThreadPoolExecutor(4) as pool:
+            results = pool.map(lambda _: self.cluster(self.descriptions, size=2),
+                    range(8))
+            self.assertTrue(all(expected == r for r in results))
+        grouper = pystrgrp.Strgrp()
+        for i, d in enumerate(self.descriptions):
+            grouper.add(d, i)
+        def best(d):
+            heap = grouper.grps_for(d)
+            return (heap[0].key(), heap[0].is_acceptible(grouper))
+        serial = [ best(d) for d in self.descriptions ]
+        with concurrent.futures.ThreadPoolExecutor(4) as pool:
+            self.assertEqual(serial * 4,
+                    list(pool.map(best, self.descriptions * 4)))
+
+    def test_grp_outlives_strgrp(self):
+        grouper = pystrgrp.Strgrp()
+        grp = grouper.add("COLES 0412 MILE END", 1)
+        del grouper
+        self.assertEqual("COLES 0412 MILE END", grp.key())
+        self.assertEqual([ 1 ], [ x.value() for x in grp ])
+
+    def test_add_many(self):
+        expected = self.cluster(self.descriptions, size=2, qgram=2)
+        grouper = pystrgrp.Strgrp(size=2, qgram=2)
+        items = list((d, i) for i, d in enumerate(self.descriptions))
+        grps = grouper.add_many(items)
+        self.assertEqual(expected,
+                [ (g.key(), [ x.value() for x in g ]) for g in grouper ])
+        self.assertEqual([ grouper.grp_exact(d).key() for d in self.descriptions ],
+                [ g.key() for g in grps ])
+        self.assertEqual([], grouper.add_many([]))
+        with self.assertRaises(TypeError):
+            grouper.add_many([ ("foo", ) ])
+        with self.assertRaises(TypeError):
+            grouper.add_many([ (1, "foo") ])
+
+    def test_long_descriptions(self):
+        # Keys beyond 64 characters take the multi-word LCS path
+        prefix = "INTERNET TRANSFER REFERENCE NUMBER FOR PAYMENT TO ACCOUNT HOLDER "
+        descriptions = [ prefix + d for d in self.descriptions ] + [
+                prefix * 3 + "A", prefix * 3 + "B" ]
+        expected = self.cluster(descriptions, size=2, threads=1)
+        self.assertEqual(expected, self.cluster(descriptions, size=2, threads=4))
+        self.assertIn([ len(descriptions) - 2, len(descriptions) - 1 ],
+                [ v for _, v in expected ])
+        grouper = pystrgrp.Strgrp(size=2, threads=4)
+        grouper.add_many((d, i) for i, d in enumerate(descriptions))
+        self.assertEqual(expected,
+                [ (g.key(), [ x.value() for x in g ]) for g in grouper ])
+
+    def test_grps_for_many(self):
+        grouper = pystrgrp.Strgrp()
+        grouper.add_many((d, i) for i, d in enumerate(self.descriptions))
+        queries = self.descriptions + [ "COLES 0413 MILE END", "ALDI" ]
+        for kwargs in ({}, { "k" : 2 }, { "min_score" : 0 }):
+            expected = [ [ (g.key(), g.is_acceptible(grouper))
+                for g in grouper.grps_for(q, **kwargs) ] for q in queries ]
+            found = [ [ (g.key(), g.is_acceptible(grouper)) for g in heap ]
+                for heap in grouper.grps_for_many(queries, **kwargs) ]
+            self.assertEqual(expected, found)
+        self.assertEqual(0, len(pystrgrp.Strgrp().grps_for_many([ "foo" ])[0]))
+
+    def test_save_load(self):
+        for kwargs in ({}, { "size" : 2, "qgram" : 2 }, { "bands" : 16 }):
+            grouper = pystrgrp.Strgrp(**kwargs)
+            for i, d in enumerate(self.descriptions):
+                grouper.add(d, (i, d))
+            with tempfile.TemporaryDirectory() as test_dir:
+                path = os.path.join(test_dir, "groups.snap")
+                grouper.save(path)
+                loaded = pystrgrp.Strgrp.load(path)
+            self.assertEqual([ (g.key(), [ x.value() for x in g ]) for g in grouper ],
+                    [ (g.key(), [ x.value() for x in g ]) for g in loaded ])
+            for d in self.descriptions:
+                self.assertEqual(grouper.grp_exact(d).key(), loaded.grp_exact(d).key())
+            for q in ("COLES 0413 MILE END", "ALDI"):
+                self.assertEqual([ g.key() for g in grouper.grps_for(q, min_score=0) ],
+                        [ g.key() for g in loaded.grps_for(q, min_score=0) ])
+                self.assertEqual(grouper.add(q, None).key(), loaded.add(q, None).key())
+
+    def test_load_invalid(self):
+        with tempfile.TemporaryDirectory() as test_dir:
+            path = os.path.join(test_dir, "groups.snap")
+            with open(path, "wb") as f:
+                f.write(b"not a snapshot")
+            with self.assertRaises(ValueError):
+                pystrgrp.Strgrp.load(path)
+            grouper = pystrgrp.Strgrp()
+            grouper.add("foo", None)
+            grouper.save(path)
+            with open(path, "r+b") as f:
+                f.truncate(os.path.getsize(path) - 1)
+            with self.assertRaises(ValueError):
+                pystrgrp.Strgrp.load(path)
+            with self.assertRaises(OSError):
+                pystrgrp.Strgrp.load(os.path.join(test_dir, "missing"))
+
+    def test_pickle(self):
+        grouper = pystrgrp.Strgrp(size=2, qgram=2)
+        for i, d in enumerate(self.descriptions):
+            grouper.add(d, (i, d))
+        grp = list(grouper)[2]
+        item = list(grp)[1]
+        loaded, lgrp, litem = pickle.loads(pickle.dumps((grouper, grp, item)))
+        self.assertEqual([ (g.key(), [ x.value() for x in g ]) for g in grouper ],
+                [ (g.key(), [ x.value() for x in g ]) for g in loaded ])
+        self.assertEqual(grp.key(), lgrp.key())
+        self.assertEqual(item.value(), litem.value())
+        # The group and item refer to the unpickled Strgrp
+        lgrp.add(loaded, "COLES 0413 MILE END", None)
+        self.assertEqual(3, loaded.grp_exact("COLES 0413 MILE END").size())
+        self.assertEqual(grouper.dumps(), pystrgrp.Strgrp.loads(grouper.dumps()).dumps())
+        with self.assertRaises(ValueError):
+            pystrgrp.Strgrp.loads(b"")
+
+    def test_pickle_reentrant(self):
+        grouper = pystrgrp.Strgrp()
+        grouper.add("COLES 0412 MILE END", 0)
+        class Keys(object):
+            def __reduce__(self):
+                return (list, ([ g.key() for g in grouper ],))
+        grouper.add("BP HILTON 1234", Keys())
+        loaded = pystrgrp.Strgrp.loads(grouper.dumps())
+        self.assertEqual([ "COLES 0412 MILE END", "BP HILTON 1234" ],
+                list(loaded.grp_exact("BP HILTON 1234"))[0].value())
+        grouper.add("WOOLWORTHS 5518", grouper.grp_exact("BP HILTON 1234"))
+        with self.assertRaises(ValueError):
+            pickle.dumps(grouper)
+
+    def test_schedule(self):
+        descriptions = self.descriptions * 20
+        expected = self.cluster(descriptions, size=2)
+        for kwargs in ({ "threads" : 2, "chunk" : 3 }, { "serial" : 4 },
+                { "threads" : 2, "autotune" : True }):
+            self.assertEqual(expected, self.cluster(descriptions, size=2, **kwargs))
+        self.assertEqual({ "threads" : 0, "chunk" : 1, "serial" : 0, "autotune" : False },
+                pystrgrp.Strgrp().schedule())
+        self.assertTrue(pystrgrp.Strgrp(autotune=True).schedule()["autotune"])
+        with self.assertRaises(ValueError):
+            pystrgrp.Strgrp(chunk=0)
+        with self.assertRaises(ValueError):
+            pystrgrp.Strgrp(threads=-1)
+
+    def test_cache_scores(self):
+        queries = [ "COLES 0413 MILE END", "BP HILTON 1288", "ALDI" ]
+        grouper = pystrgrp.Strgrp(size=2, cache=4)
+        for i, d in enumerate(self.descriptions):
+            grouper.add(d, i)
+        expected = [ [ g.key() for g in grouper.grps_for(q, min_score=0) ] for q in queries ]
+        stats = grouper.cache_stats()
+        self.assertEqual(4, stats["entries"])
+        self.assertGreater(stats["evictions"], 0)
+        for q, e in zip(queries, expected):
+            self.assertEqual(e, [ g.key() for g in grouper.grps_for(q, min_score=0) ])
+        self.assertGreater(grouper.cache_stats()["hits"], stats["hits"])
+        self.assertEqual(self.cluster(self.descriptions, size=2),
+                self.cluster(self.descriptions, size=2, cache=2))
+        with tempfile.TemporaryDirectory() as test_dir:
+            path = os.path.join(test_dir, "scores.cache")
+            grouper.save_cache(path)
+            loaded = pystrgrp.Strgrp(size=2, cache=4)
+            loaded.load_cache(path)
+            self.assertEqual(4, loaded.cache_stats()["entries"])
+            with self.assertRaises(ValueError):
+                pystrgrp.Strgrp().load_cache(path)
+            with open(path, "r+b") as f:
+                f.truncate(os.path.getsize(path) - 1)
+            with self.assertRaises(ValueError):
+                pystrgrp.Strgrp(cache=4).load_cache(path)
+        self.assertEqual({ "entries" : 0, "hits" : 0, "misses" : 0, "evictions" : 0 },
+                pystrgrp.Strgrp().cache_stats())
+
+    def test_stats(self):
+        grouper = pystrgrp.Strgrp(size=2)
+        for i, d in enumerate(self.descriptions):
+            grouper.add(d, i)
+        grouper.add(self.descriptions[0], 0)
+        stats = grouper.stats()
+        self.assertEqual(len(self.descriptions) - 1, stats["searches"])
+        self.assertEqual(1, stats["exact"])
+        self.assertGreater(stats["scanned"], 0)
+        self.assertGreater(stats["lcs"], 0)
+        self.assertGreaterEqual(stats["cells"], stats["lcs"])
+        self.assertGreater(stats["thresholds"], 0)
+        self.assertGreaterEqual(stats["score_time"], 0)
+        grouper.reset_stats()
+        self.assertTrue(all(v == 0 for v in grouper.stats().values()))
+
+    def test_metric(self):
+        expected = self.cluster(self.descriptions, size=2)
+        # The screen decides nothing with the widest margin
+        self.assertEqual(expected, self.cluster(self.descriptions, size=2,
+            screen="cosine", margin=1.0))
+        reordered = [ "BP HILTON 1234", "HILTON BP 1234" ]
+        self.assertEqual(2, len(self.cluster(reordered)))
+        for metric in ("jaccard", "cosine"):
+            for size in (0, 2):
+                self.assertEqual(1, len(self.cluster(reordered,
+                    metric=metric, size=size)))
+        grouper = pystrgrp.Strgrp(screen="jaccard", margin=0.05)
+        for i, d in enumerate(self.descriptions):
+            grouper.add(d, i)
+        self.assertGreater(grouper.stats()["cheap"], 0)
+        self.assertEqual({ "metric" : "lcs", "screen" : "jaccard",
+            "margin" : 0.05 }, grouper.metric())
+        loaded = pickle.loads(pickle.dumps(grouper))
+        self.assertEqual(grouper.metric(), loaded.metric())
+        self.assertEqual("lcs", pystrgrp.Strgrp().metric()["screen"])
+        with self.assertRaises(ValueError):
+            pystrgrp.Strgrp(metric="levenshtein")
+        with self.assertRaises(ValueError):
+            pystrgrp.Strgrp(metric="cosine", screen="jaccard")
+        with self.assertRaises(ValueError):
+            pystrgrp.Strgrp(screen="cosine", margin=-0.1)
+
+    def test_partition(self):
+        prefixes = [ "VISA DEBIT PURCHASE CARD" ]
+        for size in (0, 2):
+            expected = self.cluster(self.descriptions, size=size)
+            self.assertEqual(expected, self.cluster(self.descriptions,
+                size=size, partition=1, prefixes=prefixes))
+            self.assertEqual(expected, self.cluster(self.descriptions,
+                size=size, partition=2))
+        grouper = pystrgrp.Strgrp(partition=1, prefixes=prefixes)
+        bunnings = grouper.add("VISA DEBIT PURCHASE CARD 1234 BUNNINGS", 0)
+        grouper.add("COLES 0412 MILE END", 1)
+        grouper.reset_stats()
+        # The card number is skipped along with the prefix
+        self.assertEqual(bunnings,
+                grouper.grp_for("VISA DEBIT PURCHASE CARD 5678 BUNNINGS"))
+        self.assertEqual(1, grouper.stats()["scanned"])
+        self.assertEqual(0, grouper.stats()["widened"])
+        self.assertIsNotNone(grouper.grp_for("COLES 0419 MILE END"))
+        self.assertIsNone(grouper.grp_for("WOOLWORTHS 5518 TORRENSVILLE"))
+        self.assertEqual(1, grouper.stats()["widened"])
+        loaded = pickle.loads(pickle.dumps(grouper))
+        loaded.reset_stats()
+        self.assertEqual(bunnings.key(), loaded.grp_for(
+            "VISA DEBIT PURCHASE CARD 5678 BUNNINGS").key())
+        self.assertEqual(1, loaded.stats()["scanned"])
+        with self.assertRaises(ValueError):
+            pystrgrp.Strgrp(partition=-1)
+        with self.assertRaises(TypeError):
+            pystrgrp.Strgrp(partition=1, prefixes=[ 1 ])
+
+    def test_kernel(self):
+        # Enough similar keys of mixed lengths to fill the kernel batches
+        descriptions = self.descriptions + [ "{} {:04d} {}".format(s, i, t)
+                for i, (s, t) in enumerate(product(
+                    [ "COLES", "WOOLWORTHS", "BP HILTON" ],
+                    [ "", "MILE END", "TORRENSVILLE SOUTH AUSTRALIA" ])) ]
+        grouper = pystrgrp.Strgrp(kernel="scalar")
+        self.assertEqual({ "kernel" : "scalar", "lanes" : 1 }, grouper.kernel())
+        expected = self.cluster(descriptions, kernel="scalar")
+        for kernel in ("sse4.1", "avx2", "avx512"):
+            try:
+                grouper = pystrgrp.Strgrp(kernel=kernel)
+            except ValueError:
+                # Not supported by this CPU
+                continue
+            self.assertEqual(kernel, grouper.kernel()["kernel"])
+            self.assertEqual(expected, self.cluster(descriptions, kernel=kernel))
+        self.assertEqual({ "kernel" : "scalar", "lanes" : 1 },
+                pystrgrp.Strgrp().kernel())
+        with self.assertRaises(ValueError):
+            pystrgrp.Strgrp(kernel="neon")
+
+    def test_remove(self):
+        for kwargs in [ {}, { "size" : 2 }, { "qgram" : 0 }, { "bands" : 16 } ]:
+            grouper = pystrgrp.Strgrp(**kwargs)
+            for i, d in enumerate(self.descriptions):
+                grouper.add(d, i)
+            grp = grouper.grp_exact("COLES 0412 MILE END")
+            item = list(grp)[0]
+            with self.assertRaises(IndexError):
+                grp.remove(grouper, 2)
+            self.assertEqual(2, grp.remove(grouper, 0))
+            self.assertEqual("COLES 0412 MILE END", item.key())
+            self.assertEqual("COLES 0419 MILE END", grp.key())
+            self.assertIsNone(grouper.grp_exact("COLES 0412 MILE END"))
+            self.assertEqual(grp, grouper.grp_for("COLES 0412 MILE END"))
+            self.assertEqual(3, grp.remove(grouper, 0))
+            self.assertEqual(0, grp.size())
+            self.assertNotIn(grp.key(), [ g.key() for g in grouper ])
+            self.assertNotIn(grp.key(), [ g.key() for g in grouper.grps_for("COLES 0419 MILE END") ])
+            self.assertIsNone(grouper.grp_for("COLES 0419 MILE END"))
+            self.assertFalse(grp.add(grouper, "COLES 0419 MILE END", 3))
+            loaded = pystrgrp.Strgrp.loads(grouper.dumps())
+            self.assertEqual(self.cluster_of(grouper), self.cluster_of(loaded))
+            self.assertEqual(0, pickle.loads(pickle.dumps(grp)).size())
+
+    @staticmethod
+    def cluster_of(grouper):
+        return [ (g.key(), [ i.value() for i in g ]) for g in grouper ]
+
+    def test_move_rekey_dissolve(self):
+        grouper = pystrgrp.Strgrp(size=2)
+        for i, d in enumerate(self.descriptions):
+            grouper.add(d, i)
+        coles = grouper.grp_exact("COLES 0412 MILE END")
+        bp = grouper.grp_exact("BP HILTON 1234")
+        bp.move(grouper, 0, coles)
+        self.assertEqual([ 2, 3, 4 ], [ i.value() for i in coles ])
+        self.assertEqual(coles, grouper.grp_exact("BP HILTON 1234"))
+        self.assertEqual("BP HILTON 1299", bp.key())
+        coles.rekey(grouper, 2)
+        self.assertEqual("BP HILTON 1234", coles.key())
+        with self.assertRaises(IndexError):
+            coles.rekey(grouper, 3)
+        self.assertEqual([ 5 ], bp.dissolve(grouper))
+        self.assertEqual([], bp.dissolve(grouper))
+        with self.assertRaises(ValueError):
+            coles.move(grouper, 0, bp)
+        self.assertEqual(coles, grouper.grp_for("BP HILTON 1299"))
+        self.assertEqual(len(self.descriptions) - 1,
+                sum(g.size() for g in grouper))
+
+    def test_dissolved_reclaimed(self):
+        for kwargs in [ {}, { "qgram" : 0 }, { "bands" : 16 } ]:
+            grouper = pystrgrp.Strgrp(**kwargs)
+            for i, d in enumerate(self.descriptions):
+                grouper.add(d, i)
+            expected = self.cluster_of(grouper)
+            held = grouper.grp_exact("A")
+            self.assertEqual([ 8 ], held.dissolve(grouper))
+            it = iter(grouper)
+            first = next(it)
+            for i in range(1000):
+                grp = grouper.add("TRANSFER %d TO SAVINGS" % (i * 7919), i)
+                self.assertEqual(i, grp.remove(grouper, 0))
+            remaining = expected[:-2] + expected[-1:]
+            self.assertEqual(remaining, [ (g.key(), [ i.value() for i in g ])
+                for g in [ first ] + list(it) if g.size() ])
+            with self.assertRaises(IndexError):
+                pystrgrp._grp(grouper, 100)
+            self.assertEqual("A", held.key())
+            self.assertEqual(0, held.size())
+            self.assertEqual(remaining, self.cluster_of(grouper))
+            self.assertEqual(grouper.grp_exact("BP HILTON 1234"),
+                    grouper.grp_for("BP HILTON 1299"))
+            loaded = pystrgrp.Strgrp.loads(grouper.dumps())
+            self.assertEqual(self.cluster_of(grouper), self.cluster_of(loaded))
+
+    def test_variants(self):
+        descriptions = [ "COLES 0412 MILE END", "COLES 0419 MILE END",
+                "COLES 0412 MILE END", "COLES 0412 MILE END", "BP HILTON 1234",
+                "COLES 0419 MILE END" ]
+        expected = self.cluster(descriptions, size=4)
+        for kwargs in ({}, { "size" : 4 }, { "size" : 4, "samples" : 1 }):
+            grouper = pystrgrp.Strgrp(**kwargs)
+            for i, d in enumerate(descriptions):
+                grouper.add(d, i)
+            self.assertEqual(expected, self.cluster_of(grouper))
+            coles = grouper.grp_exact("COLES 0412 MILE END")
+            self.assertEqual([ ("COLES 0412 MILE END", 3),
+                ("COLES 0419 MILE END", 2) ], coles.variants())
+            self.assertEqual(5, coles.size())
+            loaded = pystrgrp.Strgrp.loads(grouper.dumps())
+            self.assertEqual(coles.variants(),
+                    loaded.grp_exact("COLES 0412 MILE END").variants())
+            coles.remove(grouper, 1)
+            coles.remove(grouper, 3)
+            self.assertEqual([ ("COLES 0412 MILE END", 3) ], coles.variants())
+            self.assertIsNone(grouper.grp_exact("COLES 0419 MILE END"))
+            bp = grouper.grp_exact("BP HILTON 1234")
+            coles.move(grouper, 0, bp)
+            self.assertEqual([ ("COLES 0412 MILE END", 2) ], coles.variants())
+            self.assertEqual([ ("BP HILTON 1234", 1),
+                ("COLES 0412 MILE END", 1) ], bp.variants())
+
+    def test_minhash_index_invalid(self):
+        with self.assertRaises(ValueError):
+            pystrgrp.Strgrp(bands=16, rows=0)
+        with self.assertRaises(ValueError):
+            pystrgrp.Strgrp(bands=512, rows=4)
+
+class StrgrpFallbackTest(unittest.TestCase):
+    """The fallback must group as the extension does"""
+    @staticmethod
+    def examples():
+        path = os.path.join(os.path.dirname(__file__), "..", "..", "examples",
+                "transactions.csv")
+        with open(path) as f:
+            return [ row[2] for row in csv.reader(f) if row ]
+
+    @staticmethod
+    def searched(module, descriptions, **kwargs):
+        grouper = module.Strgrp(**kwargs)
+        for i, d in enumerate(descriptions):
+            grouper.add(d, i)
+        found = [ [ (g.key(), g.is_acceptible(grouper))
+            for g in grouper.grps_for(d, min_score=0) ]
+            for d in descriptions[::7] ]
+        return StrgrpTest.cluster_of(grouper), found
+
+    def test_lcs(self):
+        r = random.Random(0)
+        # Cover patterns spanning one, two and three words
+        for la in (0, 1, 63, 64, 65, 130):
+            a = "".join(r.choice("abc") for _ in range(la))
+            bs = [ "".join(r.choice("abc") for _ in range(r.randrange(100)))
+                    for _ in range(8) ]
+            codes = strgrp._pack([ b.encode("UTF-8") for b in bs ])
+            self.assertEqual([ core.lcs(a, b) for b in bs ],
+                    list(strgrp.lcs(a.encode("UTF-8"), codes)))
+
+    @requires_pystrgrp
+    def test_search(self):
+        descriptions = self.examples() + StrgrpTest.descriptions
+        for kwargs in ({}, { "size" : 2 }, { "size" : 4, "samples" : 2 },
+                { "threshold" : 0.7 }):
+            self.assertEqual(self.searched(pystrgrp, descriptions, **kwargs),
+                    self.searched(strgrp, descriptions, **kwargs))
+
+    @requires_pystrgrp
+    def test_edits(self):
+        def edited(module):
+            grouper = module.Strgrp(size=2)
+            for i, d in enumerate(self.examples()):
+                grouper.add(d, i)
+            r = random.Random(1)
+            for _ in range(100):
+                grps = list(grouper)
+                grp = r.choice(grps)
+                op = r.randrange(3) if r.random() < 0.9 else 3
+                if op == 0:
+                    grp.remove(grouper, r.randrange(grp.size()))
+                elif op == 1:
+                    grp.move(grouper, r.randrange(grp.size()), r.choice(grps))
+                elif op == 2:
+                    grp.rekey(grouper, r.randrange(grp.size()))
+                elif op == 3:
+                    grp.dissolve(grouper)
+            return self.searched(module, StrgrpTest.descriptions), \
+                    StrgrpTest.cluster_of(grouper), \
+                    [ g.variants() for g in grouper ], \
+                    [ grouper.grp_for(d) and grouper.grp_for(d).key()
+                            for d in self.examples() ]
+        self.assertEqual(edited(pystrgrp), edited(strgrp))
+
+    def test_pickle(self):
+        grouper = strgrp.Strgrp(size=2)
+        for i, d in enumerate(StrgrpTest.descriptions):
+            grouper.add(d, i)
+        loaded = strgrp.Strgrp.loads(grouper.dumps())
+        self.assertEqual(StrgrpTest.cluster_of(grouper),
+                StrgrpTest.cluster_of(loaded))
+        grp = grouper.grp_exact("COLES 0412 MILE END")
+        self.assertEqual(grp.key(), pickle.loads(pickle.dumps(grp)).key())
+        with self.assertRaises(ValueError):
+            strgrp.Strgrp(metric="jaccard")
+        with self.assertRaises(ValueError):
+            strgrp.Strgrp(kernel="avx2")
+
+    def test_dynamic_groups(self):
+        with tempfile.TemporaryDirectory() as test_dir, \
+                mock.patch.object(groups, "Strgrp", strgrp.Strgrp):
+            gc = groups.SqlGroupCollection(test_dir)
+            with groups.DynamicGroups(backend=gc, size=0) as dg:
+                coles = dg.add("COLES 0412 MILE END", 0)
+                self.assertIsInstance(coles, strgrp.Grp)
+                self.assertEqual(coles, dg.add("COLES 0419 MILE END", 1))
+                self.assertEqual(coles, dg.find_group("COLES 0419 MILE END"))
+                self.assertEqual(1, dg.stats()["searches"])
+
 if __name__ == '__main__':
     unittest.main()
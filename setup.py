@@ -24,7 +24,6 @@ pystrgrp = Extension('pystrgrp',
         "ext/ccan/list/list.c",
         "ext/ccan/str/debug.c",
         "ext/ccan/strgrp/strgrp.c",
-        "ext/ccan/stringmap/stringmap.c",
         "ext/ccan/str/str.c",
         "ext/ccan/take/take.c",
         "ext/ccan/talloc/talloc.c",
@@ -34,7 +33,8 @@ pystrgrp = Extension('pystrgrp',
         "ext/pystrgrp.c"
         ],
     depends = [ 'ext/config.h' ],
-    optional = False
+    # fpos.strgrp stands in for the extension if it cannot be built
+    optional = True
     )
 
 setup(name='fpos',